@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+'''
+Bytes and CPU per message for each wire codec.
+
+    python bench/codec.py [iterations]
+'''
+
+import os
+import sys
+import uuid
+import base64
+import timeit
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "p2p"))
+import codec
+
+def mkmsg(msgtype, **extra):
+    msg = {}
+    msg['type'] = msgtype
+    msg['id'] = (uuid.uuid4().int, (3, 7))
+    msg['stamp'] = uuid.uuid4().int
+    msg['srvport'] = 6966
+    msg['clock'] = base64.b64encode(os.urandom(24))
+    msg.update(extra)
+    return msg
+
+samples = [
+    ('maekawa', mkmsg('maekawa', maekawa='grant', seq=12)),
+    ('newlm', mkmsg('newlm', newlm=(4, 3), src=['10.0.0.12', 6966])),
+    ('data', mkmsg('data', data={'update': True, 'token': 'x' * 64})),
+    ('data-1k', mkmsg('data', data={'blob': 'y' * 1024})),
+]
+
+def bench(n):
+    print "%-10s %-6s %8s %12s %12s" % ("message", "codec", "bytes", "enc us/msg", "dec us/msg")
+    for label, msg in samples:
+        for name in codec.PREFERENCE:
+            c = codec.codecs[name]
+            wire = c.encode(msg)
+            assert c.decode(wire) == codec.codecs['json'].decode(codec.codecs['json'].encode(msg))
+            enc = timeit.timeit(lambda: c.encode(msg), number=n) / n * 1e6
+            dec = timeit.timeit(lambda: c.decode(wire), number=n) / n * 1e6
+            print "%-10s %-6s %8d %12.2f %12.2f" % (label, name, len(wire), enc, dec)
+
+if __name__ == '__main__':
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+'''
+Routing table costs: XOR distance on 20-byte strings (the way dht.py
+used to do it) against ints, and inserts and k-closest queries on a
+RoutingTable holding lots of contacts.
+
+    python bench/dht.py [contacts seen]
+'''
+
+import os
+import sys
+import time
+import random
+import hashlib
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "p2p"))
+import dht
+
+def strxor(id1, id2):
+    # the original DHT.xor
+    k = 0
+    m = len(id1)
+    for x in xrange(m):
+        k += (ord(id1[x])^ord(id2[x])) * 256**((m - 1) - x)
+    return k
+
+def timeit(f, n):
+    start = time.time()
+    for _ in xrange(n):
+        f()
+    return (time.time() - start) / n * 1e6
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    a, b = hashlib.sha1('a').digest(), hashlib.sha1('b').digest()
+    ia, ib = dht.DHT.sha2num(a), dht.DHT.sha2num(b)
+    print "%-28s %10.3f us" % ("xor, strings", timeit(lambda: strxor(a, b), 20000))
+    print "%-28s %10.3f us" % ("xor, ints", timeit(lambda: ia ^ ib, 200000))
+
+    me = random.getrandbits(160)
+    ids = [random.getrandbits(160) for _ in xrange(n)]
+    for bits in (1, 5):
+        t = dht.RoutingTable(me, 20, b=bits)
+        start = time.time()
+        for i in ids:
+            t.update(i, ('127.0.0.1', 1))
+        ins = (time.time() - start) / n * 1e6
+        q = timeit(lambda: t.closest(random.getrandbits(160)), 5000)
+        print "b=%d: %6d contacts in %3d buckets, update %.2f us, closest %.1f us (%.3f us/contact)" % \
+            (bits, len(t), len(t.buckets), ins, q, q / len(t))
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+'''
+A DHT of lots of nodes on localhost: how long lookups take, how many
+RPCs they cost, and how many of the true k closest nodes they find.
+
+    python bench/dhtnet.py [nodes] [lookups] [alpha]
+'''
+
+import os
+import sys
+import time
+import random
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "p2p"))
+import dht
+
+def build(n, alpha):
+    nodes = []
+    first = dht.DHT(port=0, alpha=alpha)
+    first.start()
+    nodes.append(first)
+    boot = [('127.0.0.1', first.port)]
+    for i in xrange(n - 1):
+        d = dht.DHT(bootstrap=boot, port=0, alpha=alpha)
+        d.start()
+        nodes.append(d)
+        if i % 20 == 19:
+            # let the joins settle, and bootstrap off someone newer
+            time.sleep(0.2)
+            boot = [('127.0.0.1', random.choice(nodes).port)]
+    time.sleep(1)
+    return nodes
+
+def lookups(nodes, m):
+    ids = sorted(d.id for d in nodes)
+    k = nodes[0].table.k
+    futures = []
+    for _ in xrange(m):
+        target = random.getrandbits(160)
+        futures.append((target, random.choice(nodes).find_node(target)))
+    times, rpcs, found = [], [], []
+    for target, f in futures:
+        got = set(nid for nid, addr in f.result(60))
+        want = set(sorted(ids, key=lambda i: i ^ target)[:k])
+        l = f.lookup
+        times.append(l.elapsed)
+        rpcs.append(l.rpcs)
+        found.append(len(got & want) / float(k))
+    return times, rpcs, found
+
+def pct(xs, p):
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(len(xs) * p))]
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    m = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    alpha = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+    start = time.time()
+    nodes = build(n, alpha)
+    print "%d nodes up in %.1fs, %.0f contacts each" % \
+        (n, time.time() - start, sum(len(d.table) for d in nodes) / float(n))
+    start = time.time()
+    times, rpcs, found = lookups(nodes, m)
+    took = time.time() - start
+    print "%d lookups (alpha %d) in %.2fs, all in flight at once" % (m, alpha, took)
+    print "latency ms: p50 %.1f p90 %.1f p99 %.1f" % \
+        tuple(pct(times, p) * 1000 for p in (0.5, 0.9, 0.99))
+    print "rpcs per lookup: mean %.1f max %d" % (sum(rpcs) / float(m), max(rpcs))
+    print "true k closest found: %.1f%%" % (100 * sum(found) / m)
+    sent = sum(d.rpc.stats['sent'] for d in nodes)
+    print "datagrams: %d sent, %d retries, %d timeouts" % \
+        (sent, sum(d.rpc.stats['retries'] for d in nodes),
+         sum(d.rpc.stats['timeouts'] for d in nodes))
+    for d in nodes:
+        d.stop()
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+'''
+A lace of Broadcasters on localhost, measured: how long joins take,
+broadcast latency, throughput and duplicate deliveries, mutex
+throughput and waits under contention, and bytes on the wire per
+message type.  Results come out as json, so runs can be diffed.
+
+    python bench/lace.py [--nodes 4,9,16] [--messages 200] [--locks 10]
+                         [--keys 1] [--evloop] [--seed N] [--out results.json]
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import optparse
+import threading
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "p2p"))
+import broadcaster
+import codec
+
+def msgtype(data):
+    # the type of an encoded message, without decoding all of it
+    if data[:1] == codec.BinaryCodec.MAGIC:
+        t = codec.BinaryCodec.TYPES[ord(data[1])]
+        if t:
+            return t
+    return codec.Envelope.decode(data)['type']
+
+class Wire(object):
+    '''
+    Counts frames and bytes sent, per message type, across a lace.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.frames = {}
+            self.bytes = {}
+
+    def watch(self, b):
+        send = b.tcp.send
+        def counted(msg, conn, *args):
+            t = msgtype(msg)
+            with self.lock:
+                self.frames[t] = self.frames.get(t, 0) + 1
+                self.bytes[t] = self.bytes.get(t, 0) + len(msg) + 4
+            return send(msg, conn, *args)
+        b.tcp.send = counted
+
+def pct(xs, ps=(0.5, 0.9, 0.99)):
+    xs = sorted(xs)
+    if not xs:
+        return {}
+    out = dict(('p%g' % (p * 100), xs[min(len(xs) - 1, int(len(xs) * p))]) for p in ps)
+    out['max'] = xs[-1]
+    out['mean'] = sum(xs) / len(xs)
+    return out
+
+def wait(cond, timeout, step=0.01):
+    end = time.time() + timeout
+    while not cond():
+        if time.time() > end:
+            return False
+        time.sleep(step)
+    return True
+
+def build(n, evloop, wire):
+    '''
+    Start n nodes, one after the other, each bootstrapping off the
+    first, and time each join: until it has its place in the lace and
+    a connection to everyone else in its row and column.
+    '''
+    first = broadcaster.Broadcaster(port=0, evloop=evloop)
+    first.base()
+    wire.watch(first)
+    first.start()
+    nodes = [first]
+    joins = []
+    for i in xrange(n - 1):
+        b = broadcaster.Broadcaster([('127.0.0.1', first.tcp.port)], port=0, evloop=evloop)
+        wire.watch(b)
+        start = time.time()
+        b.start()
+        joined = lambda: b.value != (0, 0) and len(b.peers) >= \
+            sum(1 for o in nodes if o.ispeer(b.value) and o.value != b.value)
+        if not wait(joined, 30):
+            raise RuntimeError("node %d never joined" % (i + 1))
+        joins.append(time.time() - start)
+        nodes.append(b)
+    # let the last newlm and needpeer floods die down
+    time.sleep(0.5)
+    return nodes, joins
+
+def broadcasts(nodes, m, wire):
+    n = len(nodes)
+    lock = threading.Lock()
+    seen = {}    # (seq, node) -> deliveries
+    lat = []
+    for i, b in enumerate(nodes):
+        def react(data, reply=None, msg=None, i=i):
+            if not isinstance(data, dict) or 'bench' not in data:
+                return
+            now = time.time()
+            with lock:
+                key = (data['bench'], i)
+                seen[key] = seen.get(key, 0) + 1
+                lat.append(now - data['t'])
+        b.event += react
+    wire.reset()
+    start = time.time()
+    for seq in xrange(m):
+        random.choice(nodes).send({'bench': seq, 't': time.time()})
+    want = m * (n - 1)
+    delivered = wait(lambda: len(lat) >= want, 30)
+    took = time.time() - start
+    time.sleep(0.2) # for stragglers and duplicates
+    with lock:
+        dups = sum(c - 1 for c in seen.values())
+        got = len(seen)
+        lats = list(lat)
+    frames = wire.frames.get('data', 0)
+    return {
+        'messages': m,
+        'deliveries': got,
+        'complete': delivered,
+        'seconds': took,
+        'deliveries_per_sec': got / took,
+        'messages_per_sec': m / took,
+        'latency': pct(lats),
+        'duplicate_deliveries': dups,
+        'frames_per_message': frames / float(m),
+        'redundant_frames_per_message': (frames - got) / float(m),
+    }
+
+def mutexes(nodes, rounds, keys):
+    lock = threading.Lock()
+    waits = []
+    held = {}
+    overlaps = [0]
+    def worker(b):
+        for r in xrange(rounds):
+            key = None if keys == 1 else 'k%d' % random.randrange(keys)
+            start = time.time()
+            with b.mutex(key):
+                waited = time.time() - start
+                with lock:
+                    waits.append(waited)
+                    overlaps[0] += held.get(key, 0)
+                    held[key] = held.get(key, 0) + 1
+                with lock:
+                    held[key] -= 1
+    ts = [threading.Thread(target=worker, args=(b,)) for b in nodes]
+    start = time.time()
+    for t in ts:
+        t.daemon = True
+        t.start()
+    for t in ts:
+        t.join(120)
+    took = time.time() - start
+    return {
+        'acquisitions': len(waits),
+        'keys': keys,
+        'seconds': took,
+        'acquisitions_per_sec': len(waits) / took,
+        'wait': pct(waits),
+        'overlaps': overlaps[0],
+    }
+
+def run(n, opts):
+    wire = Wire()
+    nodes, joins = build(n, opts.evloop, wire)
+    joinwire = dict((t, {'frames': wire.frames[t], 'bytes': wire.bytes[t]}) for t in wire.frames)
+    result = {'nodes': n, 'join': dict(pct(joins), total=sum(joins)), 'join_wire': joinwire}
+    result['broadcast'] = bcast = broadcasts(nodes, opts.messages, wire)
+    bcast['wire'] = dict((t, {'frames': wire.frames[t], 'bytes': wire.bytes[t]}) for t in wire.frames)
+    wire.reset()
+    result['mutex'] = mx = mutexes(nodes, opts.locks, opts.keys)
+    mx['wire'] = dict((t, {'frames': wire.frames[t], 'bytes': wire.bytes[t]}) for t in wire.frames)
+    for b in nodes:
+        b.stop()
+    return result
+
+if __name__ == '__main__':
+    p = optparse.OptionParser()
+    p.add_option('--nodes', default='4,9,16', help='lace sizes, comma separated')
+    p.add_option('--messages', type='int', default=200, help='broadcasts per size')
+    p.add_option('--locks', type='int', default=10, help='mutex rounds per node')
+    p.add_option('--keys', type='int', default=1, help='lock keys to spread over')
+    p.add_option('--evloop', action='store_true', help='event loop transport')
+    p.add_option('--seed', type='int', default=None)
+    p.add_option('--out', default=None, help='write json here, not stdout')
+    opts, args = p.parse_args()
+    if opts.seed is not None:
+        random.seed(opts.seed)
+    results = {
+        'params': dict(vars(opts)),
+        'started': time.time(),
+        'runs': [],
+    }
+    for n in [int(x) for x in opts.nodes.split(',')]:
+        sys.stderr.write("%d nodes...\n" % n)
+        results['runs'].append(run(n, opts))
+    out = json.dumps(results, indent=2, sort_keys=True)
+    if opts.out:
+        with open(opts.out, 'w') as f:
+            f.write(out + "\n")
+    else:
+        print out
+    sys.stdout.flush()
+    # peer threads don't all know how to stop
+    os._exit(0)
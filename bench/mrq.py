@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+'''
+Dedup cache throughput: the new MRQ and BloomMRQ against the list-
+backed MRQ they replaced.
+
+    python bench/mrq.py [operations]
+'''
+
+import os
+import sys
+import uuid
+import time
+import random
+import threading
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "p2p"))
+import mrq
+
+class ListMRQ(object):
+    '''
+    The original list-plus-set MRQ, kept here for comparison.
+    '''
+    def __init__(self, limit=50):
+        self.limit = limit
+        self.count = 0
+        self.list = []
+        self.set = set()
+        self.lock = threading.RLock()
+
+    def add(self, obj):
+        with self.lock:
+            if obj in self.set:
+                self.list.remove(obj)
+                self.list.append(obj)
+                return
+            self.list.append(obj)
+            self.set.add(obj)
+            self.count += 1
+
+    def remove(self):
+        with self.lock:
+            o = self.list[0]
+            self.list = self.list[1:]
+            self.set.remove(o)
+            self.count -= 1
+
+    def __iadd__(self, obj):
+        with self.lock:
+            self.add(obj)
+            while self.count > self.limit:
+                self.remove()
+        return self
+
+    def __contains__(self, obj):
+        return obj in self.set
+
+def workload(n, limit):
+    # a flood: each stamp shows up a few times (once per peer that
+    # relays it), interleaved with newer ones
+    stamps = [uuid.uuid4().int for _ in xrange(n / 4)]
+    ops = []
+    for i, s in enumerate(stamps):
+        ops.append(s)
+        for _ in xrange(3):
+            ops.append(stamps[max(0, i - random.randint(0, limit / 2))])
+    return ops
+
+def run(cls, ops, limit):
+    q = cls(limit)
+    start = time.time()
+    for s in ops:
+        if s in q:
+            pass
+        q += s
+    return (time.time() - start) / len(ops) * 1e6
+
+def falsepositives(limit, fprate, n=200000):
+    q = mrq.BloomMRQ(limit, fprate=fprate)
+    for _ in xrange(limit * 3):
+        q += uuid.uuid4().int
+    hits = sum(1 for _ in xrange(n) if uuid.uuid4().int in q)
+    return float(hits) / n
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    print "%-10s %-10s %12s" % ("limit", "cache", "us/op")
+    for limit in (2500, 25000):
+        ops = workload(n, limit)
+        for name, cls in (('list', ListMRQ), ('mrq', mrq.MRQ), ('bloom', mrq.BloomMRQ)):
+            print "%-10d %-10s %12.2f" % (limit, name, run(cls, ops, limit))
+    for fp in (0.01, 0.001):
+        print "bloom fprate %g: measured %.5f" % (fp, falsepositives(2500, fp))
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+'''
+Big laces in a simulated network (see p2p/sim.py), measured in
+virtual time: frames per broadcast and how long it takes to reach
+everyone, mutex fairness when lots of nodes want the lock at once,
+and how long real joins take to settle.  The same seed gives the same
+numbers, every run.  Results come out as json, like bench/lace.py.
+
+    python bench/sim.py [--nodes 100,1000] [--messages 10] [--lockers 100]
+                        [--joins 50] [--latency 0.002] [--jitter 0.001]
+                        [--bandwidth B] [--loss 0.0] [--partition]
+                        [--seed 0] [--out results.json]
+'''
+
+import os
+import sys
+import json
+import time
+import optparse
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "p2p"))
+import sim
+import broadcaster
+
+def pct(xs, ps=(0.5, 0.9, 0.99)):
+    xs = sorted(xs)
+    if not xs:
+        return {}
+    out = dict(('p%g' % (p * 100), xs[min(len(xs) - 1, int(len(xs) * p))]) for p in ps)
+    out['max'] = xs[-1]
+    out['mean'] = sum(xs) / len(xs)
+    return out
+
+def jain(xs):
+    # 1 if everyone got the same, down to 1/n if one got it all
+    if not xs or not any(xs):
+        return 1.0
+    return sum(xs) ** 2 / (len(xs) * sum(x * x for x in xs))
+
+def network(opts):
+    return sim.Network(seed=opts.seed, latency=opts.latency, jitter=opts.jitter,
+                       bandwidth=opts.bandwidth, loss=opts.loss)
+
+def wire(net, before):
+    types = net.stats['types']
+    return dict((t, {'frames': c[0] - before.get(t, (0, 0))[0],
+                     'bytes': c[1] - before.get(t, (0, 0))[1]})
+                for t, c in types.items() if c[0] > before.get(t, (0, 0))[0])
+
+def snapshot(net):
+    return dict((t, tuple(c)) for t, c in net.stats['types'].items())
+
+def broadcasts(net, nodes, m):
+    n = len(nodes)
+    seen = {}   # (seq, node) -> deliveries
+    lat = []
+    sent = {}
+    for i, b in enumerate(nodes):
+        def react(data, reply=None, msg=None, i=i):
+            if not isinstance(data, dict) or 'bench' not in data:
+                return
+            key = (data['bench'], i)
+            seen[key] = seen.get(key, 0) + 1
+            lat.append(net.now - sent[data['bench']])
+        b.event += react
+    before = snapshot(net)
+    for seq in xrange(m):
+        sent[seq] = net.now
+        net.random.choice(nodes).send({'bench': seq})
+        net.run(0.001)
+    net.run(stop=lambda: len(lat) >= m * (n - 1), duration=60)
+    net.run(0.5) # for stragglers and duplicates
+    frames = net.stats['types'].get('data', [0])[0] - before.get('data', (0,))[0]
+    return {
+        'messages': m,
+        'deliveries': len(seen),
+        'complete': len(seen) == m * (n - 1),
+        'latency': pct(lat),
+        'duplicate_deliveries': sum(c - 1 for c in seen.values()),
+        'frames_per_message': frames / float(m),
+        'wire': wire(net, before),
+    }
+
+def mutexes(net, nodes, lockers, hold=0.01):
+    '''
+    lockers nodes all ask for the lock at the same moment, and each
+    holds it for hold seconds.  Everyone should get it, one at a time,
+    and nobody should wait much longer than their share.
+    '''
+    chosen = net.random.sample(nodes, min(lockers, len(nodes)))
+    start = net.now
+    waits = {}
+    held = [0]
+    overlaps = [0]
+    def granted(b):
+        def done(*args):
+            waits[b.uuid] = net.now - start
+            overlaps[0] += held[0]
+            held[0] += 1
+            def release():
+                held[0] -= 1
+                b.release()
+            net.later(hold, release)
+        return done
+    before = snapshot(net)
+    frames = net.stats['frames']
+    for b in chosen:
+        b.acquire(granted(b))
+    net.run(stop=lambda: len(waits) == len(chosen), duration=3600)
+    took = net.now - start
+    order = sorted(waits.values())
+    # how long each waited past the last grant before it, so a fair
+    # lock hands out roughly equal turns
+    turns = [b - a for a, b in zip([0] + order, order)]
+    return {
+        'lockers': len(chosen),
+        'acquisitions': len(waits),
+        'seconds': took,
+        'wait': pct(waits.values()),
+        'turn': pct(turns),
+        'fairness': jain(turns),
+        'overlaps': overlaps[0],
+        'frames_per_lock': (net.stats['frames'] - frames) / float(max(1, len(waits))),
+        'wire': wire(net, before),
+    }
+
+def joins(opts):
+    '''
+    A lace built with real joins, one after the other through the
+    first node: how long (virtual) till everyone has its place and all
+    its peers, and what it cost on the wire.
+    '''
+    net = network(opts)
+    nodes = sim.lace(net, 1, heartbeat=opts.heartbeat)
+    first = nodes[0]
+    times = []
+    for i in xrange(opts.joins - 1):
+        b = broadcaster.Broadcaster([first.tcp.addr], transport=net.transport(),
+                                    heartbeat=opts.heartbeat)
+        start = net.now
+        b.start()
+        joined = lambda: b.value != (0, 0) and len(b.peers) >= \
+            sum(1 for o in nodes if o.ispeer(b.value) and o.value != b.value)
+        net.run(stop=joined, duration=60)
+        times.append(net.now - start if joined() else None)
+        nodes.append(b)
+    net.run(1)
+    return {
+        'nodes': opts.joins,
+        'joined': sum(1 for t in times if t is not None),
+        'join': pct([t for t in times if t is not None]),
+        'frames': net.stats['frames'],
+        'frames_per_join': net.stats['frames'] / float(max(1, len(times))),
+        'wire': wire(net, {}),
+    }
+
+def partition(net, nodes):
+    '''
+    Cut the lace in half, broadcast on one side, heal, and see who got
+    it: a flood only reaches whoever it can reach at the time.
+    '''
+    half = len(nodes) // 2
+    net.partition([b.tcp for b in nodes[:half]], [b.tcp for b in nodes[half:]])
+    got = set()
+    for i, b in enumerate(nodes):
+        b.event += lambda data, i=i, **kw: isinstance(data, dict) and \
+            'split' in data and got.add(i)
+    nodes[0].send({'split': 1})
+    net.run(1)
+    during = len(got)
+    net.heal()
+    net.run(5)
+    return {'sides': [half, len(nodes) - half], 'reached': during,
+            'reached_after_heal': len(got)}
+
+def run(n, opts):
+    net = network(opts)
+    wall = time.time()
+    nodes = sim.lace(net, n, heartbeat=opts.heartbeat)
+    result = {'nodes': n, 'peers': pct([len(b.peers) for b in nodes]),
+              'lace_max': list(nodes[-1].lace_max)}
+    result['broadcast'] = broadcasts(net, nodes, opts.messages)
+    if opts.lockers:
+        result['mutex'] = mutexes(net, nodes, opts.lockers)
+    if opts.partition:
+        result['partition'] = partition(net, nodes)
+    result['virtual_seconds'] = net.now
+    result['wall_seconds'] = time.time() - wall
+    return result
+
+if __name__ == '__main__':
+    p = optparse.OptionParser()
+    p.add_option('--nodes', default='100,1000', help='lace sizes, comma separated')
+    p.add_option('--messages', type='int', default=10, help='broadcasts per size')
+    p.add_option('--lockers', type='int', default=100, help='nodes after the lock at once')
+    p.add_option('--joins', type='int', default=50, help='lace size to build with real joins, 0 for none')
+    p.add_option('--latency', type='float', default=0.002)
+    p.add_option('--jitter', type='float', default=0.001)
+    p.add_option('--bandwidth', type='float', default=None, help='bytes/second per node')
+    p.add_option('--loss', type='float', default=0.0)
+    p.add_option('--heartbeat', type='float', default=1.0)
+    p.add_option('--partition', action='store_true', help='split each lace in two for a bit')
+    p.add_option('--seed', type='int', default=0)
+    p.add_option('--out', default=None, help='write json here, not stdout')
+    opts, args = p.parse_args()
+    results = {'params': dict(vars(opts)), 'runs': []}
+    for n in [int(x) for x in opts.nodes.split(',')]:
+        sys.stderr.write("%d nodes...\n" % n)
+        results['runs'].append(run(n, opts))
+    if opts.joins > 1:
+        sys.stderr.write("%d joins...\n" % opts.joins)
+        results['joins'] = joins(opts)
+    out = json.dumps(results, indent=2, sort_keys=True)
+    if opts.out:
+        with open(opts.out, 'w') as f:
+            f.write(out + "\n")
+    else:
+        print out
@@ -1,4 +1,6 @@
 from dht import DHT
 from broadcaster import Broadcaster
+from kv import KVStore
+from merkle import AntiEntropy
 
 __version__ = '0.0.5'
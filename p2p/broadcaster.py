@@ -12,7 +12,26 @@ import tcp
 import timer
 import event
 import mrq
+import codec
 import maekawa
+import connpool
+import failure
+import stream
+from metrics import Metrics, NULL
+
+def fillindex(value):
+    '''
+    Where value comes in the order get_next_addr fills the lace,
+    counting (1, 1) as 1, and (0, 0) as 0.  Every slot with a shell
+    number max(x, y) below m is filled before any in shell m.
+    '''
+    x, y = value
+    m = max(x, y)
+    if x == y:
+        return m * m
+    if x == m:
+        return (m - 1) ** 2 + 2 * (y - 1) + 1
+    return (m - 1) ** 2 + 2 * (x - 1) + 2
 
 class Broadcaster(object):
     '''
@@ -21,35 +40,139 @@ class Broadcaster(object):
 
     Except "designed" doesn't really convey the amount of flailing
     going on, here.
+
+    transport replaces the TCP transport with anything that quacks
+    like it (see sim.py).  One that keeps its own time can also bring
+    a clock, a wheel and a random.Random, and set inline to have
+    everything run on the caller's thread.
+
+    metrics=True keeps count of what the node's doing, in a
+    metrics.Metrics at self.metrics (or pass one in): messages and
+    bytes by type and by peer, duplicates, how long handlers take,
+    lock waits, queue depths and the like.  Take a look with
+    self.metrics.snapshot(), or serve it up with self.metrics.serve().
+    Off, it costs next to nothing.
     '''
-    def __init__(self, bootstrap=(), port=6966, heartbeat=30, joincb=None):
+    def __init__(self, bootstrap=(), port=6966, heartbeat=30, joincb=None,
+                 evloop=False, codecs=codec.PREFERENCE, pool=None, suspect=8.0,
+                 wheel=None, lease=60, tree=True, transport=None, metrics=None):
         self.c = 0
         self.peers = {}
-        self.clist = {}
-        self.uuid = uuid.uuid4().int
+        self.metrics = Metrics() if metrics is True else (metrics or NULL)
+        self.tcp = transport or tcp.TCP(port, evloop, self.metrics)
+        self.now = getattr(self.tcp, 'clock', time.time)
+        self.rng = getattr(self.tcp, 'random', None)
+        inline = getattr(self.tcp, 'inline', False)
+        self.uuid = self.newid()
         self.value = (0, 0)
         self.lace_max = (0, 0)
-        self.tcp = tcp.TCP(port)
         self.seen = mrq.MRQ(2500)
         self.tcp.handlers += self.handle_tcp_msg
+        self.tcp.disconnected += self.handle_disconnect
+        self.conns = connpool.ConnPool(self.tcp, clock=self.now)
         self.lock = threading.RLock()
         self.plock = threading.Lock()
-        self.timer = timer.Timer(heartbeat)
-        self.handlers = event.Event()
+        self.stateq = event.Serial(inline)
+        # every timer the node (and its mutexes) needs hangs off one wheel
+        self.wheel = wheel or getattr(self.tcp, 'wheel', None) or timer.wheel()
+        self.timer = timer.Timer(heartbeat, self.wheel, jitter=heartbeat / 10.0)
+        self.timer += self.conns.sweep
+        # liveness: phi accrual over everything we hear from each peer,
+        # keyed by the address it listens on
+        self.fd = failure.PhiDetector(heartbeat, suspect, clock=self.now)
+        self.canon = {}    # conn -> listening address of whoever's there
+        self.suspects = {} # peers we've dropped for seeming dead
+        self.timer += self.check_peers
+        # reactors get data/oncedata payloads on a bounded worker
+        # pool, so a slow one can't stall the transport
+        self.pool = pool or event.Pool(inline=inline)
+        self.handlers = event.Event(self.pool)
+        self.event = self.handlers
         self.boot = bootstrap
         self.joincb = joincb
+        self.clocklock = threading.RLock()
         self.clock = None
+        self.causal = set(['newlm']) # message types that carry our clock
+        self.extra = {}    # msgtype -> (handler, topology?), from register()
+        self.dupes = {}    # msgtype -> handler for copies we've already seen, likewise
         self.testid = 0
+        # one MaekawaNode per lock key, made on first use and thrown
+        # away again once it's been idle a while; the default lock
+        # (key None) stays put
         self.mk = maekawa.MaekawaNode(self)
+        self.locks = {None: self.mk}
+        self.lockidle = heartbeat * 2
+        self.tree = tree # spanning-tree broadcasts, instead of flooding
+        self.lease = lease # how long a lock can be held before it's taken back
+        self.locklock = threading.Lock()
+        self.timer += self.reap_locks
+        self.codecs = list(codecs)
+        self.wire = {} # conn -> the codec we agreed on with whoever's there
+        self.streams = stream.Streams(self, heartbeat * 2)
+        if self.metrics.enabled:
+            self.gauges()
+
+    def newid(self):
+        if self.rng:
+            return self.rng.getrandbits(128)
+        return uuid.uuid4().int
+
+    def gauges(self):
+        '''
+        Things the metrics look up only when they're asked for.
+        '''
+        m = self.metrics
+        def dedup():
+            c = m.counters
+            hits, misses = c.get('dedup.hits', 0), c.get('dedup.misses', 0)
+            return {'hits': hits, 'misses': misses,
+                    'rate': hits / float(hits + misses) if hits + misses else None}
+        m.gauge('dedup', dedup)
+        m.gauge('peers', lambda: len(self.peers))
+        m.gauge('suspects', lambda: len(self.suspects))
+        m.gauge('lace', lambda: {'value': self.value, 'lace_max': self.lace_max})
+        m.gauge('queues', self.queues)
+        m.gauge('pool', self.pool.stats)
+        m.gauge('locks', lambda: len(self.locks))
+
+    def queues(self):
+        '''
+        How many connections we've got, and how many frames are
+        waiting to go out on them, all told and on the worst one.
+        '''
+        conns = set(c for c in self.conns.conns.values() if not c.closed)
+        depths = [c.depth() for c in conns]
+        return {'connections': len(conns), 'queued': sum(depths),
+                'deepest': max(depths) if depths else 0}
 
     def base(self):
         self.value = self.lace_max = (1, 1)
         self.clock = itc.Stamp()
 
-    def addpeer(self, pid, contact):
-        pl = self.peers.get(pid, {'contact': None, 'value': (0, 0)})
-        pl['contact'] = contact
-        self.peers[pid] = pl
+    def addpeer(self, pid, addr):
+        self.setpeer(pid, addr=tuple(addr))
+
+    def setpeer(self, pid, **kwargs):
+        '''
+        self.peers is copy-on-write: readers just grab the current
+        dict and iterate it without locking, and writers swap in a
+        new one.
+        '''
+        with self.plock:
+            peers = dict(self.peers)
+            pl = dict(peers.get(pid, {'addr': None, 'value': (0, 0)}))
+            pl.update(kwargs)
+            peers[pid] = pl
+            self.peers = peers
+        if pl['addr'] and pl['addr'] not in self.fd.last:
+            self.fd.heartbeat(pl['addr']) # start the clock on them
+
+    def delpeers(self, pids):
+        with self.plock:
+            peers = dict(self.peers)
+            for pid in pids:
+                peers.pop(pid, None)
+            self.peers = peers
 
     def dumpstamp(self, stamp):
         return base64.b64encode(stamp.dump())
@@ -65,37 +188,106 @@ class Broadcaster(object):
 
     def stop(self):
         with self.lock:
-            for p in self.peers.values():
-                self.bye(p)
             self.timer.disable()
+            self.conns.close()
             self.tcp.shutdown()
 
+    # messages that can open a new connection, and so offer codecs
+    greetings = ('hello', 'welcome', 'needpeer', 'newpeer')
+
+    @property
+    def clock(self):
+        return self._clock
+
+    @clock.setter
+    def clock(self, stamp):
+        with self.clocklock:
+            self._clock = stamp
+            self.clockdump = None
+
+    def dumpclock(self):
+        '''
+        A peek at our clock, dumped.  It only changes on joins and
+        ticks, so it's dumped once per change, not once per message.
+        '''
+        with self.clocklock:
+            if self.clockdump is None and self._clock:
+                self.clockdump = self.dumpstamp(self._clock.peek())
+            return self.clockdump
+
     def mkmsg(self, msgtype='noop'):
-        msg = {}
+        '''
+        A new message.  Only the types in self.causal, whose handlers
+        need to know what we'd seen when we sent them, get our clock.
+        '''
+        msg = codec.Envelope()
         msg['type'] = msgtype
         msg['id'] = (self.uuid, self.value)
-        msg['stamp'] = uuid.uuid4().int
+        msg['stamp'] = self.newid()
         msg['srvport'] = self.tcp.port
-        if self.clock:
-            msg['clock'] = self.dumpstamp(self.clock.peek())
+        if msgtype in self.causal and self.clock:
+            msg['clock'] = self.dumpclock()
+        if msgtype in self.greetings:
+            msg['codecs'] = self.codecs
         return msg
 
+    def encode(self, msg, conn):
+        if not isinstance(msg, codec.Envelope):
+            msg = codec.Envelope(msg)
+        return msg.encode(self.wire.get(conn, codec.codecs['json']))
+
+    # strings longer than this go out as streams rather than one message
+    STREAM = 1024 * 1024
+
     def send(self, data):
+        '''
+        Send data to every node.  A file (anything with a read()) is
+        streamed, and reactors get it as a stream; see Streams.  So
+        is a string longer than STREAM, but that's put back together
+        and handed over as if it had come in one message.
+        '''
+        big = self.streamable(data)
+        if big:
+            return self.send_stream(*big)
         msg = self.mkmsg()
         msg['data'] = data
         msg['type'] = 'data'
-        self.broadcast(msg)
+        self.relay(msg)
 
     def send_one(self, data):
+        '''
+        Send data to one random peer, streaming it like send() does.
+        '''
+        dst = None
+        peers = self.peers
+        if len(peers) > 0:
+            dst = (self.rng or random).choice(peers.keys())
+        if not dst:
+            return
+        big = self.streamable(data)
+        if big:
+            return self.send_stream(*big, peer=dst)
         msg = self.mkmsg()
         msg['data'] = data
         msg['type'] = 'oncedata'
-        dst = None
-        with self.lock:
-            if len(self.peers) > 0:
-                dst = random.choice(self.peers.keys())
-        if dst:
-            self.sendmsg(msg, dst)
+        self.sendmsg(msg, dst)
+
+    def streamable(self, data):
+        # (src, info) for send_stream, if data ought to be streamed
+        if hasattr(data, 'read'):
+            return data, None
+        if isinstance(data, basestring) and len(data) > self.STREAM:
+            return json.dumps(data), {'data': 'json'}
+        return None
+
+    def send_stream(self, src, info=None, peer=None):
+        '''
+        Stream src (a string or file) to every node, or just to peer,
+        in chunks that don't hold up anything else.  info goes along
+        with it for the reactors.  Returns a Future that's done once
+        it's all been queued.
+        '''
+        return self.streams.send(src, info, peer)
 
     def bootstrap(self, plist):
         msg = self.mkmsg('hello')
@@ -105,38 +297,162 @@ class Broadcaster(object):
     def handle_tcp_msg(self, msg, conn):
         self.handle_msg(msg, conn)
 
+    def handle_disconnect(self, conn, addr):
+        self.wire.pop(conn, None)
+        self.canon.pop(conn, None)
+
+    def check_peers(self):
+        '''
+        Runs every heartbeat: drop peers that look dead, and poke the
+        ones we haven't sent anything to lately so they know we're
+        not.
+        '''
+        now = self.now()
+        dead = []
+        for pid, pl in self.peers.items():
+            if self.fd.suspected(pl['addr'], now):
+                dead.append(pid)
+                continue
+            c = self.conns.peek(pl['addr'])
+            if c is None or now - c.lastsent > self.timer.interval / 2.0:
+                self.sendmsg(self.mkmsg('heartbeat'), pid)
+        if dead:
+            self.stateq.submit(self.drop_suspects, dead)
+
+    def drop_suspects(self, pids):
+        peers = self.peers
+        pids = [p for p in pids if p in peers]
+        for pid in pids:
+            self.suspects[pid] = peers[pid]
+        self.delpeers(pids)
+        for mk in self.locks.values():
+            for pid in pids:
+                mk.forget(pid)
+
+    def restore_suspects(self, addr):
+        for pid, pl in self.suspects.items():
+            if pl['addr'] == addr:
+                del self.suspects[pid]
+                if self.ispeer(pl['value']) and pid not in self.peers:
+                    self.setpeer(pid, **pl)
+
+    def alive(self, conn):
+        '''
+        We heard something on conn.  Feed it to the failure detector
+        under the listening address of whoever's on the other end.
+        '''
+        key = self.canon.get(conn, None)
+        if not key:
+            return
+        self.fd.heartbeat(key)
+        if self.suspects:
+            self.stateq.submit(self.restore_suspects, key)
+
+    # handlers that change our place in the lace; these all run, in
+    # order, on self.stateq, so they never race each other
+    topology = ('hello', 'welcome', 'needpeer', 'newpeer', 'newlm', 'recon')
+
     def handle_msg(self, msg, conn):
         '''
-        msg is a json-encoded message
+        msg is an encoded message, in whatever codec the sender used
+
+        Nothing in here takes a lock: decoding and dedup happen on
+        the calling connection's thread, handlers that touch the
+        topology get queued on self.stateq, and everything else runs
+        right here.
         '''
         if conn:
             addr = conn.getpeername()
         else:
             addr = (0, 0)
-        if not addr in self.clist and not addr == (0, 0):
-            self.clist[addr] = conn
-        with self.lock:
-            msg = json.loads(msg)
-            if msg['stamp'] in self.seen:
-                return
-            self.seen += msg['stamp']
-            src = msg.get('src', None) or addr
-            src = src[0], src[1]
-            if not msg.get('src', None):
-                msg['src'] = src
-            addr = tuple(msg['src'])
-            def reply(data):
-                rmsg = self.mkmsg()
-                rmsg['type'] = 'oncedata'
-                rmsg['data'] = data
-                self.sendmsg(rmsg, msg['id'])
+        if conn:
+            self.conns.add(addr, conn)
+            self.alive(conn)
+        size = len(msg)
+        stamp = codec.peek(msg)
+        if stamp is not None and stamp in self.seen \
+                and codec.peektype(msg) not in self.dupes:
+            # a duplicate; don't bother decoding the rest
+            self.duplicate(conn, addr, size)
+            return
+        msg = codec.Envelope.decode(msg)
+        msg.conn = conn
+        if not self.seen.add(msg['stamp']):
+            self.duplicate(conn, addr, size)
+            dupe = self.dupes.get(msg['type'], None)
+            if dupe is not None:
+                dupe(msg)
+            return
+        self.metrics.count('dedup.misses')
+        self.metrics.traffic('in', msg['type'], self.canon.get(conn, None) or addr, size)
+        src = msg.get('src', None) or addr
+        src = src[0], src[1]
+        if not msg.get('src', None):
+            msg['src'] = src
+            if conn:
+                # straight from the source, not relayed, so this is
+                # also the connection to wherever they listen
+                self.conns.add((addr[0], msg['srvport']), conn)
+                self.canon[conn] = (addr[0], msg['srvport'])
+                if 'codecs' in msg:
+                    self.wire[conn] = codec.negotiate(msg['codecs'], self.codecs)
+        addr = tuple(msg['src'])
+        def reply(data):
+            rmsg = self.mkmsg()
+            rmsg['type'] = 'oncedata'
+            rmsg['data'] = data
+            self.sendmsg(rmsg, msg['id'][0])
+        handler, topo = self.extra.get(msg['type'], (None, False))
+        if handler is None:
             try:
                 handler = getattr(self, "handle_msg_%s"%msg['type'])
             except AttributeError:
-                print "no such handler"
+                self.metrics.count('unhandled')
                 return
+        if self.metrics.enabled:
+            handler = self.metrics.timed('handler.' + msg['type'], handler)
+        if topo or msg['type'] in self.topology:
+            self.stateq.submit(handler, msg, addr, reply)
+        else:
             handler(msg, addr, reply)
 
+    def duplicate(self, conn, addr, size):
+        self.metrics.count('dedup.hits')
+        self.metrics.traffic('in', 'duplicate', self.canon.get(conn, None) or addr, size)
+
+    def register(self, msgtype, handler, topology=False, causal=False,
+                 duplicates=None):
+        '''
+        Have handler(msg, addr, reply) handle messages of type msgtype,
+        for whatever's layered on top of us.  Handlers that touch the
+        topology (or just need to run one at a time) can ask to be run
+        on self.stateq with the built-in ones, and ones that need the
+        sender's clock in msg['clock'] can ask for causal.  Copies of
+        a message we've already had are dropped, unless duplicates is
+        given, in which case it gets called with them, decoded.
+        '''
+        self.extra[msgtype] = (handler, topology)
+        if causal:
+            self.causal.add(msgtype)
+        if duplicates is not None:
+            self.dupes[msgtype] = duplicates
+
+    def tick(self):
+        '''
+        Count an event on our clock, and return a peek at it.
+        '''
+        with self.clocklock:
+            self.clock.event()
+            self.clockdump = None
+            return self.clock.peek()
+
+    def witness(self, stamp):
+        '''
+        Fold someone else's clock into ours.
+        '''
+        with self.clocklock:
+            self.clock = self.clock + stamp
+
     def get_next_addr(self, addr):
         '''
         So the way we fill out the lace is:
@@ -171,55 +487,140 @@ class Broadcaster(object):
             return True
         return False
 
-    def acquire(self, acqcb=None):
-        with self.lock:
-            self.mk.acquire(acqcb)
+    def lock_for(self, key):
+        '''
+        The MaekawaNode for lock key, made if there isn't one yet.
+        '''
+        with self.locklock:
+            mk = self.locks.get(key, None)
+            if mk is None:
+                mk = self.locks[key] = maekawa.MaekawaNode(self, key)
+            mk.touched = self.now() # so reap_locks leaves it be
+            return mk
+
+    def reap_locks(self):
+        now = self.now()
+        with self.locklock:
+            old = [(key, mk) for key, mk in self.locks.items()
+                   if key is not None and now - mk.touched > self.lockidle]
+        # not idle() under locklock: lock_for() gets called with a
+        # lock's own lock held, so that'd be the wrong way round
+        for key, mk in old:
+            if mk.idle():
+                with self.locklock:
+                    if self.locks.get(key, None) is mk and now - mk.touched > self.lockidle:
+                        del self.locks[key]
+
+    def acquire(self, acqcb=None, key=None, timeout=None, lease=None):
+        '''
+        Start acquiring lock key.  Returns a Future; see
+        MaekawaNode.acquire.
+        '''
+        return self.lock_for(key).acquire(acqcb, timeout, lease)
 
-    def release(self):
-        with self.lock:
-            self.mk.release()
+    def release(self, key=None):
+        self.lock_for(key).release()
+
+    def lockstats(self):
+        '''
+        Timings for recent acquisitions of every lock we know of.
+        '''
+        return [s for mk in self.locks.values() for s in list(mk.history)]
 
     class mutob(object):
-        def __init__(self, bc):
+        def __init__(self, bc, key=None, timeout=30):
             self.bc = bc
-            self.ev = threading.Event()
+            self.key = key
+            self.timeout = timeout
 
         def __enter__(self):
-            self.bc.acquire(self.ev.set)
-            a = self.ev.wait(2)
-            if not a:
-                print "fail on", self.bc.uuid % 997
-                print len(self.bc.mk.fails), len(self.bc.mk.grants), len(self.bc.mk.grantset), self.bc.mk.mutexed
-                raise RuntimeError("deadlock")
+            # raises event.Timeout if we can't get it in time
+            return self.bc.acquire(key=self.key, timeout=self.timeout).result()
 
         def __exit__(self, type, value, traceback):
-            self.bc.release()
+            self.bc.release(self.key)
 
-    def mutex(self):
-        return self.mutob(self)
+    def mutex(self, key=None, timeout=30):
+        '''
+        A distributed lock, for use in a with statement.  Locks with
+        different keys are independent of each other.
+        '''
+        return self.mutob(self, key, timeout)
 
     def bumptid(self):
         self.testid += 1
         m = self.mkmsg('bumptid')
         m['testid'] = self.testid
-        self.broadcast(m)
+        self.relay(m)
+
+    def handle_msg_data(self, msg, addr, reply):
+        self.relay(msg)
+        if msg['id'][0] != self.uuid:
+            self.handlers.poolfire(msg['data'], reply=reply, msg=msg)
+
+    def handle_msg_oncedata(self, msg, addr, reply):
+        self.handlers.poolfire(msg['data'], reply=reply, msg=msg)
 
     def handle_msg_bumptid(self, msg, addr, reply):
-        self.broadcast(msg)
+        self.relay(msg)
         self.testid = msg['testid']
 
+    def handle_msg_heartbeat(self, msg, addr, reply):
+        pass # hearing it was the point
+
     def handle_msg_maekawa(self, msg, addr, reply):
-        self.mk.handle_msg(msg)
+        self.handle_ops([msg], msg['id'][0])
+
+    def handle_msg_mkbatch(self, msg, addr, reply):
+        self.handle_ops(msg['ops'], msg['id'][0])
+
+    def handle_ops(self, ops, sender):
+        # every op in a frame is one step, so all the replies to it
+        # get batched together.  The locks they're for stay held till
+        # the replies are queued on their connections, so no other
+        # thread can get something for the same lock out first (see
+        # Outbox); and they're taken in one order, so two frames for
+        # the same locks can't deadlock over them
+        mks = {}
+        for op in ops:
+            key = op.get('key', None)
+            if repr(key) not in mks:
+                mks[repr(key)] = self.lock_for(key)
+        held = [mks[k] for k in sorted(mks)]
+        for mk in held:
+            mk.lock.acquire()
+        try:
+            out = maekawa.Outbox(self)
+            for op in ops:
+                mks[repr(op.get('key', None))].handle_op(op, sender, out)
+            out.flush()
+        finally:
+            for mk in reversed(held):
+                mk.lock.release()
+
+    def sendops(self, ops, peerid, peers=None):
+        '''
+        Send a peer some Maekawa messages: as a plain 'maekawa'
+        message if there's just the one, else as an 'mkbatch'.
+        '''
+        if len(ops) == 1:
+            msg = self.mkmsg('maekawa')
+            msg.update(ops[0])
+        else:
+            msg = self.mkmsg('mkbatch')
+            msg['ops'] = ops
+        self.sendmsg(msg, peerid, peers)
 
     def handle_msg_newlm(self, msg, addr, reply):
         '''
         Handle 'newlm' message, bumping the lace_max
         '''
-        self.broadcast(msg)
+        self.relay(msg)
         oclock = self.loadstamp(msg['clock'])
-        if self.clock <= oclock:
-            self.lace_max = tuple(msg['newlm'])
-            self.clock = self.clock + oclock
+        with self.clocklock:
+            if self.clock <= oclock:
+                self.lace_max = tuple(msg['newlm'])
+                self.clock = self.clock + oclock
 
     def handle_msg_recon(self, msg, addr, reply):
         '''
@@ -234,7 +635,7 @@ class Broadcaster(object):
         '''
 	    Handle the 'needpeer' message.  addr is seeking peers.
         '''
-        self.broadcast(msg)
+        self.relay(msg)
         if not self.ispeer(msg['id'][1]):
             # not a concern of ours
             return
@@ -242,16 +643,14 @@ class Broadcaster(object):
             # someone got handed our id
             nmsg = self.mkmsg()
             nmsg['type'] = 'recon'
-            self.sendmsg(nmsg, addr)
+            self.sendmsg_raw(nmsg, (addr[0], msg['srvport']))
             return
         pid = msg['id'][0]
-        if not addr in self.clist:
-            conn = self.tcp.connect(addr)
-            if not conn:
-                conn = self.tcp.connect((addr[0], msg['srvport']))
-            self.clist[addr] = conn
-        self.addpeer(pid, self.clist[addr])
-        self.peers[msg['id'][0]]['value'] = msg['id'][1]
+        paddr = (addr[0], msg['srvport'])
+        conn = self.conns.get(paddr)
+        if conn and conn not in self.wire and 'codecs' in msg:
+            self.wire[conn] = codec.negotiate(msg['codecs'], self.codecs)
+        self.setpeer(pid, addr=paddr, value=msg['id'][1])
         nmsg = self.mkmsg()
         nmsg['type'] = 'newpeer'
         nmsg['newlm'] = self.lace_max
@@ -264,20 +663,20 @@ class Broadcaster(object):
         if not self.ispeer(msg['id'][1]):
             # something's broke
             return
-        self.addpeer(msg['id'][0], self.clist[addr])
-        self.peers[msg['id'][0]]['value'] = msg['id'][1]
+        self.setpeer(msg['id'][0], addr=(addr[0], msg['srvport']), value=msg['id'][1])
         self.lace_max = tuple(msg['newlm'])
         # clean house
         rem = []
-        for a in self.peers:
-            if not self.ispeer(self.peers[a]['value']):
+        peers = self.peers
+        for a in peers:
+            if not self.ispeer(peers[a]['value']):
                 rem.append(a)
-        for r in rem:
-            del self.peers[r]
+        self.delpeers(rem)
 
     def handle_msg_welcome(self, msg, addr, reply):
         if self.value != (0, 0):
-            print "what"
+            # we've already got a place; a second welcome is stale
+            self.metrics.count('welcome.ignored')
             return
         # we are new
         self.value = tuple(msg['value'])
@@ -286,11 +685,10 @@ class Broadcaster(object):
             return
         self.clock = self.loadstamp(msg['itc'])
         # add whoever we're talking to as a temporary peer
-        self.addpeer(msg['id'][0], self.clist[addr])
-        self.peers[msg['id'][0]]['value'] = msg['id'][1]
+        self.setpeer(msg['id'][0], addr=(addr[0], msg['srvport']), value=msg['id'][1])
         nmsg = self.mkmsg()
         nmsg['type'] = 'needpeer'
-        self.broadcast(nmsg)
+        self.relay(nmsg)
 
     def handle_msg_hello(self, msg, addr, reply):
         # we are being greeted
@@ -298,42 +696,131 @@ class Broadcaster(object):
         nmsg['type'] = 'welcome'
         nlm = self.get_next_addr(self.lace_max)
         nmsg['value'] = nlm
-        a, b = self.clock.fork()
-        self.clock = a
+        with self.clocklock:
+            a, b = self.clock.fork()
+            self.clock = a
         nmsg['itc'] = self.dumpstamp(b)
         self.sendmsg_raw(nmsg, addr)
         # bump lace_max site-wide
         # XXX this is broken right now
         self.lace_max = nlm
-        self.clock.event()
+        self.tick()
         bmsg = self.mkmsg('newlm')
         bmsg['newlm'] = self.lace_max
-        self.broadcast(bmsg)
+        self.relay(bmsg)
 
-    def broadcast(self, msg):
-        with self.lock:
-            for peer in self.peers:
-                self.sendmsg(msg, peer)
-            self.sendmsg(msg, self.uuid) # sigh
+    def relay(self, msg):
+        '''
+        Start a message on its way to the whole network, or pass on
+        one that's on its way.
+
+        Messages we start go along a spanning tree of the lace, if we
+        can: origin (x0, y0) sends to its row and its column, every
+        node (x, y0) in the row forwards down column x, and every node
+        (x0, y) in the column forwards along row y to whoever's at an
+        (x, y) where (x, y0) hasn't been filled, and so has nobody to
+        forward down that column.  The fill order guarantees
+        (x0, y) is there whenever such an (x, y) is, so everyone gets
+        the message exactly once.
+
+        Anyone on the tree who's missing a node it should forward to,
+        or suspects one of them is dead, floods the message to all
+        its peers instead, as does everyone who gets it after that.
+        '''
+        peers = self.peers
+        for pid in self.targets(msg, peers):
+            self.sendmsg(msg, pid, peers)
+
+    def targets(self, msg, peers):
+        '''
+        Whoever relay() would send msg to, out of peers.  Marks msg as
+        going along the tree, or takes that back, to match.
+        '''
+        if self.tree and msg['id'][0] == self.uuid and 'tree' not in msg \
+                and self.value != (0, 0):
+            msg['tree'] = self.value
+        if 'tree' in msg:
+            kids = self.treekids(tuple(msg['tree']), peers)
+            if kids is not None:
+                return kids
+            del msg['tree'] # a hole in the tree; flood it
+        return list(peers)
+
+    def treekids(self, origin, peers):
+        '''
+        Whoever we forward to on origin's tree, or None if any of them
+        are missing or look dead (suspected, or backing off after we
+        couldn't connect).  One we just don't happen to have a
+        connection to yet, or any more since it went idle, gets one
+        opened, and the message waits on it.
+        '''
+        x, y = self.value
+        x0, y0 = origin
+        last = fillindex(self.lace_max)
+        if last < max(fillindex(self.value), fillindex(origin), 1):
+            # we're new, and don't know how big the lace is yet
+            return None
+        def there(v):
+            return fillindex(v) <= last
+        if (x, y) == (x0, y0):
+            mine = lambda v: v[0] == x or v[1] == y
+        elif y == y0:
+            mine = lambda v: v[0] == x and v[1] != y0
+        elif x == x0:
+            mine = lambda v: v[1] == y and v[0] != x0 and not there((v[0], y0))
+        else:
+            return []
+        n = max(self.lace_max)
+        want = set(v for v in ([(x, j) for j in xrange(1, n + 1)] +
+                               [(i, y) for i in xrange(1, n + 1)])
+                   if v != (x, y) and mine(v) and there(v))
+        kids = []
+        for pid, pl in peers.iteritems():
+            v = tuple(pl.get('value', ()))
+            if len(v) != 2 or not mine(v):
+                continue
+            if not pl['addr']:
+                return None
+            c = self.conns.get(pl['addr'])
+            if c is None or c.closed or self.fd.suspected(pl['addr']):
+                return None
+            want.discard(v)
+            kids.append(pid)
+        if want:
+            return None
+        return kids
+
+    def broadcast(self, msg, peers=None):
+        '''
+        Send msg to every peer in peers (a snapshot of self.peers,
+        unless told otherwise).
+        '''
+        if peers is None:
+            peers = self.peers
+        for peer in peers:
+            self.sendmsg(msg, peer, peers)
 
-    def sendmsg(self, msg, peerid):
+    def sendmsg(self, msg, peerid, peers=None):
         if self.uuid == peerid:
-            if msg['type'] == 'maekawa':
-                msg['stamp'] = uuid.uuid4().int # newstamp
-                self.handle_msg(json.dumps(msg), None)
             return
         self.seen += msg['stamp']
-        msg = json.dumps(msg)
-        ct = self.peers[peerid]['contact']
-        if ct:
-            self.tcp.send(msg, ct)
+        pl = (peers or self.peers).get(peerid, None)
+        if pl and pl['addr']:
+            self.sendmsg_raw(msg, pl['addr'])
 
     def sendmsg_raw(self, msg, addr):
         self.seen += msg['stamp']
-        msg = json.dumps(msg)
-        if not addr in self.clist:
-            c = self.tcp.connect(addr)
-            self.clist[addr] = c
-        else:
-            c = self.clist[addr]
-        self.tcp.send(msg, c)
+        c = self.conns.get(addr)
+        if c:
+            self.canon.setdefault(c, tuple(addr))
+            self.sendmsg_conn(msg, c, addr)
+
+    def sendmsg_conn(self, msg, conn, addr=None):
+        '''
+        Send msg down conn, to whoever's at the other end of it.
+        '''
+        self.seen += msg['stamp']
+        addr = addr or self.canon.get(conn, None)
+        data = self.encode(msg, conn)
+        self.metrics.traffic('out', msg['type'], addr and tuple(addr), len(data))
+        self.tcp.send(data, conn, msg['type'] == 'chunk')
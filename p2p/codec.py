@@ -0,0 +1,249 @@
+import json
+import socket
+import struct
+import base64
+
+class JSONCodec(object):
+    '''
+    The original wire format: the message dict, json-encoded.
+    '''
+    name = 'json'
+
+    def encode(self, msg):
+        if 'blob' in msg:
+            # raw bytes don't go in json
+            msg = dict(msg)
+            msg['blob64'] = base64.b64encode(msg.pop('blob'))
+        return json.dumps(msg)
+
+    def decode(self, data):
+        msg = json.loads(data)
+        if 'blob64' in msg:
+            msg['blob'] = base64.b64decode(msg.pop('blob64'))
+        return msg
+
+class BinaryCodec(object):
+    '''
+    A compact binary wire format.
+
+    Every message starts with a fixed-width header holding the fields
+    that every message carries:
+
+        magic    B    0xb1
+        type     B    index into TYPES, 0 if the type isn't listed
+        flags    B    which optional fields follow
+        id       16s  node uuid
+        value    II   node lace coordinates
+        stamp    16s  dedup stamp
+        srvport  H
+
+    followed by the raw ITC clock bytes (length-prefixed) if there's
+    a clock, the relay source address if there is one, the raw blob
+    (length-prefixed) if there is one, and whatever else is in the
+    message as a length-prefixed json payload.
+
+    Decoding gives back exactly the dict the json codec would have,
+    and anything the header can't represent just falls back to json,
+    which decode() tells apart by the first byte.
+    '''
+    name = 'bin1'
+    MAGIC = '\xb1'
+    HEADER = struct.Struct("!cBB16sII16sH")
+    SRC = struct.Struct("!4sH")
+    STAMP = struct.calcsize("!cBB16sII") # where the stamp sits in HEADER
+
+    # append only; the index is what goes on the wire
+    TYPES = [None, 'noop', 'data', 'oncedata', 'hello', 'welcome',
+             'needpeer', 'newpeer', 'newlm', 'recon', 'maekawa',
+             'bumptid', 'heartbeat', 'mkbatch', 'kv',
+             'merkle', 'chunk', 'chunkack']
+    CODES = dict((t, i) for i, t in enumerate(TYPES) if t)
+    HEADERKEYS = frozenset(['type', 'id', 'stamp', 'srvport', 'clock', 'src',
+                            'blob'])
+
+    CLOCK = 0x01
+    SRC_ADDR = 0x02
+    BLOB = 0x04
+
+    def __init__(self):
+        self.json = JSONCodec()
+
+    @staticmethod
+    def packid(n):
+        return struct.pack("!QQ", n >> 64, n & 0xffffffffffffffff)
+
+    @staticmethod
+    def unpackid(s):
+        hi, lo = struct.unpack("!QQ", s)
+        return (hi << 64) | lo
+
+    def encode(self, msg):
+        try:
+            return self.pack(msg)
+        except (KeyError, TypeError, ValueError, struct.error, socket.error):
+            return self.json.encode(msg)
+
+    def pack(self, msg):
+        code = self.CODES.get(msg['type'], 0)
+        nid, value = msg['id']
+        flags = 0
+        tail = []
+        clock = msg.get('clock', None)
+        if clock:
+            flags |= self.CLOCK
+            raw = base64.b64decode(clock)
+            tail.append(struct.pack("!H", len(raw)))
+            tail.append(raw)
+        src = msg.get('src', None)
+        if src:
+            flags |= self.SRC_ADDR
+            tail.append(self.SRC.pack(socket.inet_aton(src[0]), src[1]))
+        blob = msg.get('blob', None)
+        if blob is not None:
+            flags |= self.BLOB
+            tail.append(struct.pack("!I", len(blob)))
+            tail.append(blob)
+        head = self.HEADER.pack(self.MAGIC, code, flags,
+                                self.packid(nid), value[0], value[1],
+                                self.packid(msg['stamp']), msg['srvport'])
+        rest = dict((k, v) for k, v in msg.iteritems() if k not in self.HEADERKEYS)
+        if not code:
+            rest['type'] = msg['type']
+        payload = json.dumps(rest) if rest else ""
+        tail.append(struct.pack("!I", len(payload)))
+        tail.append(payload)
+        return head + "".join(tail)
+
+    def peek(self, data):
+        '''
+        Just the dedup stamp, straight out of the header.
+        '''
+        return self.unpackid(data[self.STAMP:self.STAMP + 16])
+
+    def peektype(self, data):
+        code = ord(data[1])
+        return self.TYPES[code] if code < len(self.TYPES) else None
+
+    def decode(self, data):
+        if data[:1] != self.MAGIC:
+            return self.json.decode(data)
+        magic, code, flags, nid, vx, vy, stamp, srvport = \
+            self.HEADER.unpack_from(data)
+        off = self.HEADER.size
+        clock = None
+        if flags & self.CLOCK:
+            n = struct.unpack_from("!H", data, off)[0]
+            off += 2
+            clock = base64.b64encode(data[off:off + n])
+            off += n
+        src = None
+        if flags & self.SRC_ADDR:
+            ip, port = self.SRC.unpack_from(data, off)
+            off += self.SRC.size
+            src = [socket.inet_ntoa(ip), port]
+        blob = None
+        if flags & self.BLOB:
+            n = struct.unpack_from("!I", data, off)[0]
+            off += 4
+            blob = data[off:off + n]
+            off += n
+        n = struct.unpack_from("!I", data, off)[0]
+        off += 4
+        msg = json.loads(data[off:off + n]) if n else {}
+        if code:
+            msg['type'] = self.TYPES[code]
+        msg['id'] = [self.unpackid(nid), [vx, vy]]
+        msg['stamp'] = self.unpackid(stamp)
+        msg['srvport'] = srvport
+        if clock is not None:
+            msg['clock'] = clock
+        if src is not None:
+            msg['src'] = src
+        if blob is not None:
+            msg['blob'] = blob
+        return msg
+
+class Envelope(dict):
+    '''
+    A message dict that remembers how it looks on the wire.
+
+    Each codec's encoding is made at most once and then shared by
+    every connection that speaks it, and a message that came in off
+    the wire keeps the bytes it arrived as, so relaying it doesn't
+    encode anything at all.  Changing the message throws the cached
+    encodings away.
+    '''
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.wire = {}
+        self.conn = None # the connection it came in on, if it did
+
+    @classmethod
+    def decode(cls, data):
+        c = codecs['bin1'] if data[:1] == BinaryCodec.MAGIC else codecs['json']
+        env = cls(c.decode(data))
+        env.wire[c.name] = data
+        return env
+
+    def encode(self, c):
+        data = self.wire.get(c.name)
+        if data is None:
+            data = self.wire[c.name] = c.encode(self)
+        return data
+
+    def __setitem__(self, key, value):
+        self.wire.clear()
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self.wire.clear()
+        dict.__delitem__(self, key)
+
+    def update(self, *args, **kwargs):
+        self.wire.clear()
+        dict.update(self, *args, **kwargs)
+
+    def pop(self, *args):
+        self.wire.clear()
+        return dict.pop(self, *args)
+
+codecs = {}
+for c in (BinaryCodec(), JSONCodec()):
+    codecs[c.name] = c
+
+# in order of preference
+PREFERENCE = ['bin1', 'json']
+
+def decode(data):
+    '''
+    Decode a message in whichever format it arrived in.
+    '''
+    return codecs['bin1'].decode(data)
+
+def peek(data):
+    '''
+    The dedup stamp of an encoded message, if it can be had without
+    decoding the whole thing; None otherwise.
+    '''
+    if data[:1] == BinaryCodec.MAGIC:
+        return codecs['bin1'].peek(data)
+    return None
+
+def peektype(data):
+    '''
+    The type of an encoded message, the same way as peek(); None if
+    it can't be had that cheaply.
+    '''
+    if data[:1] == BinaryCodec.MAGIC:
+        return codecs['bin1'].peektype(data)
+    return None
+
+def negotiate(offered, ours=PREFERENCE):
+    '''
+    Pick the codec to talk to a peer that offered the given names.
+    JSON is always the fallback, since everyone speaks it.
+    '''
+    for name in ours:
+        if name in offered and name in codecs:
+            return codecs[name]
+    return codecs['json']
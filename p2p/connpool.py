@@ -0,0 +1,102 @@
+import time
+import threading
+
+class ConnPool(object):
+    '''
+    Owns every connection a node has, keyed by address.
+
+    There's one connection per peer, whichever side opened it: an
+    inbound connection can be aliased to the address the peer listens
+    on, and then it's the one we send on too.  Connecting never
+    blocks the caller (frames queue on the Conn until it's up), dead
+    connections are forgotten as soon as the transport notices, idle
+    ones are closed by sweep(), and an address that won't take a
+    connection is left alone for an exponentially growing while
+    before we try it again.
+    '''
+    def __init__(self, tcp, idle=300, timeout=5, backoff=1, maxbackoff=60,
+                 clock=time.time):
+        self.tcp = tcp
+        self.clock = clock
+        self.idle = idle
+        self.timeout = timeout
+        self.backoff = backoff
+        self.maxbackoff = maxbackoff
+        self.conns = {}   # addr -> Conn
+        self.retry = {}   # addr -> (when we can try again, next delay)
+        self.lock = threading.Lock()
+        tcp.disconnected += self.handle_disconnect
+
+    def add(self, addr, conn):
+        '''
+        File conn under addr, replacing anything dead that was there.
+        '''
+        addr = tuple(addr)
+        with self.lock:
+            old = self.conns.get(addr, None)
+            if old is conn:
+                return
+            if old is None or old.closed:
+                self.conns[addr] = conn
+                self.retry.pop(addr, None)
+
+    def get(self, addr):
+        '''
+        A connection to addr, opening one if need be.  Returns None,
+        without waiting, if addr is still backing off after failing.
+        '''
+        addr = tuple(addr)
+        now = self.clock()
+        with self.lock:
+            conn = self.conns.get(addr, None)
+            if conn and not conn.closed:
+                return conn
+            r = self.retry.get(addr, None)
+            if r and r[0] > now:
+                return None
+            conn = self.tcp.connect_async(addr, self.timeout)
+            self.conns[addr] = conn
+            return conn
+
+    def peek(self, addr):
+        '''
+        Whatever connection we have to addr, without opening one.
+        '''
+        return self.conns.get(tuple(addr), None)
+
+    def alive(self, addr):
+        conn = self.conns.get(tuple(addr), None)
+        return conn is not None and not conn.closed and not conn.connecting
+
+    def handle_disconnect(self, conn, addr):
+        now = self.clock()
+        with self.lock:
+            for a in [a for a, c in self.conns.iteritems() if c is conn]:
+                del self.conns[a]
+                if conn.established:
+                    self.retry.pop(a, None)
+                    continue
+                # never got through; back off
+                delay = self.retry.get(a, (0, self.backoff))[1]
+                self.retry[a] = (now + delay, min(delay * 2, self.maxbackoff))
+
+    def sweep(self):
+        '''
+        Close connections nothing has gone over in self.idle seconds,
+        and forget backoffs long since expired.
+        '''
+        now = self.clock()
+        with self.lock:
+            idle = [c for c in self.conns.itervalues()
+                    if not c.connecting and now - c.last > self.idle]
+            for a in [a for a, r in self.retry.iteritems()
+                      if now - r[0] > self.maxbackoff]:
+                del self.retry[a]
+        for c in set(idle):
+            self.tcp.drop(c)
+
+    def close(self):
+        with self.lock:
+            conns = set(self.conns.values())
+        for c in conns:
+            self.tcp.drop(c)
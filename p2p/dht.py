@@ -1,73 +1,679 @@
-import json
 import hashlib
 import random
 import threading
 import uuid
 import time
+import bisect
+import binascii
+import collections
 
 import udp
 import timer
 import event
 
+class Contact(object):
+    '''
+    Another node, as far as routing goes.
+    '''
+    __slots__ = ('id', 'addr', 'last', 'fails')
+
+    def __init__(self, nid, addr):
+        self.id = nid
+        self.addr = addr
+        self.last = time.time()
+        self.fails = 0
+
+class KBucket(object):
+    '''
+    Up to k contacts with ids in [lo, hi), least recently seen first,
+    plus a cache of up to k more that turned up while it was full, to
+    take the place of any that die.
+    '''
+    def __init__(self, lo, hi, k):
+        self.lo = lo
+        self.hi = hi
+        self.k = k
+        self.contacts = collections.OrderedDict() # id -> Contact
+        self.spares = collections.OrderedDict()   # id -> Contact, newest last
+        self.touched = time.time() # last looked up in, for refreshes
+
+    def __contains__(self, nid):
+        return self.lo <= nid < self.hi
+
+    def full(self):
+        return len(self.contacts) >= self.k
+
+    def oldest(self):
+        return next(self.contacts.itervalues())
+
+    def split(self):
+        mid = (self.lo + self.hi) // 2
+        a, b = KBucket(self.lo, mid, self.k), KBucket(mid, self.hi, self.k)
+        for c in self.contacts.itervalues():
+            (a if c.id < mid else b).contacts[c.id] = c
+        for c in self.spares.itervalues():
+            s = a if c.id < mid else b
+            if len(s.contacts) < s.k:
+                s.contacts[c.id] = c
+            else:
+                s.spares[c.id] = c
+        a.touched = b.touched = self.touched
+        return a, b
+
+class RoutingTable(object):
+    '''
+    Kademlia's routing table: the id space cut into k-buckets, finer
+    and finer towards our own id.
+
+    Ids are plain ints and distance is a ^ b.  The buckets are kept in
+    id order, so finding the one an id belongs in is a bisect.  A full
+    bucket that our own id falls in is split in two, and so (as in
+    section 4.2 of the paper, with b bits per hop) is one whose depth
+    isn't a multiple of b, so that lookups can fix b bits of the id
+    at a time and far-off parts of the id space get more than k
+    contacts.  Any other full bucket keeps the contacts it has (the
+    ones that have been up longest are the likeliest to stay up) and
+    parks newcomers in its replacement cache.  update() then hands back the bucket's oldest
+    contact, for the caller to ping and, if it doesn't answer, fail().
+
+    closest() doesn't look at every contact: buckets cover disjoint
+    runs of ids that share a prefix, so every id in one bucket is
+    nearer the target than every id in another, or every one further.
+    Sorting the buckets by the nearest any of their ids could be and
+    taking contacts from them in that order until there are k gets the
+    exact k closest.
+    '''
+    def __init__(self, myid, k=20, bits=160, b=5):
+        self.id = myid
+        self.k = k
+        self.bits = bits
+        self.b = b
+        self.buckets = [KBucket(0, 1 << bits, k)]
+        self.los = [0] # each bucket's lo, for bisecting
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return sum(len(b.contacts) for b in self.buckets)
+
+    def bucket(self, nid):
+        return self.buckets[bisect.bisect_right(self.los, nid) - 1]
+
+    def get(self, nid):
+        return self.bucket(nid).contacts.get(nid, None)
+
+    def contacts(self):
+        return [c for b in self.buckets for c in b.contacts.itervalues()]
+
+    def update(self, nid, addr):
+        '''
+        We heard from nid, at addr.  Returns None, or if its bucket is
+        full, the oldest contact in that bucket, which should be pinged
+        and failed if it doesn't answer.
+        '''
+        if nid == self.id:
+            return None
+        with self.lock:
+            while True:
+                b = self.bucket(nid)
+                c = b.contacts.pop(nid, None)
+                if c is not None or not b.full():
+                    if c is None:
+                        c = b.spares.pop(nid, None) or Contact(nid, addr)
+                    c.addr = addr
+                    c.last = time.time()
+                    c.fails = 0
+                    b.contacts[nid] = c
+                    return None
+                if b.hi - b.lo > 1 and (self.id in b or self.depth(b) % self.b):
+                    self.split(b)
+                    continue
+                c = b.spares.pop(nid, None) or Contact(nid, addr)
+                c.addr = addr
+                c.last = time.time()
+                b.spares[nid] = c
+                if len(b.spares) > b.k:
+                    b.spares.popitem(last=False)
+                return b.oldest()
+
+    def depth(self, b):
+        # how many leading bits every id in b shares
+        return self.bits + 1 - (b.hi - b.lo).bit_length()
+
+    def split(self, b):
+        i = self.buckets.index(b)
+        lo, hi = b.split()
+        self.buckets[i:i + 1] = [lo, hi]
+        self.los[i:i + 1] = [lo.lo, hi.lo]
+
+    def fail(self, nid, limit=1):
+        '''
+        nid didn't answer.  After limit such failures in a row it's
+        dropped, and the newest contact in the replacement cache takes
+        its place.  Returns True if it was dropped.
+        '''
+        with self.lock:
+            b = self.bucket(nid)
+            c = b.contacts.get(nid, None)
+            if c is None:
+                b.spares.pop(nid, None)
+                return False
+            c.fails += 1
+            if c.fails < limit:
+                return False
+            del b.contacts[nid]
+            if b.spares:
+                nid, c = b.spares.popitem()
+                b.contacts[nid] = c
+            return True
+
+    def remove(self, nid):
+        return self.fail(nid, 0)
+
+    def closest(self, target, k=None, exclude=()):
+        '''
+        The k contacts nearest target, nearest first.
+        '''
+        k = k or self.k
+        with self.lock:
+            order = []
+            for b in self.buckets:
+                if b.contacts:
+                    # the nearest anything in [lo, hi) can be to target
+                    order.append(((b.lo ^ target) & ~(b.hi - b.lo - 1), b))
+            order.sort(key=lambda o: o[0])
+            out = []
+            for near, b in order:
+                if len(out) >= k:
+                    break
+                out.extend(c for c in b.contacts.itervalues() if c.id not in exclude)
+        out.sort(key=lambda c: c.id ^ target)
+        return out[:k]
+
+    def touch(self, nid):
+        '''
+        We just looked up nid, so its bucket doesn't need refreshing.
+        '''
+        self.bucket(nid).touched = time.time()
+
+    def stale(self, age):
+        '''
+        A random id in each bucket that hasn't been looked up in for age
+        seconds, to look up so that the bucket gets refreshed.
+        '''
+        now = time.time()
+        return [random.randrange(b.lo, b.hi) for b in self.buckets
+                if now - b.touched > age]
+
+class Item(object):
+    __slots__ = ('value', 'size', 'expires', 'republish', 'own', 'cached')
+
+    def __init__(self, value, expires, republish, own, cached):
+        self.value = value
+        self.size = len(value) + ValueStore.OVERHEAD
+        self.expires = expires
+        self.republish = republish # when to send it out again, or None
+        self.own = own             # we put() it, so it's ours to keep alive
+        self.cached = cached       # a copy left along a lookup path
+
+class ValueStore(object):
+    '''
+    The values a DHT node holds: its share of the network's, copies
+    cached here by lookups that passed through, and whatever it put()
+    itself.
+
+    Everything has a time to live.  The store is an LRU capped at
+    limit bytes; when it's over, the least recently used values go
+    first, except our own, which only go when we stop republishing
+    them.
+
+    Nothing here has a timer per key.  Expiry and republish times are
+    filed in buckets slot seconds wide, and one sweep() now and then
+    deals with every bucket that's come due.  A key that's been moved
+    to a later time just stays behind in its old bucket, and gets
+    skipped when that bucket comes up.
+    '''
+    OVERHEAD = 128 # roughly what an entry costs besides its value
+
+    def __init__(self, limit=64 * 1024 * 1024, slot=60):
+        self.limit = limit
+        self.slot = slot
+        self.items = collections.OrderedDict() # key -> Item, least recently used first
+        self.size = 0
+        self.expiring = {}    # slot -> set of keys
+        self.republishing = {} # slot -> set of keys
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evicted': 0, 'expired': 0}
+
+    def __len__(self):
+        return len(self.items)
+
+    def file(self, buckets, kid, when):
+        buckets.setdefault(int(when // self.slot), set()).add(kid)
+
+    def put(self, kid, value, ttl, republish=None, own=False, cached=False):
+        '''
+        Hold value for ttl seconds, sending it out again every
+        republish seconds if there's a republish.  Storing a key again
+        puts off its republish, since whoever stored it just did that
+        for us.  A cached copy never replaces the real thing.
+        '''
+        now = time.time()
+        when = now + republish if republish else None
+        with self.lock:
+            old = self.items.get(kid, None)
+            if old is not None:
+                if cached and not old.cached and old.expires > now:
+                    return
+                if old.own and not own:
+                    # someone else stored it for us; we still keep it
+                    # alive, on the schedule we had
+                    own = True
+                    when = old.republish and max(old.republish, now)
+                self.drop(kid)
+            it = Item(value, now + ttl, when, own, cached)
+            self.items[kid] = it
+            self.size += it.size
+            self.file(self.expiring, kid, it.expires)
+            if it.republish is not None:
+                self.file(self.republishing, kid, it.republish)
+            self.evict()
+
+    def evict(self):
+        '''
+        Drop least recently used values till we're under the limit.
+        Our own are moved to the back as we pass them, so the next
+        evict() doesn't have to step over them again.
+        '''
+        over = self.size - self.limit
+        passed = 0
+        while over > 0 and passed < len(self.items):
+            kid, it = next(self.items.iteritems())
+            if it.own:
+                del self.items[kid]
+                self.items[kid] = it
+                passed += 1
+                continue
+            self.drop(kid)
+            over -= it.size
+            self.stats['evicted'] += 1
+
+    def drop(self, kid):
+        it = self.items.pop(kid)
+        self.size -= it.size
+
+    def item(self, kid):
+        '''
+        kid's Item, if we've a live one, counting it as used.
+        '''
+        with self.lock:
+            it = self.items.pop(kid, None)
+            if it is None or it.expires <= time.time():
+                if it is not None:
+                    self.size -= it.size
+                    self.stats['expired'] += 1
+                self.stats['misses'] += 1
+                return None
+            self.items[kid] = it
+            self.stats['hits'] += 1
+            return it
+
+    def get(self, kid):
+        it = self.item(kid)
+        return it and it.value
+
+    def due(self, buckets, now):
+        slot = int(now // self.slot)
+        keys = set()
+        for s in [s for s in buckets if s <= slot]:
+            keys |= buckets.pop(s)
+        return keys
+
+    def sweep(self, republish):
+        '''
+        Throw out what's expired.  Returns (key, value, seconds left to
+        live, own) for everything due to be republished, which is then
+        filed under its next republish time, republish seconds on.
+        '''
+        now = time.time()
+        out = []
+        with self.lock:
+            for kid in self.due(self.expiring, now):
+                it = self.items.get(kid, None)
+                if it is None:
+                    continue
+                if it.expires <= now:
+                    self.drop(kid)
+                    self.stats['expired'] += 1
+                else:
+                    self.file(self.expiring, kid, it.expires)
+            for kid in self.due(self.republishing, now):
+                it = self.items.get(kid, None)
+                if it is None or it.republish is None:
+                    continue
+                if it.republish <= now:
+                    out.append((kid, it.value, it.expires - now, it.own))
+                    it.republish = now + republish
+                self.file(self.republishing, kid, it.republish)
+        return out
+
+class Lookup(object):
+    '''
+    One iterative Kademlia lookup: ask the alpha closest nodes we know
+    of for the k closest they know of, and keep asking the closest
+    ones nobody has asked yet, alpha at a time, until the k closest we
+    have have all answered (or failed to).  A find_value lookup stops
+    as soon as anyone answers with the value.
+
+    It's all callbacks, with no thread of its own, so any number can
+    run at once.  future gets the k closest nodes that answered, as
+    (id, addr) pairs, or for find_value, the value (None if nobody
+    had it).  rpcs and elapsed are there afterwards for the curious.
+
+    A find_value lookup that finds the value leaves a copy with the
+    closest node it asked that didn't have one, so the next lookup
+    for a popular key stops there, or sooner.
+    '''
+    def __init__(self, dht, target, method='find_node'):
+        self.dht = dht
+        self.target = target
+        self.method = method
+        self.k = dht.table.k
+        self.alpha = dht.alpha
+        self.future = event.Future()
+        self.future.lookup = self
+        self.lock = threading.Lock()
+        self.nodes = {} # id -> addr, everyone we've heard of
+        self.asked = set()
+        self.answered = set()
+        self.failed = set()
+        self.inflight = 0
+        self.rpcs = 0
+        self.started = time.time()
+        self.elapsed = None
+        for c in dht.table.closest(target):
+            self.nodes[c.id] = c.addr
+
+    def start(self):
+        self.dht.table.touch(self.target)
+        self.next()
+        return self.future
+
+    def closest(self, ids):
+        return sorted(ids, key=lambda i: i ^ self.target)[:self.k]
+
+    def next(self):
+        with self.lock:
+            if self.future.done():
+                return
+            top = self.closest(i for i in self.nodes if i not in self.failed)
+            todo = [i for i in top if i not in self.asked][:self.alpha - self.inflight]
+            if not todo and not self.inflight:
+                todo = None
+            else:
+                for i in todo:
+                    self.asked.add(i)
+                self.inflight += len(todo)
+                self.rpcs += len(todo)
+        if todo is None:
+            result = [(i, self.nodes[i]) for i in top if i in self.answered]
+            self.finish(None if self.method == 'find_value' else result)
+            return
+        for i in todo:
+            f = self.dht.ask(i, self.nodes[i], self.method, target=self.target)
+            f.add_done_callback(lambda f, i=i: self.reply(i, f))
+
+    def reply(self, nid, f):
+        found = None
+        with self.lock:
+            self.inflight -= 1
+            if f.error is not None:
+                self.failed.add(nid)
+            else:
+                resp = f.value
+                if self.method == 'find_value' and 'value' in resp:
+                    found = resp
+                else:
+                    self.answered.add(nid)
+                    for i, addr in resp.get('nodes', ()):
+                        if i != self.dht.id:
+                            self.nodes.setdefault(i, addr)
+        if found is None:
+            self.next()
+        elif not self.future.done():
+            self.finish(found['value'])
+            self.cache(found['value'], found.get('ttl', self.dht.cachettl))
+
+    def cache(self, value, ttl):
+        with self.lock:
+            missed = self.closest(self.answered)
+        if missed:
+            i = missed[0]
+            self.dht.ask(i, self.nodes[i], 'store', target=self.target,
+                         value=value, cache=True, ttl=min(ttl, self.dht.cachettl))
+
+    def finish(self, result):
+        self.elapsed = time.time() - self.started
+        self.future.set_result(result)
+
 class DHT(object):
     '''
-    Implements Kademlia (when it works, which isn't now)
+    Implements Kademlia
     http://en.wikipedia.org/wiki/Kademlia
     http://xlattice.sourceforge.net/components/protocol/kademlia/specs.html
+
+    Nodes talk over udp.RPC.  Everyone we hear from goes in the routing
+    table, and anyone who stops answering is dropped from it, so
+    there's no separate heartbeat.  Buckets that haven't been looked
+    up in for refresh seconds get a lookup of a random id in them.
+
+    Values live for ttl seconds.  Every node holding one sends it on
+    to the k closest nodes every republish seconds (unless somebody
+    else just did), and whoever put() it in the first place keeps
+    restarting its ttl, so a value lasts until its owner goes away.
+    Copies cached along lookup paths last cachettl seconds at most.
+    All of that happens in one sweep every sweep seconds.
     '''
-    def __init__(self, idseed, bootstrap=(), port=6965):
-        self.buckets = {}
-        self.id = hashlib.sha1(idseed).digest()
-        self.udp = udp.UDP(port)
-        self.udp.handlers += self.handle_msg
-        if bootstrap:
-            self.bootstrap(bootstrap)
+    def __init__(self, idseed=None, bootstrap=(), port=6965, wheel=None, k=20,
+                 alpha=3, evloop=False, timeout=1.0, refresh=3600,
+                 ttl=86400, republish=3600, cachettl=600, limit=64 * 1024 * 1024,
+                 sweep=60):
+        self.wheel = wheel or timer.wheel()
+        if idseed is None:
+            idseed = uuid.uuid4().bytes
+        self.id = self.sha2num(hashlib.sha1(idseed).digest())
+        self.table = RoutingTable(self.id, k)
+        self.alpha = alpha
+        self.boot = bootstrap
+        self.refresh = refresh
+        self.ttl = ttl
+        self.republish = republish
+        self.cachettl = cachettl
+        self.sweepevery = sweep
+        self.values = ValueStore(limit, sweep)
+        self.pinging = set()
+        self.udp = udp.UDP(port, evloop)
+        self.rpc = udp.RPC(self.udp, self.id, self.wheel, timeout)
+        self.rpc.seen += self.heard
+        self.rpc.serve('ping', self.handle_ping)
+        self.rpc.serve('find_node', self.handle_find_node)
+        self.rpc.serve('find_value', self.handle_find_value)
+        self.rpc.serve('store', self.handle_store)
+        self.timer = None
+        self.sweeper = None
 
+    @staticmethod
     def xor(id1, id2):
-        k = 0
-        m = len(id1)
-        for x in xrange(m):
-            k += (ord(id1[x])^ord(id2[x])) * 256**((m - 1) - x)
-        return k
+        return id1 ^ id2
 
+    @staticmethod
     def sha2num(sha):
-        k = 0
-        m = len(sha)
-        for x in xrange(m):
-            k += (ord(sha[x]) * 256**((m - 1) - x))
-        return k
-
-    bucks = [2**x for x in xrange(160)]
-    def bucketid(num):
-        for x in xrange(len(self.bucks)):
-            if n < self.bucks[x]:
-                return x - 1
-        return x
-
-    def heartbeat(self):
-        msg = json.dumps({'heartbeat': True})
-        dlst = []
-        for addr in self.peers:
-            self.udp.send(msg, addr)
-            self.peers[addr] += 1
-            if self.peers[addr] > 5:
-                dlst.append(addr)
-        for d in dlst:
-            del self.peers[addr]
-
-    def handle_msg(self, data, addr):
-        msg = json.loads(data)
-        if msg.get('heartbeat', False):
-            self.handle_heartbeat(addr)
-        if msg.get('state', False):
-            self.handle_state(msg['state'], addr)
-
-    def handle_heartbeat(self, addr):
-        self.peers[addr] = 0
-
-    def handle_remove(self, addr):
-        if self.peers.has_key(addr):
-            del self.peers[addr]
-
-    def handle_state(self, state):
-        print "anyone for state?"
+        return int(binascii.hexlify(sha), 16)
+
+    @staticmethod
+    def bucketid(distance):
+        '''
+        Which power of two distance falls under: the index of the
+        k-bucket it would be in if the table were fully split.
+        '''
+        return distance.bit_length() - 1
+
+    @classmethod
+    def keyid(cls, key):
+        return cls.sha2num(hashlib.sha1(key).digest())
+
+    def start(self):
+        self.udp.start()
+        self.port = self.udp.port
+        if self.boot:
+            self.bootstrap(self.boot)
+        self.timer = self.wheel.schedule(self.refresh, self.refresh_buckets,
+                                         period=self.refresh,
+                                         jitter=self.refresh / 10.0)
+        self.sweeper = self.wheel.schedule(self.sweepevery, self.sweep,
+                                           period=self.sweepevery,
+                                           jitter=self.sweepevery / 10.0)
+
+    def stop(self):
+        for t in (self.timer, self.sweeper):
+            if t:
+                t.cancel()
+        self.udp.shutdown()
+
+    def bootstrap(self, addrs):
+        '''
+        Ping every address in addrs, and once anyone answers, look
+        ourselves up to fill the table.  Returns a Future for that
+        lookup, which fails with event.Timeout if nobody answers.
+        '''
+        done = event.Future()
+        state = {'left': len(addrs), 'joined': False}
+        lock = threading.Lock()
+        def pinged(f):
+            with lock:
+                state['left'] -= 1
+                join = f.error is None and not state['joined']
+                state['joined'] = state['joined'] or join
+                alone = not state['left'] and not state['joined']
+            if join:
+                self.find_node(self.id).add_done_callback(
+                    lambda l: done.set_result(l.value))
+            elif alone:
+                done.set_exception(event.Timeout("nobody to bootstrap from"))
+        for addr in addrs:
+            self.rpc.call(addr, 'ping').add_done_callback(pinged)
+        return done
+
+    def heard(self, nid, addr):
+        oldest = self.table.update(nid, addr)
+        if oldest is not None and oldest.id not in self.pinging:
+            # a full bucket: keep the old contact if it's still there
+            self.pinging.add(oldest.id)
+            f = self.ask(oldest.id, oldest.addr, 'ping')
+            f.add_done_callback(lambda f, nid=oldest.id: self.pinging.discard(nid))
+
+    def ask(self, nid, addr, method, **args):
+        '''
+        Call method on node nid, dropping it from the table if it
+        never answers.
+        '''
+        f = self.rpc.call(addr, method, **args)
+        def check(f):
+            if isinstance(f.error, event.Timeout):
+                self.table.fail(nid)
+        f.add_done_callback(check)
+        return f
+
+    def refresh_buckets(self):
+        for nid in self.table.stale(self.refresh):
+            self.find_node(nid)
+
+    def find_node(self, target):
+        '''
+        A Future for the k nodes closest to target, as (id, addr).
+        '''
+        return Lookup(self, target).start()
+
+    def find_value(self, target):
+        return Lookup(self, target, 'find_value').start()
+
+    def get(self, key):
+        '''
+        A Future for key's value, or None if nobody has it.
+        '''
+        kid = self.keyid(key)
+        value = self.values.get(kid)
+        if value is not None:
+            f = event.Future()
+            f.set_result(value)
+            return f
+        return self.find_value(kid)
+
+    def put(self, key, value, ttl=None):
+        '''
+        Store value (a string) at the k nodes closest to key, and keep
+        it there.  Returns a Future for how many of them took it, or
+        that fails with ValueError if value won't fit in a datagram.
+        '''
+        kid = self.keyid(key)
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        ttl = ttl or self.ttl
+        if not self.rpc.fits('store', target=kid, value=value, ttl=int(ttl)):
+            f = event.Future()
+            f.set_exception(ValueError("a %d byte value won't fit in a datagram" % len(value)))
+            return f
+        self.values.put(kid, value, ttl, self.republish, own=True)
+        return self.publish(kid, value, ttl)
+
+    def sweep(self):
+        for kid, value, ttl, own in self.values.sweep(self.republish):
+            if own:
+                self.values.put(kid, value, self.ttl, self.republish, own=True)
+                ttl = self.ttl
+            self.publish(kid, value, ttl)
+
+    def publish(self, kid, value, ttl):
+        done = event.Future()
+        def found(l):
+            nodes = l.value or []
+            if not nodes:
+                done.set_result(0)
+                return
+            state = {'left': len(nodes), 'ok': 0}
+            lock = threading.Lock()
+            def stored(f):
+                with lock:
+                    state['left'] -= 1
+                    state['ok'] += f.error is None
+                    last = not state['left']
+                if last:
+                    done.set_result(state['ok'])
+            for nid, addr in nodes:
+                self.ask(nid, addr, 'store', target=kid, value=value,
+                         ttl=int(ttl)).add_done_callback(stored)
+        self.find_node(kid).add_done_callback(found)
+        return done
+
+    def contacts(self, target, sender):
+        return [(c.id, c.addr) for c in self.table.closest(target, exclude=(sender,))]
+
+    def handle_ping(self, args, addr, sender):
+        return {}
+
+    def handle_find_node(self, args, addr, sender):
+        return {'nodes': self.contacts(args['target'], sender)}
+
+    def handle_find_value(self, args, addr, sender):
+        it = self.values.item(args['target'])
+        if it is not None:
+            return {'value': it.value, 'ttl': int(it.expires - time.time())}
+        return self.handle_find_node(args, addr, sender)
+
+    def handle_store(self, args, addr, sender):
+        ttl = min(args.get('ttl', self.ttl), self.ttl)
+        if args.get('cache', False):
+            self.values.put(args['target'], args['value'],
+                            min(ttl, self.cachettl), cached=True)
+        else:
+            self.values.put(args['target'], args['value'], ttl, self.republish)
+        return {}
@@ -1,9 +1,14 @@
+import time
 import thread
+import threading
 import traceback
+import Queue
+import collections
 
 class Event(object):
-    def __init__(self):
+    def __init__(self, pool=None):
         self.hooks = []
+        self.pool = pool
 
     def __iadd__(self, new):
         self.hooks.append(new)
@@ -21,6 +26,17 @@ class Event(object):
                 print traceback.format_exc()
                 continue
 
+    def poolfire(self, *args, **kwargs):
+        '''
+        Hand each hook to self.pool (made on first use, if we weren't
+        given one).  Hooks run on the pool's workers, each hook seeing
+        its calls in the order they were fired.
+        '''
+        if self.pool is None:
+            self.pool = Pool()
+        for hook in self.hooks:
+            self.pool.submit(hook, *args, **kwargs)
+
     def fire(self, *args, **kwargs):
         for hook in self.hooks:
             try:
@@ -31,3 +47,210 @@ class Event(object):
 
     def clear(self):
         self.hooks = []
+
+class Serial(object):
+    '''
+    Runs whatever it's handed one call at a time, in the order it was
+    handed over, on a thread of its own.
+
+    With inline=True there's no thread: calls run right away in the
+    caller, except that one submitted while another's running waits
+    until that one's done.  That's for single-threaded simulations.
+    '''
+    def __init__(self, inline=False):
+        self.q = Queue.Queue()
+        self.lock = threading.Lock()
+        self.started = False
+        self.inline = inline
+        self.backlog = collections.deque()
+        self.draining = False
+
+    def submit(self, func, *args, **kwargs):
+        if self.inline:
+            self.backlog.append((func, args, kwargs))
+            if not self.draining:
+                self.drain()
+            return
+        if not self.started:
+            with self.lock:
+                if not self.started:
+                    t = threading.Thread(target=self.run)
+                    t.daemon = True
+                    t.start()
+                    self.started = True
+        self.q.put((func, args, kwargs))
+
+    def run(self):
+        while True:
+            func, args, kwargs = self.q.get()
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                print traceback.format_exc()
+
+    def drain(self):
+        self.draining = True
+        try:
+            while self.backlog:
+                func, args, kwargs = self.backlog.popleft()
+                try:
+                    func(*args, **kwargs)
+                except Exception as e:
+                    print traceback.format_exc()
+        finally:
+            self.draining = False
+
+class Pool(object):
+    '''
+    A fixed number of worker threads running hooks off a bounded
+    queue.
+
+    Calls to the same hook never overlap and run in the order they
+    were submitted; different hooks run in parallel.  Once limit
+    calls are waiting, submit() either blocks until there's room
+    (policy='block') or throws the new call away (policy='drop').
+
+    inline=True runs every call in the caller instead, one at a time,
+    as Serial does.
+    '''
+    def __init__(self, workers=4, limit=1000, policy='block', inline=False):
+        if policy not in ('block', 'drop'):
+            raise ValueError("policy must be 'block' or 'drop'")
+        self.workers = workers
+        self.limit = limit
+        self.policy = policy
+        self.cond = threading.Condition(threading.Lock())
+        self.queues = {}                   # hook -> its pending calls
+        self.ready = collections.deque()   # hooks with calls waiting
+        self.scheduled = set()             # hooks ready or running
+        self.threads = []
+        self.queued = 0
+        self.running = 0
+        self.dropped = 0
+        self.done = 0
+        self.serial = Serial(inline=True) if inline else None
+
+    def submit(self, hook, *args, **kwargs):
+        '''
+        Returns False if the call was dropped.
+        '''
+        if self.serial:
+            self.done += 1
+            self.serial.submit(hook, *args, **kwargs)
+            return True
+        with self.cond:
+            while self.queued >= self.limit:
+                if self.policy == 'drop':
+                    self.dropped += 1
+                    return False
+                self.cond.wait()
+            if len(self.threads) < self.workers:
+                t = threading.Thread(target=self.work)
+                t.daemon = True
+                t.start()
+                self.threads.append(t)
+            self.queues.setdefault(hook, collections.deque()).append((args, kwargs))
+            self.queued += 1
+            if hook not in self.scheduled:
+                self.scheduled.add(hook)
+                self.ready.append(hook)
+                self.cond.notify_all()
+            return True
+
+    def work(self):
+        while True:
+            with self.cond:
+                while not self.ready:
+                    self.cond.wait()
+                hook = self.ready.popleft()
+                args, kwargs = self.queues[hook].popleft()
+                self.queued -= 1
+                self.running += 1
+                self.cond.notify_all() # room for anyone blocked in submit
+            try:
+                hook(*args, **kwargs)
+            except Exception as e:
+                print traceback.format_exc()
+            with self.cond:
+                self.running -= 1
+                self.done += 1
+                if self.queues[hook]:
+                    self.ready.append(hook)
+                    self.cond.notify_all()
+                else:
+                    del self.queues[hook]
+                    self.scheduled.discard(hook)
+
+    def stats(self):
+        with self.cond:
+            return dict(queued=self.queued, running=self.running,
+                        dropped=self.dropped, done=self.done)
+
+class Timeout(RuntimeError):
+    pass
+
+class Future(object):
+    '''
+    A result that turns up later, from another thread.  Wait for it
+    with result(), or have a callback run when it's there.
+    '''
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.finished = False
+        self.value = None
+        self.error = None
+        self.callbacks = []
+
+    def done(self):
+        return self.finished
+
+    def set_result(self, value):
+        return self.finish(value, None)
+
+    def set_exception(self, error):
+        return self.finish(None, error)
+
+    def finish(self, value, error):
+        # only the first result counts
+        with self.cond:
+            if self.finished:
+                return False
+            self.finished = True
+            self.value = value
+            self.error = error
+            self.cond.notify_all()
+            callbacks, self.callbacks = self.callbacks, []
+        for cb in callbacks:
+            try:
+                cb(self)
+            except Exception:
+                print traceback.format_exc()
+        return True
+
+    def add_done_callback(self, cb):
+        with self.cond:
+            if not self.finished:
+                self.callbacks.append(cb)
+                return
+        cb(self)
+
+    def result(self, timeout=None):
+        '''
+        The result, once there is one, or else raise whatever went
+        wrong.  Raises Timeout if there's still nothing after timeout
+        seconds.
+        '''
+        with self.cond:
+            if timeout is not None:
+                end = time.time() + timeout
+            while not self.finished:
+                if timeout is None:
+                    self.cond.wait()
+                    continue
+                left = end - time.time()
+                if left <= 0:
+                    raise Timeout("timed out waiting for a result")
+                self.cond.wait(left)
+        if self.error is not None:
+            raise self.error
+        return self.value
@@ -0,0 +1,104 @@
+import math
+import time
+import threading
+import collections
+
+class Gaps(object):
+    '''
+    The last window gaps between messages from one peer, with their
+    sum and sum of squares kept up as they come and go, so the mean
+    and variance are there without a pass over them.
+    '''
+    __slots__ = ('gaps', 'sum', 'sumsq', 'adds')
+
+    def __init__(self, window, first):
+        self.gaps = collections.deque(maxlen=window)
+        self.sum = self.sumsq = 0.0
+        self.adds = 0
+        self.add(first)
+
+    def add(self, gap):
+        gaps = self.gaps
+        if len(gaps) == gaps.maxlen:
+            old = gaps[0]
+            self.sum -= old
+            self.sumsq -= old * old
+        gaps.append(gap)
+        self.sum += gap
+        self.sumsq += gap * gap
+        self.adds += 1
+        if self.adds % gaps.maxlen == 0:
+            # start over every so often, before rounding errors pile up
+            self.sum = sum(gaps)
+            self.sumsq = sum(g * g for g in gaps)
+
+    def stats(self):
+        n = len(self.gaps)
+        mean = self.sum / n
+        return mean, max(self.sumsq / n - mean * mean, 0.0)
+
+class PhiDetector(object):
+    '''
+    A phi accrual failure detector (Hayashibara et al., 2004).
+
+    Rather than a yes/no timeout, every monitored peer gets a
+    suspicion level phi: how unlikely it is, given the spread of the
+    gaps between the messages we've had from it so far, that we'd
+    still be waiting this long if it were alive.  phi of 1 means a
+    10% chance it's just late, 2 means 1%, and so on; a peer is
+    suspected once phi passes threshold.
+
+    Anything at all heard from a peer counts; the node only has to
+    send explicit heartbeats on links that would otherwise be quiet.
+    That makes the gaps bursty (tiny under load, a whole heartbeat
+    interval when idle), so like Akka's detector we allow an extra
+    pause on top of the mean before phi starts climbing.
+
+    Connection threads, timers and relays all call in at once, so
+    everything's under a lock; phi() is constant time, since it's
+    asked about every tree child of every message relayed.
+    '''
+    def __init__(self, interval=30, threshold=8.0, window=100, minstd=None,
+                 pause=None, clock=time.time):
+        self.interval = interval    # what we expect the gaps to be, to start with
+        self.threshold = threshold
+        self.window = window
+        self.minstd = minstd if minstd is not None else interval / 5.0
+        self.pause = pause if pause is not None else interval
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.last = {}
+        self.gaps = {} # key -> Gaps
+
+    def heartbeat(self, key, now=None):
+        now = self.clock() if now is None else now
+        with self.lock:
+            last = self.last.get(key, None)
+            if last is None:
+                # a guess until we have real ones
+                self.gaps[key] = Gaps(self.window, self.interval)
+            else:
+                self.gaps[key].add(now - last)
+            self.last[key] = now
+
+    def phi(self, key, now=None):
+        with self.lock:
+            last = self.last.get(key, None)
+            if last is None:
+                return 0.0
+            mean, var = self.gaps[key].stats()
+        now = self.clock() if now is None else now
+        std = max(math.sqrt(var), self.minstd)
+        # chance a live peer's next message is later than this
+        late = 0.5 * math.erfc((now - last - mean - self.pause) / (std * math.sqrt(2)))
+        if late <= 1e-300:
+            return float('inf')
+        return -math.log10(late)
+
+    def suspected(self, key, now=None):
+        return self.phi(key, now) > self.threshold
+
+    def forget(self, key):
+        with self.lock:
+            self.last.pop(key, None)
+            self.gaps.pop(key, None)
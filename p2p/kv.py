@@ -0,0 +1,187 @@
+import json
+import threading
+
+import event
+import merkle
+
+class Entry(object):
+    '''
+    One key's current value, and the version it's at: a dumped ITC
+    stamp, plus the writer's wall clock and id to settle ties.  dead
+    marks a delete, kept around so it can win over older writes.
+    '''
+    __slots__ = ('value', 'ver', 't', 'writer', 'dead', 'stamp')
+
+    def __init__(self, value, ver, t, writer, dead=False, stamp=None):
+        self.value = value
+        self.ver = ver
+        self.t = t
+        self.writer = writer
+        self.dead = dead
+        self.stamp = stamp # ver, loaded; made when first needed
+
+    def hash(self, key):
+        return merkle.MerkleTree.digest(json.dumps([key, self.ver, self.dead]))
+
+    def wire(self, key):
+        return [key, self.value, self.ver, self.t, self.writer, self.dead]
+
+    @classmethod
+    def unwire(cls, w):
+        key, value, ver, t, writer, dead = w
+        return key, cls(value, ver, t, writer, dead)
+
+class KVStore(object):
+    '''
+    A replicated key-value store on top of a Broadcaster.
+
+    Every node keeps the whole map and reads from it locally.  A write
+    counts an event on the node's ITC clock, versions the key with a
+    peek at the clock, and sends out just that key in a 'kv' message;
+    one changed key costs one small message however big the map is.
+
+    Receivers keep whichever version is newer.  Writes that are
+    concurrent (neither writer had seen the other's) are settled the
+    same way everywhere: later wall clock time wins, then higher
+    writer id, and the winner gets the join of both versions, so
+    anything written after seeing either one supersedes both.
+    Deletes are kept as tombstones, so that they beat the writes they
+    deleted.
+
+    The store also keeps a Merkle tree of itself up to date, for
+    merkle.AntiEntropy to repair replicas with.
+    '''
+    def __init__(self, bc, depth=4):
+        self.bc = bc
+        self.data = {} # key -> Entry
+        self.tree = merkle.MerkleTree(depth)
+        self.lock = threading.RLock()
+        self.changed = event.Event(bc.pool) # fired with (key, value) on every change
+        bc.register('kv', self.handle_msg_kv)
+
+    def get(self, key, default=None):
+        e = self.data.get(key, None)
+        if e is None or e.dead:
+            return default
+        return e.value
+
+    def __getitem__(self, key):
+        e = self.data.get(key, None)
+        if e is None or e.dead:
+            raise KeyError(key)
+        return e.value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        self.delete(key)
+
+    def __contains__(self, key):
+        e = self.data.get(key, None)
+        return e is not None and not e.dead
+
+    def keys(self):
+        return [k for k, e in self.data.items() if not e.dead]
+
+    def items(self):
+        return [(k, e.value) for k, e in self.data.items() if not e.dead]
+
+    def set(self, key, value):
+        self.update({key: value})
+
+    def delete(self, key):
+        self.write([(key, None, True)])
+
+    def update(self, pairs):
+        '''
+        Set a bunch of keys at once, in one message.
+        '''
+        if hasattr(pairs, 'items'):
+            pairs = pairs.items()
+        self.write([(k, v, False) for k, v in pairs])
+
+    def write(self, changes):
+        if self.bc.clock is None:
+            raise RuntimeError("not part of a lace yet")
+        out = []
+        with self.lock:
+            stamp = self.bc.tick()
+            ver = self.bc.dumpstamp(stamp)
+            t = self.bc.now()
+            for key, value, dead in changes:
+                e = Entry(value, ver, t, self.bc.uuid, dead, stamp)
+                self.put(key, e)
+                out.append(e.wire(key))
+        for key, value, dead in changes:
+            self.changed.poolfire(key, None if dead else value)
+        msg = self.bc.mkmsg('kv')
+        msg['kv'] = out
+        self.bc.relay(msg)
+
+    def put(self, key, e):
+        old = self.data.get(key, None)
+        self.data[key] = e
+        self.tree.update(key, old.hash(key) if old else None, e.hash(key))
+
+    def entries(self, keys):
+        '''
+        The entries for keys, in wire form.
+        '''
+        data = self.data
+        return [data[k].wire(k) for k in keys if k in data]
+
+    def stamp(self, e):
+        if e.stamp is None:
+            e.stamp = self.bc.loadstamp(e.ver)
+        return e.stamp
+
+    def newer(self, new, cur):
+        '''
+        Whether new should replace cur; and, if they're concurrent,
+        the join of their versions, for whichever one wins.
+        '''
+        a, b = self.stamp(cur), self.stamp(new)
+        if b <= a:
+            return False, None
+        if a <= b:
+            return True, None
+        if (new.t, new.writer) > (cur.t, cur.writer):
+            return True, a + b
+        return False, a + b
+
+    def merge(self, entries):
+        '''
+        Take in entries (in wire form) from elsewhere, keeping the
+        ones newer than ours.  Returns the keys that changed.
+        '''
+        changed = []
+        with self.lock:
+            for w in entries:
+                key, new = Entry.unwire(w)
+                cur = self.data.get(key, None)
+                if cur is None:
+                    take, joined = True, None
+                else:
+                    take, joined = self.newer(new, cur)
+                # whatever we write next has to come after this
+                self.bc.witness(self.stamp(new))
+                if joined is not None:
+                    ver = self.bc.dumpstamp(joined)
+                    if take:
+                        new.ver, new.stamp = ver, joined
+                    else:
+                        cur = Entry(cur.value, ver, cur.t, cur.writer, cur.dead, joined)
+                        self.put(key, cur)
+                if take:
+                    self.put(key, new)
+                    changed.append(key)
+        for key in changed:
+            e = self.data.get(key)
+            self.changed.poolfire(key, None if e.dead else e.value)
+        return changed
+
+    def handle_msg_kv(self, msg, addr, reply):
+        self.bc.relay(msg)
+        if msg['id'][0] != self.bc.uuid:
+            self.merge(msg['kv'])
@@ -0,0 +1,203 @@
+import os
+import time
+import heapq
+import fcntl
+import errno
+import select
+import thread
+import threading
+import collections
+import traceback
+
+class Poller(object):
+    '''
+    Thin wrapper over epoll, or poll where there's no epoll, so the
+    loop only has to speak one dialect.
+    '''
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self.p = select.epoll()
+            self.READ = select.EPOLLIN
+            self.WRITE = select.EPOLLOUT
+            self.ERR = select.EPOLLERR | select.EPOLLHUP
+            self.scale = 1
+        else:
+            self.p = select.poll()
+            self.READ = select.POLLIN
+            self.WRITE = select.POLLOUT
+            self.ERR = select.POLLERR | select.POLLHUP | select.POLLNVAL
+            self.scale = 1000
+        self.masks = {}
+
+    def set(self, fd, mask):
+        old = self.masks.get(fd, 0)
+        if mask == old:
+            return
+        if not mask:
+            del self.masks[fd]
+            try:
+                self.p.unregister(fd)
+            except (IOError, OSError, KeyError, ValueError):
+                pass # already closed; the kernel forgot it for us
+            return
+        self.masks[fd] = mask
+        if old:
+            self.p.modify(fd, mask)
+        else:
+            self.p.register(fd, mask)
+
+    def poll(self, timeout=None):
+        if timeout is None:
+            timeout = -1 if self.scale == 1 else None
+        else:
+            timeout = timeout * self.scale
+        return self.p.poll(timeout)
+
+class Loop(object):
+    '''
+    A small poll-driven reactor.  Every callback registered here runs
+    on the loop's one thread, so a node can serve thousands of
+    sockets without a thread apiece.  Other threads hand the loop
+    work with call_soon().
+    '''
+    def __init__(self):
+        self.poller = Poller()
+        self.readers = {}
+        self.writers = {}
+        self.pending = collections.deque()
+        self.timers = [] # heap of [when, seq, func, args]
+        self.seq = 0
+        self.ident = None
+        self.running = False
+        self.rpipe, self.wpipe = os.pipe()
+        for fd in (self.rpipe, self.wpipe):
+            fl = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+        self.add_reader(self.rpipe, self.drain)
+
+    def inloop(self):
+        return self.ident == thread.get_ident()
+
+    def update(self, fd):
+        mask = 0
+        if fd in self.readers:
+            mask |= self.poller.READ
+        if fd in self.writers:
+            mask |= self.poller.WRITE
+        self.poller.set(fd, mask)
+
+    def add_reader(self, fd, cb):
+        if self.running and not self.inloop():
+            return self.call_soon(self.add_reader, fd, cb)
+        self.readers[fd] = cb
+        self.update(fd)
+
+    def remove_reader(self, fd):
+        if self.running and not self.inloop():
+            return self.call_soon(self.remove_reader, fd)
+        if self.readers.pop(fd, None):
+            self.update(fd)
+
+    def add_writer(self, fd, cb):
+        if self.running and not self.inloop():
+            return self.call_soon(self.add_writer, fd, cb)
+        self.writers[fd] = cb
+        self.update(fd)
+
+    def remove_writer(self, fd):
+        if self.running and not self.inloop():
+            return self.call_soon(self.remove_writer, fd)
+        if self.writers.pop(fd, None):
+            self.update(fd)
+
+    def call_soon(self, func, *args):
+        self.pending.append((func, args))
+        self.wakeup()
+
+    def call_later(self, delay, func, *args):
+        '''
+        Run func on the loop after delay seconds.  Returns a handle
+        you can give to cancel().  Must be called on the loop thread.
+        '''
+        self.seq += 1
+        t = [time.time() + delay, self.seq, func, args]
+        heapq.heappush(self.timers, t)
+        return t
+
+    def cancel(self, t):
+        t[2] = None
+
+    def run_timers(self):
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            when, seq, func, args = heapq.heappop(self.timers)
+            if func:
+                self.call(func, *args)
+
+    def wakeup(self):
+        try:
+            os.write(self.wpipe, "x")
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def drain(self):
+        try:
+            while os.read(self.rpipe, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def run_pending(self):
+        # only run what was here when we started, so a callback that
+        # reschedules itself can't starve the sockets
+        for _ in xrange(len(self.pending)):
+            func, args = self.pending.popleft()
+            self.call(func, *args)
+
+    def call(self, func, *args):
+        try:
+            func(*args)
+        except Exception:
+            print traceback.format_exc()
+
+    def run_once(self, timeout=None):
+        if self.timers:
+            left = max(0, self.timers[0][0] - time.time())
+            timeout = left if timeout is None else min(timeout, left)
+        if self.pending:
+            timeout = 0
+        try:
+            events = self.poller.poll(timeout)
+        except (IOError, OSError, select.error) as e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        for fd, ev in events:
+            if ev & (self.poller.READ | self.poller.ERR):
+                cb = self.readers.get(fd)
+                if cb:
+                    self.call(cb)
+            if ev & (self.poller.WRITE | self.poller.ERR):
+                cb = self.writers.get(fd)
+                if cb:
+                    self.call(cb)
+        self.run_timers()
+        self.run_pending()
+
+    def run(self):
+        self.ident = thread.get_ident()
+        self.running = True
+        while self.running:
+            self.run_once()
+
+    def start(self):
+        self.running = True
+        t = threading.Thread(target=self.run)
+        t.daemon = True
+        t.start()
+
+    def stop(self):
+        self.running = False
+        self.wakeup()
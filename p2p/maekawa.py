@@ -1,11 +1,70 @@
 import uuid
 import heapq
 import threading
+import contextlib
+import collections
 
-class MaekawaNode(object):
+import event
+
+class Outbox(object):
+    '''
+    The Maekawa messages from one step of handling, held back until
+    the step is over so that everything for the same peer, whatever
+    lock it's for, goes out as one frame.  It's flushed before the
+    locks for the step are let go: Maekawa needs what we send a peer
+    to get there in the order we decided it, and nobody else can be
+    deciding anything for those locks till then.
+
+    Messages to ourselves are handled in place, without ever being
+    encoded, before anything is sent; so whatever our own vote does
+    in reply rides along too.  A release and the grant it frees up for
+    the next in line reach that node together, for instance.
+    '''
     def __init__(self, parent):
+        self.parent = parent
+        self.ops = collections.OrderedDict() # peer id -> [op, ...]
+        self.via = {}                        # peer id -> peers snapshot to find it in
+
+    def put(self, peerid, op, peers=None):
+        self.ops.setdefault(peerid, []).append(op)
+        if peers is not None:
+            self.via[peerid] = peers
+
+    def broadcast(self, op, peers=None):
+        if peers is None:
+            peers = self.parent.peers
+        for peer in peers:
+            self.put(peer, op, peers)
+        self.put(self.parent.uuid, op)
+
+    def flush(self):
+        me = self.parent.uuid
+        while me in self.ops:
+            for op in self.ops.pop(me):
+                self.parent.lock_for(op.get('key', None)).handle_op(op, me, self)
+        for peerid, ops in self.ops.iteritems():
+            self.parent.sendops(ops, peerid, self.via.get(peerid, None))
+        self.ops.clear()
+
+class MaekawaNode(object):
+    '''
+    One distributed lock, by Maekawa's algorithm.  A Broadcaster can
+    have any number of these, one per lock key; their messages carry
+    the key so they can share the node's connections.
+
+    Grants are leases: a voter takes its grant back lease seconds
+    after giving it, released or not, so a holder that dies can't
+    wedge the lock.  The holder counts its lease from when it asked,
+    which is before any voter can have granted it, and lets go when
+    the lease is up, setting 'revoked' in the stats that acquire()'s
+    Future handed it, so a holder can check it still has the lock.
+    '''
+    def __init__(self, parent, key=None):
         self.lock = threading.RLock() # probably an unneeded mistake
         self.parent = parent  # this is so goddamn backwards
+        self.key = key        # which lock this is; None is the default one
+        self.wheel = parent.wheel
+        self.touched = self.parent.now() # last time anything happened to it
         self.acqcb = None     # the callback invoked when the mutex is acquired
         self.grant = None     # the id of the peer we have given our "grant" toekn
         self.maeq = []        # a queue of requests, in the form of (sequence number, node id)
@@ -18,36 +77,166 @@ class MaekawaNode(object):
         self.inquired = False # whether we have an outstanding 'inquire' message with our current grant
         self.grantset = set() # the set of peers we need to get grant tickets from
         self.started = False
+        self.requesting = False # between acquire() and getting every grant
+        self.future = None    # what acquire() handed back
+        self.leasetime = None # how long our grants last, counting from...
+        self.asked = None     # ...when we sent the request
+        self.leasetimer = None
+        self.deadlinetimer = None
+        self.leases = {}      # node id -> (seq, lease) of its latest request
+        self.granttimer = None # takes our grant back when its lease is up
+        self.stats = None     # timings for the acquisition under way
+        self.waiting = collections.deque() # acquire()s here waiting for that one to be done
+        self.history = collections.deque(maxlen=100) # and for recent ones
+        self.out = None       # the Outbox for the step in progress
+
+    def mkop(self, op=None, seq=None):
+        msg = {'maekawa': op, 'seq': seq}
+        if self.key is not None:
+            msg['key'] = self.key
+        return msg
+
+    @contextlib.contextmanager
+    def step(self, out=None):
+        '''
+        Hold the lock for one step of the algorithm, with everything
+        sent going into an Outbox: out, if given, or else the one for
+        the step we're already in, or else a new one that gets flushed
+        at the end of the step, before the lock is let go.
+        '''
+        with self.lock:
+            outer = self.out
+            out = out or outer
+            mine = out is None
+            if mine:
+                out = Outbox(self.parent)
+            self.out = out
+            try:
+                yield out
+            finally:
+                self.out = outer
+            if mine:
+                out.flush()
 
-    def acquire(self, acqcb=None):
+    def idle(self):
+        '''
+        Whether there's nothing going on with this lock at all: not
+        held or wanted by us, and our grant not out to anyone.
+        '''
         with self.lock:
-            if self.started:
+            return not (self.started or self.requesting or self.mutexed
+                        or self.grant is not None or self.maeq or self.waiting)
+
+    def acquire(self, acqcb=None, timeout=None, lease=None):
+        '''
+        Ask for the lock, without waiting for it.  Returns a Future
+        that gets this acquisition's stats once we hold the lock, or
+        event.Timeout if we still don't after timeout seconds, by
+        which point the request has been withdrawn.
+
+        If we're already after this lock, or holding it, for somebody
+        else here, this waits its turn behind them (and anyone else
+        waiting already) before asking the rest of the lace; timeout
+        counts that wait too.
+        '''
+        with self.step():
+            now = self.touched = self.parent.now()
+            future = event.Future()
+            deadline = None
+            if timeout is not None:
+                deadline = self.wheel.later(timeout, self.expire, future)
+            waiter = (acqcb, future, lease or self.parent.lease, now, deadline)
+            if self.mutexed or self.requesting or self.waiting:
+                self.waiting.append(waiter)
+            else:
+                self.begin(*waiter)
+            return future
+
+    def begin(self, acqcb, future, lease, asked, deadline):
+        self.acqcb = acqcb
+        self.future = future
+        self.leasetime = lease
+        self.deadlinetimer = deadline
+        self.stats = {'key': self.key, 'asked': asked, 'wait': None,
+                      'inquires': 0, 'yields': 0, 'fails': 0, 'retries': 0,
+                      'revoked': False}
+        self.request()
+
+    def next_waiter(self):
+        # we're done with the lock; on to whoever's next here, if anyone
+        while self.waiting and not (self.mutexed or self.requesting):
+            waiter = self.waiting.popleft()
+            if not waiter[1].done():
+                self.begin(*waiter)
+
+    def request(self):
+        self.requesting = True
+        self.inquires = set()
+        self.fails = set()
+        self.grants = set()
+        self.asked = self.parent.now()
+        msg = self.mkop('request', self.reqseq)
+        msg['lease'] = self.leasetime
+        peers = self.parent.peers # one snapshot for both, so they agree
+        self.grantset = set(peers.keys() + [self.parent.uuid])
+        self.leasetimer = self.wheel.later(self.leasetime, self.lease_up, self.reqseq)
+        self.out.broadcast(msg, peers)
+
+    def withdraw(self):
+        # call the request off, handing back any grants we got for it
+        self.requesting = False
+        self.leasetimer.cancel()
+        msg = self.mkop('withdraw', self.reqseq)
+        self.reqseq += 1 # anything still on its way for that request is stale now
+        self.out.broadcast(msg)
+
+    def expire(self, future):
+        with self.step():
+            queued = [w for w in self.waiting if w[1] is future]
+            if queued:
+                # it never got as far as asking
+                self.waiting.remove(queued[0])
+            elif future is not self.future or not self.requesting:
+                return
+            else:
+                self.withdraw()
+                self.acqcb = None
+                self.stats['wait'] = self.parent.now() - self.stats['asked']
+                self.history.append(self.stats)
+                self.next_waiter()
+            self.parent.metrics.count('lock.timeouts')
+        future.set_exception(event.Timeout("timed out waiting for lock %r" % (self.key,)))
+
+    def lease_up(self, seq):
+        with self.step():
+            if seq != self.reqseq:
                 return
             if self.mutexed:
-                raise RuntimeError("bizzare truth values")
-            self.acqcb = acqcb
-            self.inquires = set()
-            self.fails = set()
-            self.grants = set()
-            msg = self.parent.mkmsg('maekawa')
-            msg['maekawa'] = 'request'
-            msg['seq'] = self.reqseq
-            with self.parent.lock:
-                self.grantset = set(self.parent.peers.keys() + [self.parent.uuid])
-                self.parent.broadcast(msg)
+                self.stats['revoked'] = True
+                self.parent.metrics.count('lock.leases_expired')
+                self.release()
+            elif self.requesting:
+                # some of the grants we've got may have been taken back
+                # already, so they're no good; ask all over again
+                self.withdraw()
+                self.stats['retries'] += 1
+                self.parent.metrics.count('lock.retries')
+                self.request()
 
     def release(self):
-        with self.lock:
+        with self.step():
+            self.touched = self.parent.now()
             if self.mutexed == False:
                 return
+            held = self.touched - self.stats['asked'] - self.stats['wait']
+            self.parent.metrics.observe('lock.held', held)
             self.mutexed = False
             self.acqcb = None
+            self.leasetimer.cancel()
             self.reqseq += 1 # ARE YOU FUCKING KIDDING ME MOVING THIS HERE FIXED ALL THE BUGS WHAT THE SHITDICK
-            msg = self.parent.mkmsg('maekawa')
-            msg['maekawa'] = 'release'
-            msg['seq'] = self.reqseq
-            self.parent.broadcast(msg)
+            self.out.broadcast(self.mkop('release', self.reqseq))
             self.started = False
+            self.next_waiter()
 
     @staticmethod
     def should_yield(msgid, msgseq, newid, newseq):
@@ -67,33 +256,33 @@ class MaekawaNode(object):
             return True
         return False
 
-    def handle_msg(self, msg):
-        if not msg['maekawa']:
-            print "bad message"
-            return
+    def handle_op(self, msg, msgid, out=None):
+        '''
+        Handle one Maekawa message from msgid, sending any replies
+        through out.
+        '''
         try:
-            handler = getattr(self, "handle_msg_%s"%msg['maekawa'])
+            handler = getattr(self, "handle_msg_%s"%msg.get('maekawa'))
         except AttributeError:
-            print "no such handler"
+            # no op, or one we don't know
+            self.parent.metrics.count('maekawa.bad')
             return
-        msgid = msg['id'][0]
 #        f = " ".join(['recv', "%03d"%(msgid%997), ">>", "%03d"%(self.parent.uuid%997), msg['maekawa']])
 #        print f
-        nmsg = self.parent.mkmsg('maekawa')
-        with self.lock:
+        self.parent.metrics.count('maekawa.' + msg['maekawa'])
+        nmsg = self.mkop()
+        with self.step(out):
+            self.touched = self.parent.now()
             ans = handler(msg, msgid, nmsg)
-        if ans:
-#            f = " ".join(['send', "%03d"%(self.parent.uuid%997), ">>", "%03d"%(ans[1]%997), ans[0]['maekawa']])
-#            print f
-            self.parent.sendmsg(ans[0], ans[1])
+            if ans:
+#                f = " ".join(['send', "%03d"%(self.parent.uuid%997), ">>", "%03d"%(ans[1]%997), ans[0]['maekawa']])
+#                print f
+                self.out.put(ans[1], ans[0])
 
     def sendfail(self, nodeid, reqseq):
-        fmsg = self.parent.mkmsg('maekawa')
-        fmsg['maekawa'] = 'fail'
-        fmsg['seq'] = reqseq
-#        f = " ".join(['send', "%03d"%(self.parent.uuid%997), ">>", "%03d"%(nodeid%997), fmsg['maekawa']])
+#        f = " ".join(['send', "%03d"%(self.parent.uuid%997), ">>", "%03d"%(nodeid%997), 'fail'])
 #        print f
-        self.parent.sendmsg(fmsg, nodeid)
+        self.out.put(nodeid, self.mkop('fail', reqseq))
 
     def handle_msg_request(self, msg, msgid, nmsg):
         '''
@@ -111,14 +300,10 @@ class MaekawaNode(object):
     	is lower than the grant id, send an 'inquire' message to
     	the node that has our grant.
         '''
+        self.leases[msgid] = (msg['seq'], msg.get('lease', None))
         if self.grant is None:
             # we have nothing outstanding -- grant the request
-            self.grant = msgid
-            self.grantseq = msg['seq']
-            nmsg['seq'] = msg['seq']
-            nmsg['maekawa'] = 'grant'
-            self.inquired = False
-            return nmsg, msgid
+            return self.give(msgid, msg['seq'], nmsg)
         # enqueue the message, since we can't grant it now
         heapq.heappush(self.maeq, (msg['seq'], msgid))
         if not self.should_yield(self.grant, self.grantseq, msgid, msg['seq']):
@@ -134,15 +319,70 @@ class MaekawaNode(object):
             return nmsg, self.grant
         # nothing to do, fall off the end
 
+    def give(self, mid, seq, nmsg):
+        # hand our grant to mid, for as long as it asked for it
+        self.grant = mid
+        self.grantseq = seq
+        self.inquired = False
+        if self.granttimer:
+            self.granttimer.cancel()
+            self.granttimer = None
+        lseq, lease = self.leases.get(mid, (None, None))
+        if lseq == seq and lease:
+            self.granttimer = self.wheel.later(lease, self.reclaim, mid, seq)
+        nmsg['seq'] = seq
+        nmsg['maekawa'] = 'grant'
+        return nmsg, mid
+
+    def reclaim(self, mid, seq):
+        # mid's lease is up; as far as we're concerned, it's released
+        with self.step():
+            if self.grant == mid and self.grantseq == seq:
+                ans = self.handle_msg_release(None, mid, self.mkop())
+                if ans:
+                    self.out.put(ans[1], ans[0])
+
     def handle_msg_grant(self, msg, msgid, nmsg):
         if msg['seq'] != self.reqseq:
             return
         self.grants.add(msgid)
-        if self.grants == self.grantset:
+        self.check()
+
+    def check(self):
+        if self.requesting and self.grants >= self.grantset:
+            self.requesting = False
             self.mutexed = True
+            if self.deadlinetimer:
+                self.deadlinetimer.cancel()
+                self.deadlinetimer = None
+            self.stats['wait'] = self.parent.now() - self.stats['asked']
+            self.stats['expires'] = self.asked + self.leasetime
+            self.history.append(self.stats)
+            self.parent.metrics.count('lock.acquired')
+            self.parent.metrics.observe('lock.wait', self.stats['wait'])
             if self.acqcb:
                 self.acqcb()
                 self.acqcb = None
+            self.future.set_result(self.stats)
+
+    def forget(self, nodeid):
+        '''
+        nodeid is gone, or as good as.  Stop waiting on it for a
+        grant, drop its queued requests, and if it's holding our grant
+        take it back as though it had released.
+        '''
+        with self.step():
+            self.grantset.discard(nodeid)
+            self.grants.discard(nodeid)
+            self.fails.discard(nodeid)
+            self.inquires.discard(nodeid)
+            self.maeq = [r for r in self.maeq if r[1] != nodeid]
+            heapq.heapify(self.maeq)
+            if self.grant == nodeid:
+                ans = self.handle_msg_release(None, nodeid, self.mkop())
+                if ans:
+                    self.out.put(ans[1], ans[0])
+            self.check()
 
     def handle_msg_inquire(self, msg, msgid, nmsg):
         '''
@@ -150,27 +390,30 @@ class MaekawaNode(object):
     	with a 'yield'.  Otherwise just store the request in case
     	we get a failure at some other point.
         '''
-        if self.mutexed or not msg['seq'] == self.reqseq:
+        if not self.requesting or not msg['seq'] == self.reqseq:
             # this actually happens a lot
             return
+        self.stats['inquires'] += 1
         if len(self.fails) > 0:
             nmsg['maekawa'] = 'yield'
             nmsg['seq'] = self.reqseq
+            self.grants.discard(msgid) # it's not ours any more
+            self.stats['yields'] += 1
             return nmsg, msgid
         else:
             self.inquires.add(msgid)
 
     def handle_msg_fail(self, msg, msgid, nmsg):
-        if not msg['seq'] == self.reqseq:
+        if not self.requesting or not msg['seq'] == self.reqseq:
             return
         # send out yields for any cached inquires
         for i in self.inquires:
-            t = self.parent.mkmsg('maekawa')
-            t['maekawa'] = 'yield'
-            t['seq'] = self.reqseq
-            self.parent.sendmsg(t, i)
+            self.grants.discard(i)
+            self.stats['yields'] += 1
+            self.out.put(i, self.mkop('yield', self.reqseq))
         self.inquires = set() # empty the set
         self.fails.add(msgid)
+        self.stats['fails'] += 1
 
     def handle_msg_yield(self, msg, msgid, nmsg):
 	    # the node holding our grant has yielded it, so give it to
@@ -178,36 +421,45 @@ class MaekawaNode(object):
         if msg['seq'] != self.grantseq or msgid != self.grant:
             return
         heapq.heappush(self.maeq, (self.grantseq, self.grant))
-        seq, mid = heapq.heappop(self.maeq) # we won't get the same request back, 'cause heap
-        self.grant = mid
-        self.grantseq = seq
-        nmsg['seq'] = seq
-        nmsg['maekawa'] = 'grant'
-        self.inquired = False
-        return nmsg, mid
+        return self.grant_next(nmsg)
+
+    def handle_msg_withdraw(self, msg, msgid, nmsg):
+        # msgid has given up on its request; forget it, and if it had
+        # our grant, treat that as released
+        self.maeq = [r for r in self.maeq if r != (msg['seq'], msgid)]
+        heapq.heapify(self.maeq)
+        if self.grant == msgid and self.grantseq == msg['seq']:
+            return self.handle_msg_release(None, msgid, nmsg)
 
     def handle_msg_release(self, msg, msgid, nmsg):
         # unlock and send a grant to the next guy, if any
+        if msg is not None and (msgid != self.grant or msg['seq'] != self.grantseq + 1):
+            return # not for the grant we gave out (say we took it back already)
         self.grant = None
         self.grantseq = None
+        if self.granttimer:
+            self.granttimer.cancel()
+            self.granttimer = None
         if len(self.maeq) > 0:
-            seq, mid = heapq.heappop(self.maeq)
-            self.grant = mid
-            self.grantseq = seq
-            nmsg['seq'] = seq
-            nmsg['maekawa'] = 'grant'
-            self.inquired = False
-            # send a 'fail' message to every other node in the queue
-            # this isn't in the paper, but I'm pretty sure that it's necessary for the following scenario:
-            #   node A sends a request to node B, and B sends a grant to node A
-            #   node C sends a request to B and C
-            #   C gives a grant to itself, and node B compares the requests and sends an inquire to A
-            #   A declines to yield and eventually gains the lock
-            #   node B sends requests to itself and to C; B's request supersedes C's
-            #   A releases its lock, and B immediately grants its own request
-            #   C, meanwhile, sends itself an inquire
-            #   B and C deadlock, because C doesn't know B failed C's request.
-            for fseq, fid in self.maeq:
-                self.sendfail(fid, fseq)
-            return nmsg, mid
+            return self.grant_next(nmsg)
+
+    def grant_next(self, nmsg):
+        seq, mid = heapq.heappop(self.maeq) # after a yield, we won't get the same request back, 'cause heap
+        self.give(mid, seq, nmsg)
+        # send a 'fail' message to every other node in the queue
+        # this isn't in the paper, but I'm pretty sure that it's necessary for the following scenario:
+        #   node A sends a request to node B, and B sends a grant to node A
+        #   node C sends a request to B and C
+        #   C gives a grant to itself, and node B compares the requests and sends an inquire to A
+        #   A declines to yield and eventually gains the lock
+        #   node B sends requests to itself and to C; B's request supersedes C's
+        #   A releases its lock, and B immediately grants its own request
+        #   C, meanwhile, sends itself an inquire
+        #   B and C deadlock, because C doesn't know B failed C's request.
+        # the same goes after a yield: whoever was waiting behind the
+        # yielder got an inquire sent on its behalf, not a fail, and
+        # won't give up its own grants for the new holder without one
+        for fseq, fid in self.maeq:
+            self.sendfail(fid, fseq)
+        return nmsg, mid
 
@@ -0,0 +1,121 @@
+import json
+import random
+import hashlib
+
+class MerkleTree(object):
+    '''
+    A fixed-shape hash tree over a key-value map, for finding where two
+    replicas differ without shipping either one.
+
+    Keys are spread over fanout**depth leaves by the hash of the key.
+    Each node's hash is the XOR of the hashes of every entry under it,
+    so changing one entry just XORs a delta into the depth+1 nodes
+    above it, and the tree never has to be rebuilt.
+    '''
+    def __init__(self, depth=4, fanout=16):
+        self.depth = depth
+        self.fanout = fanout
+        self.levels = [[0] * (fanout ** l) for l in xrange(depth + 1)]
+        self.buckets = {} # leaf -> set of keys in it
+
+    @staticmethod
+    def digest(s):
+        return int(hashlib.sha1(s).hexdigest()[:16], 16)
+
+    def leaf(self, key):
+        return self.digest(json.dumps(key)) % len(self.levels[-1])
+
+    def update(self, key, old, new):
+        '''
+        key's entry hash went from old to new (None for no entry).
+        '''
+        i = self.leaf(key)
+        if old is None:
+            self.buckets.setdefault(i, set()).add(key)
+        elif new is None:
+            b = self.buckets.get(i, set())
+            b.discard(key)
+            if not b:
+                self.buckets.pop(i, None)
+        delta = (old or 0) ^ (new or 0)
+        for level in xrange(self.depth, -1, -1):
+            self.levels[level][i] ^= delta
+            i //= self.fanout
+
+    def hash(self, level, i):
+        return self.levels[level][i]
+
+    def children(self, level, i):
+        return xrange(i * self.fanout, (i + 1) * self.fanout)
+
+    def keys(self, leaf):
+        return list(self.buckets.get(leaf, ()))
+
+class AntiEntropy(object):
+    '''
+    Keeps a KVStore's replicas from drifting apart, whatever broadcasts
+    got lost on the way.
+
+    Every heartbeat we send each of our row and column peers the root
+    of our Merkle tree.  Wherever the two trees disagree, the peer
+    answers with the hashes one level down under the nodes that
+    differ, and so on back and forth, until whoever reaches the
+    leaves sends its entries in the differing leaves and asks for the
+    other side's.  KVStore.merge sorts out which versions win.  So
+    repairs cost bytes in proportion to the number of differences
+    times the depth of the tree, and a peer that's in sync costs one
+    small message.
+    '''
+    def __init__(self, kv, chunk=256):
+        self.kv = kv
+        self.bc = kv.bc
+        self.tree = kv.tree
+        self.chunk = chunk # leaves per 'sync' message
+        self.bc.register('merkle', self.handle_msg_merkle)
+        self.bc.timer += self.tick
+
+    def tick(self):
+        if self.bc.clock is None:
+            return
+        peers = self.bc.peers
+        for pid in peers:
+            self.send(pid, peers, merkle='digest', level=0,
+                      nodes=[[0, self.tree.hash(0, 0)]])
+
+    def send(self, pid, peers=None, **kwargs):
+        msg = self.bc.mkmsg('merkle')
+        msg.update(kwargs)
+        self.bc.sendmsg(msg, pid, peers)
+
+    def handle_msg_merkle(self, msg, addr, reply):
+        pid = msg['id'][0]
+        if msg['merkle'] == 'digest':
+            self.handle_digest(pid, msg['level'], msg['nodes'])
+        elif msg['merkle'] == 'sync':
+            self.kv.merge(msg['kv'])
+            if msg.get('want', None):
+                self.sendsync(pid, msg['want'], False)
+
+    def handle_digest(self, pid, level, nodes):
+        tree = self.tree
+        diff = [i for i, h in nodes if tree.hash(level, i) != h]
+        if not diff:
+            return
+        if level == tree.depth:
+            self.sendsync(pid, diff, True)
+            return
+        down = []
+        for i in diff:
+            for c in tree.children(level, i):
+                down.append([c, tree.hash(level + 1, c)])
+        self.send(pid, merkle='digest', level=level + 1, nodes=down)
+
+    def sendsync(self, pid, leaves, want):
+        # our entries in leaves, and (if want) a request for theirs
+        for n in xrange(0, len(leaves), self.chunk):
+            part = leaves[n:n + self.chunk]
+            entries = self.kv.entries([k for leaf in part for k in self.tree.keys(leaf)])
+            kw = {'kv': entries}
+            if want:
+                kw['want'] = part
+            self.send(pid, merkle='sync', **kw)
@@ -0,0 +1,235 @@
+import json
+import math
+import time
+import threading
+import traceback
+import BaseHTTPServer
+
+class Histogram(object):
+    '''
+    Counts of values (seconds, usually) in power-of-two buckets, from
+    a microsecond up to about a day: bucket i holds values below
+    2**i microseconds.  Fixed size, and observe() is a frexp and an
+    add, so it's fine to feed it every message.
+    '''
+    BUCKETS = 38
+    UNIT = 1e-6
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.n = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, v):
+        i = math.frexp(v / self.UNIT)[1] if v > 0 else 0
+        self.counts[max(0, min(i, self.BUCKETS - 1))] += 1
+        self.n += 1
+        self.sum += v
+        if v > self.max:
+            self.max = v
+
+    def quantile(self, q):
+        # the top of the bucket the q'th value's in; never more than
+        # twice the real thing
+        if not self.n:
+            return None
+        want = q * self.n
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if c and seen >= want:
+                return min(self.max, (1 << i) * self.UNIT)
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.n,
+            'sum': self.sum,
+            'mean': self.sum / self.n if self.n else None,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+            # bucket upper bound (in seconds) -> count, empties left out
+            'buckets': dict(('%g' % ((1 << i) * self.UNIT), c)
+                            for i, c in enumerate(self.counts) if c),
+        }
+
+class Metrics(object):
+    '''
+    What a node's been up to, counted as it happens.
+
+    Three kinds of thing:
+
+      counters, by name, that only go up: count('tcp.accepts')
+      traffic, messages and bytes in and out by message type and by
+          peer address: traffic('in', 'data', addr, len(frame))
+      histograms, by name, of durations: observe('lock.wait', 0.02),
+          or wrap a function with timed() to time every call
+
+    and gauges, functions that are only called when somebody takes a
+    snapshot, for things like queue depths that are already being
+    kept track of anyway.
+
+    snapshot() is everything, as a json-friendly dict; serve() puts
+    that up over HTTP on localhost, for poking at with curl.
+
+    Anything that's instrumented takes NULL when nobody's asked for
+    metrics, which does nothing at all, and checks enabled before
+    doing anything that costs more than a call.
+    '''
+    enabled = True
+
+    def __init__(self, clock=time.time):
+        self.clock = clock # only for stamping snapshots
+        self.lock = threading.Lock()
+        self.gauges = {}
+        self.server = None
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.types = {'in': {}, 'out': {}} # direction -> type -> [msgs, bytes]
+            self.peers = {'in': {}, 'out': {}} # direction -> addr -> [msgs, bytes]
+            self.hists = {}
+            self.since = self.clock()
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def traffic(self, direction, msgtype, peer, nbytes):
+        with self.lock:
+            t = self.types[direction].get(msgtype, None)
+            if t is None:
+                t = self.types[direction][msgtype] = [0, 0]
+            t[0] += 1
+            t[1] += nbytes
+            p = self.peers[direction].get(peer, None)
+            if p is None:
+                p = self.peers[direction][peer] = [0, 0]
+            p[0] += 1
+            p[1] += nbytes
+
+    def observe(self, name, value):
+        with self.lock:
+            h = self.hists.get(name, None)
+            if h is None:
+                h = self.hists[name] = Histogram()
+            h.observe(value)
+
+    def timed(self, name, func):
+        '''
+        func, but every call's wall-clock time goes into histogram
+        name.
+        '''
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.observe(name, time.time() - start)
+        return timed
+
+    def gauge(self, name, func):
+        '''
+        Have snapshot() report func() as name.
+        '''
+        self.gauges[name] = func
+
+    @staticmethod
+    def peername(addr):
+        if isinstance(addr, tuple) and len(addr) == 2:
+            return '%s:%s' % addr
+        return str(addr)
+
+    def snapshot(self):
+        with self.lock:
+            snap = {
+                'time': self.clock(),
+                'since': self.since,
+                'counters': dict(self.counters),
+                'types': dict((d, dict((t, {'msgs': c[0], 'bytes': c[1]})
+                                       for t, c in ts.items()))
+                              for d, ts in self.types.items()),
+                'peers': dict((d, dict((self.peername(a), {'msgs': c[0], 'bytes': c[1]})
+                                       for a, c in ps.items()))
+                              for d, ps in self.peers.items()),
+                'histograms': dict((n, h.snapshot()) for n, h in self.hists.items()),
+            }
+        gauges = {}
+        for name, func in self.gauges.items():
+            try:
+                gauges[name] = func()
+            except Exception as e:
+                print traceback.format_exc()
+        snap['gauges'] = gauges
+        return snap
+
+    def serve(self, port=0, host='127.0.0.1'):
+        '''
+        Serve snapshot() as json, to GET on any path, from a thread
+        of its own.  Returns the port it's on.  Only on localhost
+        unless you say otherwise, since it tells anyone who asks who
+        this node talks to.
+        '''
+        metrics = self
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = json.dumps(metrics.snapshot(), indent=2, sort_keys=True)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+        self.server = BaseHTTPServer.HTTPServer((host, port), Handler)
+        t = threading.Thread(target=self.server.serve_forever)
+        t.daemon = True
+        t.start()
+        return self.server.server_address[1]
+
+    def shutdown(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+class NullMetrics(object):
+    '''
+    Metrics that aren't kept.
+    '''
+    enabled = False
+
+    def count(self, name, n=1):
+        pass
+
+    def traffic(self, direction, msgtype, peer, nbytes):
+        pass
+
+    def observe(self, name, value):
+        pass
+
+    def timed(self, name, func):
+        return func
+
+    def gauge(self, name, func):
+        pass
+
+    def reset(self):
+        pass
+
+    def snapshot(self):
+        return {}
+
+    def serve(self, port=0, host='127.0.0.1'):
+        raise RuntimeError("metrics are off")
+
+    def shutdown(self):
+        pass
+
+NULL = NullMetrics()
@@ -1,47 +1,156 @@
-import heapq
+import math
+import time
 import threading
+import collections
 
 class MRQ(object):
     '''
     A most-recently-seen queue.
 
     Keeps track of the N most-recently-seen objects, with quick
-    member testing.
+    member testing.  Optionally objects also age out after maxage
+    seconds.  Everything (add, touch, evict, membership) is O(1):
+    it's just an OrderedDict kept in least- to most-recently-seen
+    order, mapping each object to when we last saw it.
     '''
-    def __init__(self, limit=50):
+    def __init__(self, limit=50, maxage=None):
         self.limit = limit
-        self.count = 0
-        self.list = []
-        self.set = set()
+        self.maxage = maxage
+        self.seen = collections.OrderedDict()
         self.lock = threading.RLock()
 
+    @property
+    def count(self):
+        return len(self.seen)
+
     def add(self, obj):
+        '''
+        Mark obj as seen.  Returns True if it's new to us.
+        '''
+        now = time.time()
         with self.lock:
-            if obj in self.set:
-                # this is slow...
-                self.list.remove(obj)
-                self.list.append(obj)
-                return
-            self.list.append(obj)
-            self.set.add(obj)
-            self.count += 1
+            new = self.pop(obj, now) is None
+            self.seen[obj] = now
+            self.expire(now)
+            return new
+
+    def pop(self, obj, now):
+        # when we last saw obj, if it still counts as seen
+        t = self.seen.pop(obj, None)
+        if t is not None and self.maxage is not None and now - t > self.maxage:
+            return None
+        return t
 
     def remove(self):
         with self.lock:
-            o = self.list[0]
-            self.list = self.list[1:]
-            self.set.remove(o)
-            self.count -= 1        
+            self.seen.popitem(last=False)
 
-    def __iadd__(self, obj):
+    def expire(self, now=None):
         with self.lock:
-            self.add(obj)
-            while self.count > self.limit:
-                self.remove()
+            while len(self.seen) > self.limit:
+                self.seen.popitem(last=False)
+            if self.maxage is None:
+                return
+            now = now or time.time()
+            while self.seen:
+                obj = next(iter(self.seen))
+                if now - self.seen[obj] <= self.maxage:
+                    break
+                self.seen.popitem(last=False)
+
+    def __iadd__(self, obj):
+        self.add(obj)
         return self
 
     def __contains__(self, obj):
-        return obj in self.set
+        t = self.seen.get(obj, None)
+        if t is None:
+            return False
+        return self.maxage is None or time.time() - t <= self.maxage
+
+    def __len__(self):
+        return len(self.seen)
 
     def __iter__(self):
-        return self.list.__iter__()
+        return iter(self.seen.keys())
+
+class Bloom(object):
+    '''
+    A plain Bloom filter over a bytearray, sized for n entries at the
+    given false-positive rate.
+    '''
+    def __init__(self, n, fprate):
+        self.bits = max(8, int(-n * math.log(fprate) / (math.log(2) ** 2)))
+        self.hashes = max(1, int(round(float(self.bits) / n * math.log(2))))
+        self.array = bytearray((self.bits + 7) // 8)
+        self.count = 0
+
+    def probes(self, obj):
+        # double hashing: h1 + i*h2 covers k probes from two hashes
+        h1 = hash(obj)
+        h2 = hash((obj, 0x9e3779b9)) | 1
+        for i in xrange(self.hashes):
+            yield (h1 + i * h2) % self.bits
+
+    def add(self, obj):
+        for b in self.probes(obj):
+            self.array[b >> 3] |= 1 << (b & 7)
+        self.count += 1
+
+    def __contains__(self, obj):
+        for b in self.probes(obj):
+            if not self.array[b >> 3] & (1 << (b & 7)):
+                return False
+        return True
+
+class BloomMRQ(object):
+    '''
+    A drop-in MRQ for very high flood rates, built from two rotating
+    Bloom filters.
+
+    New objects go into the current filter; once it holds limit
+    objects (or is older than maxage seconds) it becomes the previous
+    filter and a fresh one takes over, so anything seen within the
+    last limit..2*limit objects is remembered.  Memory is fixed at
+    two filters no matter the traffic.  The price is that a
+    never-seen object is reported as seen about 2*fprate of the time.
+    '''
+    def __init__(self, limit=50, maxage=None, fprate=0.001):
+        self.limit = limit
+        self.maxage = maxage
+        self.fprate = fprate
+        self.lock = threading.RLock()
+        self.old = Bloom(limit, fprate)
+        self.cur = Bloom(limit, fprate)
+        self.born = time.time()
+
+    @property
+    def count(self):
+        return self.old.count + self.cur.count
+
+    def rotate(self, now):
+        self.old = self.cur
+        self.cur = Bloom(self.limit, self.fprate)
+        self.born = now
+
+    def add(self, obj):
+        now = time.time()
+        with self.lock:
+            if self.cur.count >= self.limit or \
+                    (self.maxage is not None and now - self.born > self.maxage):
+                self.rotate(now)
+            if obj in self.cur:
+                return False
+            new = obj not in self.old
+            self.cur.add(obj) # refresh it, so it survives the next rotation
+            return new
+
+    def __iadd__(self, obj):
+        self.add(obj)
+        return self
+
+    def __contains__(self, obj):
+        return obj in self.cur or obj in self.old
+
+    def __len__(self):
+        return self.count
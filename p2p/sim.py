@@ -0,0 +1,331 @@
+import heapq
+import random
+import itertools
+
+import event
+import timer
+import codec
+
+class SimConn(object):
+    '''
+    One end of a simulated connection; quacks like a tcp.Conn.
+    '''
+    def __init__(self, host, addr):
+        self.host = host        # the SimTransport this end belongs to
+        self.addr = addr
+        self.peer = None        # the other end, once connected
+        self.closed = False
+        self.connecting = False
+        self.established = True
+        self.last = self.lastsent = host.net.now
+        self.queued = []        # frames sent before we were connected
+        self.arrives = 0        # when the last frame sent on it lands
+        self.serial = next(host.net.serials)
+
+    def __hash__(self):
+        # by creation order, not address, so that runs repeat exactly
+        return self.serial
+
+    def getpeername(self):
+        return self.addr
+
+    def depth(self):
+        return len(self.queued)
+
+class SimTransport(object):
+    '''
+    A node's view of a Network; stands in for tcp.TCP.
+    '''
+    inline = True
+
+    def __init__(self, net, ip, port):
+        self.net = net
+        self.ip = ip
+        self.port = port
+        self.addr = (ip, port)
+        self.handlers = event.Event()
+        self.connected = event.Event()
+        self.disconnected = event.Event()
+        self.conns = set()
+        self.listening = False
+        self.txfree = 0 # when our uplink's free, for bandwidth limits
+        self.ports = itertools.count(40000)
+
+    @property
+    def clock(self):
+        return self.net.time
+
+    @property
+    def wheel(self):
+        return self.net.wheel
+
+    @property
+    def random(self):
+        return self.net.random
+
+    def start(self):
+        self.listening = True
+
+    def shutdown(self):
+        self.listening = False
+        for conn in list(self.conns):
+            self.drop(conn)
+
+    def connect_async(self, addr, timeout=5):
+        conn = SimConn(self, tuple(addr))
+        conn.connecting = True
+        conn.established = False
+        self.conns.add(conn)
+        self.net.later(self.net.delay(), self.net.accept, conn, timeout)
+        return conn
+
+    def send(self, data, conn, bulk=False):
+        if conn.closed:
+            return
+        conn.last = conn.lastsent = self.net.now
+        if conn.connecting:
+            conn.queued.append(data)
+            return
+        self.net.transmit(conn, data)
+
+    def drop(self, conn):
+        if conn.closed:
+            return
+        conn.closed = True
+        self.conns.discard(conn)
+        self.disconnected.fire(conn, conn.addr)
+        peer = conn.peer
+        if peer is not None and not peer.closed:
+            self.net.later(self.net.delay(), peer.host.drop, peer)
+
+    def depth(self, conn):
+        return conn.depth()
+
+class Network(object):
+    '''
+    A discrete-event simulation of a network, for running lots of
+    Broadcasters in one thread in virtual time.
+
+    Every node gets a SimTransport (pass it as transport= to the
+    Broadcaster), all sharing this network's clock, timing wheel and
+    random numbers, and with no threads anywhere: run() pops events
+    (frames arriving, connections coming up) and due timers off in
+    time order and handles each to completion before the next.  So a
+    thousand nodes cost a thousand nodes' worth of CPU, not a thousand
+    nodes' worth of threads, and a run is the same every time for the
+    same seed.
+
+    Each frame takes latency seconds (plus up to jitter more) to
+    arrive, after waiting its turn for the sender's uplink if there's
+    a bandwidth (bytes/second).  Frames on a connection arrive in the
+    order they were sent.  loss throws that fraction of frames away
+    outright; partition() cuts the network into groups that can't
+    reach each other (frames between them vanish, and connections
+    between them can't be made) until heal().
+
+    stats counts frames and bytes sent, delivered and lost, and
+    frames and bytes by message type.
+    '''
+    def __init__(self, seed=0, latency=0.001, jitter=0.0, bandwidth=None,
+                 loss=0.0, tick=0.01):
+        self.random = random.Random(seed)
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.loss = loss
+        self.now = 0.0
+        self.events = [] # heap of (when, seq, func, args)
+        self.seq = itertools.count()
+        self.serials = itertools.count()
+        self.wheel = timer.Wheel(tick, clock=self.time, manual=True, rng=self.random)
+        self.hosts = {}  # ip -> SimTransport
+        self.groups = None # ip -> partition group, while partitioned
+        self.stats = {'frames': 0, 'bytes': 0, 'delivered': 0, 'lost': 0,
+                      'types': {}}
+
+    def time(self):
+        return self.now
+
+    def transport(self, port=6966):
+        '''
+        A new node's transport, at an address of its own.
+        '''
+        n = len(self.hosts) + 1
+        ip = '10.%d.%d.%d' % (n >> 16 & 255, n >> 8 & 255, n & 255)
+        t = SimTransport(self, ip, port)
+        self.hosts[ip] = t
+        return t
+
+    def later(self, delay, func, *args):
+        heapq.heappush(self.events, (self.now + delay, next(self.seq), func, args))
+
+    def delay(self):
+        if self.jitter:
+            return self.latency + self.random.uniform(0, self.jitter)
+        return self.latency
+
+    def reachable(self, a, b):
+        return self.groups is None or self.groups.get(a) == self.groups.get(b)
+
+    def partition(self, *groups):
+        '''
+        Split the network: each group is a list of addresses (or
+        transports), and anyone left out is in a group of their own.
+        '''
+        self.groups = {}
+        for i, g in enumerate(groups):
+            for h in g:
+                ip = h.ip if isinstance(h, SimTransport) else h[0]
+                self.groups[ip] = i
+        for i, ip in enumerate(self.hosts):
+            self.groups.setdefault(ip, len(groups) + i)
+
+    def heal(self):
+        self.groups = None
+
+    def accept(self, conn, timeout):
+        host = conn.host
+        dst = self.hosts.get(conn.addr[0], None)
+        if conn.closed:
+            return
+        if dst is None or not dst.listening or conn.addr[1] != dst.port:
+            self.later(self.delay(), host.drop, conn) # refused
+            return
+        if not self.reachable(host.ip, dst.ip):
+            self.later(max(0, timeout - self.latency), host.drop, conn)
+            return
+        other = SimConn(dst, (host.ip, next(host.ports)))
+        other.peer = conn
+        conn.peer = other
+        dst.conns.add(other)
+        dst.connected.fire(other)
+        # and the other way, the connection's up
+        self.later(self.delay(), self.connected, conn)
+
+    def connected(self, conn):
+        if conn.closed:
+            return
+        conn.connecting = False
+        conn.established = True
+        conn.host.connected.fire(conn)
+        queued, conn.queued = conn.queued, []
+        for data in queued:
+            self.transmit(conn, data)
+
+    def transmit(self, conn, data):
+        host = conn.host
+        stats = self.stats
+        stats['frames'] += 1
+        stats['bytes'] += len(data) + 4
+        t = self.msgtype(data)
+        count = stats['types'].setdefault(t, [0, 0])
+        count[0] += 1
+        count[1] += len(data) + 4
+        peer = conn.peer
+        if peer is None or peer.closed or not self.reachable(host.ip, peer.host.ip) \
+                or (self.loss and self.random.random() < self.loss):
+            stats['lost'] += 1
+            return
+        start = self.now
+        if self.bandwidth:
+            start = max(start, host.txfree)
+            host.txfree = start + (len(data) + 4) / float(self.bandwidth)
+            start = host.txfree
+        # frames on one connection never overtake each other
+        conn.arrives = max(start + self.delay(), conn.arrives)
+        heapq.heappush(self.events, (conn.arrives, next(self.seq),
+                                     self.deliver, (peer, data)))
+
+    def deliver(self, conn, data):
+        if conn.closed:
+            return
+        self.stats['delivered'] += 1
+        conn.last = self.now
+        conn.host.handlers.fire(data, conn)
+
+    @staticmethod
+    def msgtype(data):
+        if data[:1] == codec.BinaryCodec.MAGIC:
+            t = codec.BinaryCodec.TYPES[ord(data[1])]
+            if t:
+                return t
+        try:
+            return codec.Envelope.decode(data)['type']
+        except Exception:
+            return None
+
+    def run(self, duration=None, until=None, stop=None):
+        '''
+        Run the simulation for duration seconds (or until time until),
+        or until stop() is true, or until there's nothing left to do.
+        stop is checked after every event.  Returns how many events
+        and timer ticks it handled.
+        '''
+        if duration is not None:
+            until = self.now + duration
+        steps = 0
+        while not (stop and stop()):
+            due = self.wheel.nextdue()
+            when = self.events[0][0] if self.events else None
+            if due is not None and (when is None or due[1] <= when):
+                if until is not None and due[1] > until:
+                    break
+                self.now = max(self.now, due[1])
+                self.wheel.advance(tick=due[0])
+            elif when is not None:
+                if until is not None and when > until:
+                    break
+                when, _, func, args = heapq.heappop(self.events)
+                self.now = max(self.now, when)
+                func(*args)
+            else:
+                break
+            steps += 1
+        if until is not None and not (stop and stop()):
+            self.now = max(self.now, until)
+        return steps
+
+def lace(net, n, join=False, gap=0.05, **kwargs):
+    '''
+    n started Broadcasters on net, in a full lace, the first one its
+    base.  With join=True each one joins for real, through the first,
+    gap seconds apart (and every join floods the network, so that's
+    slow for big n).  Otherwise the lace is laid out directly, just as
+    n joins would have left it (places, peers, lace_max and forked
+    clocks) but without a message sent, to study what happens after.
+    kwargs go to every Broadcaster.
+    '''
+    import broadcaster
+    first = broadcaster.Broadcaster(transport=net.transport(), **kwargs)
+    first.base()
+    first.start()
+    nodes = [first]
+    if join:
+        for i in xrange(n - 1):
+            b = broadcaster.Broadcaster([first.tcp.addr], transport=net.transport(), **kwargs)
+            b.start()
+            nodes.append(b)
+            net.run(gap)
+        return nodes
+    value = first.value
+    for i in xrange(1, n):
+        b = broadcaster.Broadcaster(transport=net.transport(), **kwargs)
+        value = first.get_next_addr(value)
+        b.value = value
+        # fork clocks down a balanced tree, so no id gets too deep
+        parent = nodes[(i - 1) // 2]
+        parent.clock, b.clock = parent.clock.fork()
+        nodes.append(b)
+    for b in nodes:
+        b.lace_max = value
+    rows, cols = {}, {}
+    for b in nodes:
+        rows.setdefault(b.value[1], []).append(b)
+        cols.setdefault(b.value[0], []).append(b)
+    for b in nodes:
+        for o in rows[b.value[1]] + cols[b.value[0]]:
+            if o is not b:
+                b.setpeer(o.uuid, addr=o.tcp.addr, value=o.value)
+        if b is not first:
+            b.start()
+    return nodes
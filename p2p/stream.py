@@ -0,0 +1,299 @@
+import json
+import time
+import uuid
+import threading
+import tempfile
+import traceback
+import collections
+
+import event
+
+class Incoming(object):
+    '''
+    One transfer being put back together.
+    '''
+    def __init__(self, size, info, spool):
+        self.size = size
+        self.info = info
+        self.file = tempfile.SpooledTemporaryFile(spool)
+        self.have = set() # offsets we've got
+        self.got = 0
+        self.last = time.time()
+
+class Streams(object):
+    '''
+    Moves payloads too big to send as one message.
+
+    A stream is cut into CHUNK byte 'chunk' messages, which carry the
+    raw bytes as a blob and travel like any other message, except
+    that the transport queues them in a bulk lane of their own (see
+    tcp.OutQueue), so lock traffic and the like goes straight past
+    them.  The sender doesn't read ahead of the slowest connection by
+    more than WINDOW bytes, so pushing out a huge file costs about
+    WINDOW bytes of memory per connection, not the size of the file.
+
+    Along the broadcast tree (or to the one peer a stream's for) each
+    hop also holds itself to CREDIT chunks of a transfer that the
+    next hop hasn't acked yet, and a relay only acks a chunk once it's
+    passed it on, from a thread per transfer that waits on its own
+    next hops the same way.  So a slow link anywhere slows the
+    transfer down all the way back to the sender, rather than piling
+    it up in memory on the node in front of it, and nothing else on
+    the connections is held up.  Chunks that are being flooded, for a
+    hole in the tree, are the exception: a flood goes round in
+    circles, and relays waiting on each other's acks round a circle
+    would wait forever, so only the sender waits for acks, and relays
+    pass flooded chunks on as fast as the bulk lanes let them.
+
+    Receivers spool the chunks into a temporary file (in memory up to
+    SPOOL bytes, on disk past that) at the offset each one came from,
+    so it doesn't matter which order they turn up in, and when
+    they've all come hand the reactors
+
+        {'stream': file, 'size': bytes, 'info': whatever the sender gave}
+
+    with the file rewound to the start.  Transfers that go quiet for
+    idle seconds are thrown away.
+    '''
+    CHUNK = 64 * 1024
+    WINDOW = 4 * CHUNK
+    SPOOL = 1024 * 1024
+    CREDIT = WINDOW // CHUNK
+
+    def __init__(self, bc, idle=60):
+        self.bc = bc
+        self.idle = idle
+        self.incoming = {} # (origin, xfer) -> Incoming
+        self.lock = threading.Lock()
+        self.relaying = {} # (origin, xfer) -> chunks waiting to be passed on
+        self.unacked = {}  # (peer id, origin, xfer) -> chunks sent it it hasn't acked
+        self.cond = threading.Condition(threading.Lock()) # for both
+        bc.register('chunk', self.handle_msg_chunk, duplicates=self.ack)
+        bc.register('chunkack', self.handle_msg_chunkack)
+        bc.timer += self.reap
+
+    def paced(self):
+        # a transport that delivers as it's sent to has nothing to wait
+        # on, nor threads to do it from
+        return not getattr(self.bc.tcp, 'inline', False)
+
+    def send(self, src, info=None, peer=None):
+        '''
+        Stream src (a string, or anything with a read()) to every node,
+        or just to peer.  This returns straight away; the Future it
+        returns is done once the last chunk has been queued.
+        '''
+        future = event.Future()
+        if isinstance(src, unicode):
+            src = src.encode('utf-8')
+        t = threading.Thread(target=self.pump, args=(src, info, peer, future))
+        t.daemon = True
+        t.start()
+        return future
+
+    def pump(self, src, info, peer, future):
+        try:
+            xfer = uuid.uuid4().int
+            if isinstance(src, str):
+                size = len(src)
+                read = lambda off: src[off:off + self.CHUNK]
+            else:
+                size = self.size(src)
+                read = lambda off: src.read(self.CHUNK)
+            off = 0
+            while True:
+                blob = read(off)
+                msg = self.bc.mkmsg('chunk')
+                msg['xfer'] = xfer
+                msg['off'] = off
+                msg['blob'] = blob
+                if off == 0:
+                    msg['info'] = info
+                if size is not None:
+                    msg['size'] = size
+                elif not blob:
+                    msg['size'] = off # didn't know till now
+                peers = self.bc.peers
+                if peer is not None:
+                    msg['one'] = True
+                    self.sendto(msg, [peer], peers)
+                else:
+                    self.sendto(msg, self.bc.targets(msg, peers), peers)
+                off += len(blob)
+                if not blob or (size is not None and off >= size):
+                    break
+            future.set_result(xfer)
+        except Exception as e:
+            print traceback.format_exc()
+            future.set_exception(e)
+
+    def size(self, f):
+        try:
+            here = f.tell()
+            f.seek(0, 2)
+            end = f.tell()
+            f.seek(here)
+            return end - here
+        except (AttributeError, IOError):
+            return None # a pipe or some such; we'll find out at the end
+
+    def sendto(self, msg, pids, peers):
+        '''
+        Send a chunk to pids, once they've got room for it.
+        '''
+        pids = [pid for pid in pids if pid in peers]
+        credit = 'tree' in msg or msg.get('one', False) or msg['id'][0] == self.bc.uuid
+        if self.paced():
+            if credit:
+                self.wait(msg, pids)
+            self.drain(pids, peers)
+        for pid in pids:
+            if credit and self.paced():
+                key = (pid, msg['id'][0], msg['xfer'])
+                with self.cond:
+                    self.unacked[key] = self.unacked.get(key, 0) + 1
+            self.bc.sendmsg(msg, pid, peers)
+
+    def wait(self, msg, pids):
+        # till none of pids has CREDIT of msg's transfer unacked, or
+        # has gone; one that doesn't ack for idle seconds gets a fresh
+        # start, rather than the transfer stalling for good
+        xfer = (msg['id'][0], msg['xfer'])
+        end = time.time() + self.idle
+        with self.cond:
+            while True:
+                peers = self.bc.peers
+                full = [pid for pid in pids if pid in peers and
+                        self.unacked.get((pid,) + xfer, 0) >= self.CREDIT]
+                left = end - time.time()
+                if not full:
+                    return
+                if left <= 0:
+                    for pid in full:
+                        del self.unacked[(pid,) + xfer]
+                    return
+                self.cond.wait(min(left, 1.0)) # and look for departures now and then
+
+    def drain(self, pids, peers):
+        # wait for room in the bulk lanes to pids, whatever else is
+        # being streamed to them
+        for pid in pids:
+            pl = peers.get(pid, None)
+            c = pl and pl['addr'] and self.bc.conns.peek(pl['addr'])
+            if c is not None:
+                c.outq.wait_bulk(self.WINDOW, self.idle)
+
+    def ack(self, msg):
+        # tell whoever sent us msg it's done with here
+        if msg.conn is None or not self.paced():
+            return
+        ack = self.bc.mkmsg('chunkack')
+        ack['origin'] = msg['id'][0]
+        ack['xfer'] = msg['xfer']
+        self.bc.sendmsg_conn(ack, msg.conn)
+
+    def handle_msg_chunkack(self, msg, addr, reply):
+        key = (msg['id'][0], msg['origin'], msg['xfer'])
+        with self.cond:
+            n = self.unacked.pop(key, 0) - 1
+            if n > 0:
+                self.unacked[key] = n
+            self.cond.notify_all()
+
+    def forward(self, msg):
+        '''
+        Pass a chunk on, from its transfer's own thread, which waits
+        till the next hops have room for it and then acks it.
+        '''
+        if not self.paced():
+            self.bc.relay(msg) # nothing to wait on, nor a thread to do it
+            return
+        peers = self.bc.peers
+        pids = self.bc.targets(msg, peers)
+        if not pids:
+            self.ack(msg)
+            return
+        xfer = (msg['id'][0], msg['xfer'])
+        with self.cond:
+            q = self.relaying.get(xfer, None)
+            if q is not None:
+                q.append((msg, pids, peers))
+                return
+            self.relaying[xfer] = collections.deque([(msg, pids, peers)])
+        t = threading.Thread(target=self.relay_loop, args=(xfer,))
+        t.daemon = True
+        t.start()
+
+    def relay_loop(self, xfer):
+        # one per transfer, so none is kept waiting on the hops another
+        # is waiting on; gone once it's caught up
+        while True:
+            with self.cond:
+                q = self.relaying[xfer]
+                if not q:
+                    del self.relaying[xfer]
+                    return
+                msg, pids, peers = q.popleft()
+            try:
+                self.sendto(msg, pids, peers)
+            except Exception as e:
+                print traceback.format_exc()
+            self.ack(msg)
+
+    def handle_msg_chunk(self, msg, addr, reply):
+        origin = msg['id'][0]
+        if msg.get('one', False) or origin == self.bc.uuid:
+            self.ack(msg)
+        else:
+            self.forward(msg)
+        if origin == self.bc.uuid:
+            return
+        key = (origin, msg['xfer'])
+        with self.lock:
+            inc = self.incoming.get(key, None)
+            if inc is None:
+                inc = self.incoming[key] = Incoming(None, None, self.SPOOL)
+            off = msg['off']
+            if off in inc.have:
+                return
+            inc.have.add(off)
+            blob = msg['blob']
+            if blob:
+                inc.file.seek(off)
+                inc.file.write(blob)
+            inc.got += len(blob)
+            inc.last = time.time()
+            if 'info' in msg:
+                inc.info = msg['info']
+            if 'size' in msg:
+                inc.size = msg['size']
+            if inc.size is None or inc.got < inc.size:
+                return
+            del self.incoming[key]
+        inc.file.seek(0)
+        self.deliver(inc, reply, msg)
+
+    def deliver(self, inc, reply, msg):
+        info = inc.info or {}
+        if isinstance(info, dict) and info.get('data', None) == 'json':
+            # something send() streamed for being too big; hand it
+            # over just as if it had come in one message
+            data = json.load(inc.file)
+            inc.file.close()
+        else:
+            data = {'stream': inc.file, 'size': inc.size, 'info': inc.info}
+        self.bc.handlers.poolfire(data, reply=reply, msg=msg)
+
+    def reap(self):
+        now = time.time()
+        with self.lock:
+            for key, inc in self.incoming.items():
+                if now - inc.last > self.idle:
+                    del self.incoming[key]
+                    inc.file.close()
+        peers = self.bc.peers
+        with self.cond:
+            # acks that'll never come, from peers that are gone
+            for key in self.unacked.keys():
+                if key[0] not in peers:
+                    del self.unacked[key]
@@ -1,15 +1,278 @@
 import socket
 import errno
 import thread
+import threading
+import time
 import struct
+import collections
 
 from event import Event
+from metrics import NULL
+import loop
+
+class FrameReader(object):
+    '''
+    Incremental parser for length-prefixed frames.
+
+    Reads land straight in one reusable bytearray via recv_into(),
+    and every complete frame sitting in the buffer comes out of a
+    single frames() call, so a big payload is copied once on the way
+    out rather than once per recv().  The read size grows while the
+    socket keeps filling it and shrinks back when traffic is small.
+    '''
+    MINREAD = 4096
+    MAXREAD = 1 << 20
+
+    def __init__(self):
+        self.buf = bytearray(self.MINREAD)
+        self.start = 0      # first byte not yet handed out
+        self.end = 0        # end of the bytes we've read
+        self.want = 0       # total size of the frame we're stuck on
+        self.readsize = self.MINREAD
+
+    def pending(self):
+        return self.end - self.start
+
+    def room(self):
+        need = max(self.readsize, self.want - self.pending())
+        if len(self.buf) - self.end >= need:
+            return
+        size = self.pending()
+        cap = len(self.buf)
+        if size + need > cap:
+            cap = max(cap * 2, size + need)
+        elif cap > self.MAXREAD * 4 and size + need <= self.MAXREAD:
+            cap = self.MAXREAD # give back the memory from a huge frame
+        if cap != len(self.buf):
+            buf = bytearray(cap)
+            buf[0:size] = self.buf[self.start:self.end]
+            self.buf = buf
+        else:
+            self.buf[0:size] = self.buf[self.start:self.end]
+        self.start = 0
+        self.end = size
+
+    def fill(self, sock):
+        '''
+        One recv_into() on sock.  Raises EOFError when the peer hangs
+        up; socket errors (including EAGAIN) are left to the caller.
+        '''
+        self.room()
+        space = len(self.buf) - self.end
+        view = memoryview(self.buf)
+        try:
+            n = sock.recv_into(view[self.end:], space)
+        finally:
+            del view
+        if n == 0:
+            raise EOFError
+        self.end += n
+        if n == space or n >= self.readsize:
+            self.readsize = min(self.readsize * 2, self.MAXREAD)
+        elif n < self.readsize / 4:
+            self.readsize = max(self.readsize / 2, self.MINREAD)
+        return n
+
+    def frames(self):
+        '''
+        Every complete frame in the buffer, as a list of strings.
+        '''
+        out = []
+        view = memoryview(self.buf)
+        while self.end - self.start >= 4:
+            size = struct.unpack_from("!I", self.buf, self.start)[0]
+            if self.end - self.start - 4 < size:
+                self.want = size + 4
+                break
+            out.append(view[self.start + 4:self.start + 4 + size].tobytes())
+            self.start += 4 + size
+            self.want = 0
+        del view
+        if self.start == self.end:
+            self.start = self.end = 0
+        return out
+
+class OutQueue(object):
+    '''
+    Frames waiting to go out on one connection.
+
+    Senders only ever append here; a single writer drains it.  Every
+    frame queued since the last write is coalesced into one buffer
+    (up to COALESCE bytes) and handed to a single send(), and short
+    writes just leave the rest of that buffer for next time.
+
+    Bulk frames (pieces of a streamed transfer) wait in a lane of
+    their own, and at most one of them goes into each write, after
+    whatever control frames are waiting.  So a small message never
+    queues behind more than one bulk frame, however much bulk there
+    is, and a bulk sender can wait_bulk() for the lane to drain
+    rather than piling the whole transfer up in memory.
+    '''
+    COALESCE = 256 * 1024
+
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.parts = collections.deque()
+        self.bulk = collections.deque() # whole bulk frames, joined
+        self.frames = 0     # frames not yet completely written
+        self.bytes = 0      # bytes not yet written
+        self.bulkbytes = 0  # bulk bytes not yet handed to the writer
+        self.out = None     # what's left of the buffer being written
+        self.outframes = 0  # how many frames went into self.out
+        self.closed = False
+
+    def put(self, *parts, **kwargs):
+        '''
+        Queue one frame, given as its pieces.  Returns True if the
+        queue was idle, i.e. the writer needs a kick.
+        '''
+        with self.cond:
+            idle = not self.bytes
+            if kwargs.get('bulk', False):
+                frame = "".join(parts)
+                self.bulk.append(frame)
+                self.bulkbytes += len(frame)
+                self.bytes += len(frame)
+            else:
+                for p in parts:
+                    self.parts.append(p)
+                    self.bytes += len(p)
+                self.parts.append(None) # end of frame
+            self.frames += 1
+            self.cond.notify_all()
+            return idle
+
+    def chunk(self):
+        '''
+        The next bytes to write, or None if there's nothing to do.
+        '''
+        with self.cond:
+            if self.out is not None:
+                return self.out
+            if not self.parts and not self.bulk:
+                return None
+            pieces = []
+            size = 0
+            while self.parts and size < self.COALESCE:
+                p = self.parts.popleft()
+                if p is None:
+                    self.outframes += 1
+                    continue
+                pieces.append(p)
+                size += len(p)
+            while self.parts and self.parts[0] is None:
+                self.parts.popleft()
+                self.outframes += 1
+            if self.bulk and size < self.COALESCE:
+                frame = self.bulk.popleft()
+                self.bulkbytes -= len(frame)
+                pieces.append(frame)
+                self.outframes += 1
+                self.cond.notify_all()
+            self.out = memoryview("".join(pieces))
+            return self.out
+
+    def sent(self, n):
+        with self.cond:
+            self.bytes -= n
+            if n < len(self.out):
+                self.out = self.out[n:]
+                return
+            self.out = None
+            self.frames -= self.outframes
+            self.outframes = 0
+
+    def depth(self):
+        return self.frames
+
+    def wait_bulk(self, limit, timeout=None):
+        '''
+        Wait until fewer than limit bulk bytes are queued.  Returns
+        False if that didn't happen in time, or the queue was closed.
+        '''
+        end = None if timeout is None else time.time() + timeout
+        with self.cond:
+            while self.bulkbytes >= limit and not self.closed:
+                left = None if end is None else end - time.time()
+                if left is not None and left <= 0:
+                    return False
+                self.cond.wait(left)
+            return not self.closed
+
+class Conn(object):
+    '''
+    A connected peer socket, plus whatever buffering the transport
+    needs for it.  Quacks enough like a socket (fileno, getpeername)
+    that nobody upstream has to care which transport they're on.
+    '''
+    def __init__(self, sock, addr=None):
+        self.sock = sock
+        self.fd = sock.fileno()
+        try:
+            self.addr = sock.getpeername()
+        except socket.error:
+            self.addr = addr
+        self.reader = FrameReader()
+        self.outq = OutQueue()
+        self.closed = False
+        self.connecting = False # still waiting on a connect_async()
+        self.established = True # ever actually got connected
+        self.last = time.time() # last time anything went in or out
+        self.lastsent = 0       # last time we queued anything to go out
+
+    def fileno(self):
+        return self.fd
+
+    def getpeername(self):
+        return self.addr
+
+    def depth(self):
+        '''
+        Frames queued on this connection that haven't hit the wire.
+        '''
+        return self.outq.depth()
+
+    def close(self):
+        '''
+        Returns True for whoever actually closed it.
+        '''
+        with self.outq.cond:
+            if self.closed:
+                return False
+            self.closed = self.outq.closed = True
+            self.outq.cond.notify_all()
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+        return True
 
 class TCP(object):
-    def __init__(self, port):
+    '''
+    Length-prefixed message transport.
+
+    By default every connection gets its own thread blocking in
+    recv().  With evloop=True all connections are served from a
+    single loop.Loop thread instead; handlers then run on the loop
+    thread.
+
+    Either way send() never touches the socket: frames go on the
+    connection's OutQueue and are written out by a writer thread (or
+    the loop, when the socket is writable), so nothing upstream blocks
+    on a slow peer.
+
+    metrics (see metrics.py) counts connections coming and going, and
+    reads and writes on the sockets and how many bytes they moved.
+    '''
+    def __init__(self, port, evloop=False, metrics=NULL):
         self.port = port
+        self.metrics = metrics
         self.handlers = Event()
         self.connected = Event()
+        self.disconnected = Event()
+        self.loop = None
+        if evloop:
+            self.loop = loop.Loop()
 
     def start(self):
         self.srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -20,60 +283,237 @@ class TCP(object):
             if e.errno == errno.EADDRINUSE:
                 # something is already there; just bind to anything for now
                 self.srv.bind(("", 0))
-                self.port = self.srv.getsockname()[1]
             else:
                 raise e
-        thread.start_new_thread(self.accept, ())
+        self.port = self.srv.getsockname()[1]
+        self.srv.listen(128)
+        if self.loop:
+            self.srv.setblocking(0)
+            self.loop.add_reader(self.srv.fileno(), self.accept_ready)
+            self.loop.start()
+        else:
+            thread.start_new_thread(self.accept, ())
 
     def connect(self, addr):
-        conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
-            conn.connect(addr)
+            sock.connect(addr)
         except socket.error as e:
             if e.errno == errno.ECONNREFUSED:
                 return None
-        self.connected.fire(conn, addr)
-        thread.start_new_thread(self.handle_conn, (conn, addr))
+        conn = Conn(sock, addr)
+        self.serve(conn)
+        return conn
+
+    def connect_async(self, addr, timeout=5):
+        '''
+        Start connecting to addr and return its Conn straight away.
+        Anything sent on it is queued until the connection is up; if
+        it never comes up within timeout seconds, the Conn is dropped
+        (and disconnected fires) with conn.established still False.
+        '''
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        conn = Conn(sock, addr)
+        conn.connecting = True
+        conn.established = False
+        if self.loop:
+            sock.setblocking(0)
+            self.loop.call_soon(self.start_connect, conn, timeout)
+        else:
+            thread.start_new_thread(self.blocking_connect, (conn, timeout))
         return conn
 
+    def blocking_connect(self, conn, timeout):
+        try:
+            conn.sock.settimeout(timeout)
+            conn.sock.connect(conn.addr)
+            conn.sock.settimeout(None)
+        except (socket.error, socket.timeout):
+            self.drop(conn)
+            return
+        self.connect_done(conn)
+
+    def start_connect(self, conn, timeout):
+        if conn.closed:
+            return
+        try:
+            err = conn.sock.connect_ex(conn.addr)
+        except socket.error:
+            err = errno.EHOSTUNREACH # e.g. a name that won't resolve
+        if err == 0:
+            self.connect_done(conn)
+            return
+        if err not in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self.drop(conn)
+            return
+        t = self.loop.call_later(timeout, self.drop, conn)
+        def ready():
+            self.loop.cancel(t)
+            self.loop.remove_writer(conn.fd)
+            if conn.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                self.drop(conn)
+            else:
+                self.connect_done(conn)
+        self.loop.add_writer(conn.fd, ready)
+
+    def connect_done(self, conn):
+        try:
+            conn.addr = conn.sock.getpeername()
+        except socket.error:
+            pass
+        with conn.outq.cond:
+            conn.connecting = False
+            conn.established = True
+            pending = conn.outq.bytes > 0
+        self.metrics.count('tcp.connects')
+        self.serve(conn)
+        if pending and self.loop:
+            self.loop.add_writer(conn.fd, lambda: self.write_ready(conn))
+
+    def serve(self, conn):
+        if self.loop:
+            conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn.sock.setblocking(0)
+            self.connected.fire(conn, conn.addr)
+            self.loop.add_reader(conn.fd, lambda: self.read_ready(conn))
+        else:
+            thread.start_new_thread(self.handle_conn, (conn, conn.addr))
+            thread.start_new_thread(self.write_loop, (conn,))
+
     def accept(self):
-        self.srv.listen(5)
         while True:
             try:
-                conn, addr = self.srv.accept()
+                sock, addr = self.srv.accept()
+            except socket.error as e:
+                if e.errno == errno.ECONNABORTED:
+                    continue
+                return # the listener was shut down under us
+            self.metrics.count('tcp.accepts')
+            self.serve(Conn(sock, addr))
+
+    def accept_ready(self):
+        while True:
+            try:
+                sock, addr = self.srv.accept()
             except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
                 if e.errno == errno.ECONNABORTED:
                     continue
-            thread.start_new_thread(self.handle_conn, (conn, addr))
+                self.loop.remove_reader(self.srv.fileno())
+                return
+            self.metrics.count('tcp.accepts')
+            self.serve(Conn(sock, addr))
 
     def handle_conn(self, conn, addr):
-        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self.connected.fire(conn, addr)
-        buff = ""
         while True:
-            msg, buff = self.read_msg(conn, buff)
+            try:
+                n = conn.reader.fill(conn.sock)
+            except socket.error as e:
+                if e.errno == errno.EINTR:
+                    continue
+                break
+            except EOFError:
+                break
+            conn.last = time.time()
+            self.metrics.count('tcp.reads')
+            self.metrics.count('tcp.bytes_in', n)
+            for msg in conn.reader.frames():
+                self.handlers.fire(msg, conn)
+        self.drop(conn)
+
+    def read_ready(self, conn):
+        try:
+            n = conn.reader.fill(conn.sock)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            self.drop(conn)
+            return
+        except EOFError:
+            self.drop(conn)
+            return
+        conn.last = time.time()
+        self.metrics.count('tcp.reads')
+        self.metrics.count('tcp.bytes_in', n)
+        for msg in conn.reader.frames():
             self.handlers.fire(msg, conn)
 
-    def read_msg(self, conn, buff=""):
-        while len(buff) < 4:
-            buff += conn.recv(1024)
-        msgsize = struct.unpack("!I", buff[0:4])[0]
-        buff = buff[4:]
-        while len(buff) < msgsize:
-            buff += conn.recv(1024)
-        msg = buff[:msgsize]
-        buff = buff[msgsize:]
-        return msg, buff
-
-    def send(self, msg, conn):
+    def write_ready(self, conn):
+        while True:
+            data = conn.outq.chunk()
+            if data is None:
+                self.loop.remove_writer(conn.fd)
+                return
+            try:
+                n = conn.sock.send(data)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                self.drop(conn)
+                return
+            conn.outq.sent(n)
+            self.metrics.count('tcp.writes')
+            self.metrics.count('tcp.bytes_out', n)
+
+    def write_loop(self, conn):
+        q = conn.outq
+        while True:
+            with q.cond:
+                while not q.bytes and not conn.closed:
+                    q.cond.wait()
+            if conn.closed:
+                return
+            data = q.chunk()
+            try:
+                n = conn.sock.send(data)
+            except socket.error as e:
+                if e.errno == errno.EINTR:
+                    continue
+                self.drop(conn)
+                return
+            q.sent(n)
+            self.metrics.count('tcp.writes')
+            self.metrics.count('tcp.bytes_out', n)
+
+    def drop(self, conn):
+        if self.loop:
+            if self.loop.running and not self.loop.inloop():
+                # the fd has to leave the poller before it's closed and
+                # maybe reused, and only the loop can touch the poller
+                self.loop.call_soon(self.drop, conn)
+                return
+            if conn.closed:
+                return
+            self.loop.remove_reader(conn.fd)
+            self.loop.remove_writer(conn.fd)
+        if not conn.close():
+            return
+        self.metrics.count('tcp.disconnects' if conn.established else 'tcp.connect_failures')
+        self.disconnected.fire(conn, conn.addr)
+
+    def send(self, msg, conn, bulk=False):
 	    # pepper me with exceptions, for when TCP falls on its
     	# stupid face
-        msgsize = struct.pack("!I", len(msg))
-        conn.send(msgsize + msg)
+        if conn.closed:
+            return
+        conn.last = conn.lastsent = time.time()
+        idle = conn.outq.put(struct.pack("!I", len(msg)), msg, bulk=bulk)
+        if idle and self.loop and not conn.connecting:
+            self.loop.add_writer(conn.fd, lambda: self.write_ready(conn))
+
+    def depth(self, conn):
+        return conn.depth()
 
     def shutdown(self):
+        if self.loop:
+            self.loop.remove_reader(self.srv.fileno())
         try:
             self.srv.shutdown(socket.SHUT_RDWR)
-            self.sock.close()
+            self.srv.close()
         except: # nobody cares
             pass
+        if self.loop:
+            self.loop.stop()
@@ -1,9 +1,239 @@
-from threading import Timer as ThreadTimer
+import time
+import random
+import threading
+import traceback
+
+class Handle(object):
+    '''
+    One scheduled call.  cancel() is O(1): the entry just stays in its
+    slot, marked dead, until the wheel gets there.
+    '''
+    __slots__ = ('tick', 'func', 'args', 'kwargs', 'period', 'jitter',
+                 'cancelled')
+
+    def __init__(self, func, args, kwargs, period, jitter):
+        self.tick = 0
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.period = period
+        self.jitter = jitter
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class Wheel(object):
+    '''
+    A hierarchical timing wheel (Varghese & Lauck).
+
+    Level 0 has one slot per tick; each level above has slots as wide
+    as the whole level below it, so with the defaults (10ms ticks,
+    four levels of 256 slots) anything up to about a year out can be
+    scheduled.  Scheduling drops the call in a slot and cancelling
+    marks it dead, both O(1) whatever the number of timers.  Every
+    time level 0 wraps, the next slot of level 1 is spilled down into
+    it, and so on up.
+
+    Due calls run one after another on the wheel's thread, started on
+    first use, which sleeps straight through stretches with nothing
+    due.  An exception in one call is printed and doesn't disturb
+    anything else.  Pass manual=True (and a clock) to drive the wheel
+    yourself with advance() instead, and rng (a random.Random) to make
+    the jitter reproducible.
+    '''
+    def __init__(self, tick=0.01, slots=256, levels=4, clock=time.time,
+                 manual=False, rng=random):
+        self.tickwidth = tick
+        self.bits = slots.bit_length() - 1
+        if 1 << self.bits != slots:
+            raise ValueError("slots must be a power of two")
+        self.mask = slots - 1
+        self.levels = levels
+        self.wheels = [[[] for _ in xrange(slots)] for _ in xrange(levels)]
+        self.counts = [0] * levels
+        self.clock = clock
+        self.random = rng
+        self.origin = clock()
+        self.cur = 0
+        self.manual = manual
+        self.cond = threading.Condition(threading.Lock())
+        self.thread = None
+        self.wakeat = None
+
+    def ticks(self, t):
+        return int((t - self.origin) / self.tickwidth)
+
+    def later(self, delay, func, *args, **kwargs):
+        return self.schedule(delay, func, args, kwargs)
+
+    def every(self, period, func, *args, **kwargs):
+        return self.schedule(period, func, args, kwargs, period=period)
+
+    def schedule(self, delay, func, args=(), kwargs={}, period=None, jitter=0):
+        '''
+        Call func(*args, **kwargs) in delay seconds, and then every
+        period seconds if there's a period.  Each firing is pushed
+        back a random 0..jitter seconds, so that lots of nodes (or
+        timers) started together don't stay in lockstep.
+        '''
+        h = Handle(func, args, kwargs, period, jitter)
+        with self.cond:
+            self.place(h, self.ticks(self.clock()) + self.delay(delay, jitter))
+            if not self.manual:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run)
+                    self.thread.daemon = True
+                    self.thread.start()
+                elif self.wakeat is None or h.tick < self.wakeat:
+                    self.cond.notify()
+        return h
+
+    def delay(self, seconds, jitter):
+        if jitter:
+            seconds += self.random.uniform(0, jitter)
+        return max(1, int(round(seconds / self.tickwidth)))
+
+    def place(self, h, tick):
+        tick = max(tick, self.cur + 1)
+        h.tick = tick
+        dist = tick - self.cur
+        for level in xrange(self.levels):
+            if dist < 1 << (self.bits * (level + 1)) or level == self.levels - 1:
+                break
+        idx = (tick >> (self.bits * level)) & self.mask
+        if level == self.levels - 1 and dist >= 1 << (self.bits * self.levels):
+            # past the top of the wheel; park it in the furthest slot
+            # and it'll be placed again when that slot spills
+            idx = ((self.cur >> (self.bits * level)) - 1) & self.mask
+        self.wheels[level][idx].append(h)
+        self.counts[level] += 1
+
+    def spill(self, level):
+        idx = (self.cur >> (self.bits * level)) & self.mask
+        slot = self.wheels[level][idx]
+        self.wheels[level][idx] = []
+        self.counts[level] -= len(slot)
+        for h in slot:
+            if not h.cancelled:
+                self.place(h, h.tick)
+
+    def nexttick(self):
+        '''
+        The next tick at which anything can happen: a level 0 slot
+        with something in it, or a point where a higher level spills.
+        '''
+        room = self.mask + 1 - (self.cur & self.mask)
+        if self.counts[0]:
+            for i in xrange(1, room):
+                if self.wheels[0][(self.cur + i) & self.mask]:
+                    return self.cur + i
+        for level in xrange(1, self.levels):
+            if self.counts[level]:
+                span = 1 << (self.bits * level)
+                return (self.cur // span + 1) * span
+        if self.counts[0]:
+            return self.cur + room
+        return None
+
+    def due(self, target):
+        '''
+        Move the wheel up to tick target, returning whatever came due.
+        '''
+        out = []
+        while True:
+            nxt = self.nexttick()
+            if nxt is None or nxt > target:
+                self.cur = target
+                return out
+            self.cur = nxt
+            for level in xrange(self.levels - 1, 0, -1):
+                if self.cur & ((1 << (self.bits * level)) - 1) == 0:
+                    self.spill(level)
+            idx = self.cur & self.mask
+            slot = self.wheels[0][idx]
+            self.wheels[0][idx] = []
+            self.counts[0] -= len(slot)
+            out.extend(h for h in slot if not h.cancelled)
+
+    def fire(self, handles):
+        for h in handles:
+            if h.cancelled:
+                continue
+            try:
+                h.func(*h.args, **h.kwargs)
+            except Exception:
+                print traceback.format_exc()
+            if h.period and not h.cancelled:
+                with self.cond:
+                    self.place(h, self.cur + self.delay(h.period, h.jitter))
+
+    def advance(self, now=None, tick=None):
+        '''
+        Run everything due by now (the clock, if not given), or by
+        tick, if that's given instead.
+        '''
+        if tick is None:
+            tick = self.ticks(self.clock() if now is None else now)
+        with self.cond:
+            handles = self.due(tick)
+        self.fire(handles)
+
+    def nextdue(self):
+        '''
+        For whoever's driving a manual wheel: the next tick worth
+        advancing to, and when it comes, or None if nothing's
+        scheduled.
+        '''
+        with self.cond:
+            nxt = self.nexttick()
+        if nxt is None:
+            return None
+        return nxt, self.origin + nxt * self.tickwidth
+
+    def pending(self):
+        with self.cond:
+            return sum(self.counts)
+
+    def run(self):
+        while True:
+            with self.cond:
+                nxt = self.nexttick()
+                now = self.ticks(self.clock())
+                if nxt is None or nxt > now:
+                    self.wakeat = nxt
+                    if nxt is None:
+                        self.cond.wait()
+                    else:
+                        self.cond.wait(self.origin + nxt * self.tickwidth - self.clock())
+                    self.wakeat = None
+                    continue
+                handles = self.due(now)
+            self.fire(handles)
+
+shared = None
+sharedlock = threading.Lock()
+
+def wheel():
+    '''
+    The process-wide wheel, for anyone who doesn't bring their own.
+    '''
+    global shared
+    with sharedlock:
+        if shared is None:
+            shared = Wheel()
+        return shared
 
 class Timer(object):
-    def __init__(self, interval=1):
+    '''
+    Runs a list of functions every interval seconds (give or take
+    jitter), on a Wheel.
+    '''
+    def __init__(self, interval=1, wheel=None, jitter=0):
         self.interval = interval
+        self.jitter = jitter
         self.funcs = []
+        self.wheel = wheel
         self.t = None
 
     def __iadd__(self, new):
@@ -18,17 +248,19 @@ class Timer(object):
             self.funcs.append((new, (), {}))
         return self
 
-    def start(self):
-        def tick():
-            for f, a, k in self.funcs:
+    def tick(self):
+        for f, a, k in self.funcs:
+            try:
                 f(*a, **k)
-            self.t = ThreadTimer(self.interval, tick)
-            self.t.daemon = True
-            self.t.start()
-        try:
-            tick()
-        except:
-            pass
+            except Exception:
+                print traceback.format_exc()
+
+    def start(self):
+        if self.wheel is None:
+            self.wheel = wheel()
+        self.tick()
+        self.t = self.wheel.schedule(self.interval, self.tick,
+                                    period=self.interval, jitter=self.jitter)
 
     def disable(self):
         if self.t:
@@ -0,0 +1,346 @@
+import json
+import errno
+import random
+import select
+import socket
+import struct
+import threading
+import traceback
+
+import event
+import timer
+import loop
+
+class UDP(object):
+    '''
+    Datagram transport: one non-blocking socket, for sending and
+    receiving both.
+
+    Whoever's reading (a thread of its own, or with evloop=True a
+    loop.Loop) drains up to BATCH datagrams from the socket every time
+    it wakes up, and fires handlers with (data, addr) for each.
+    '''
+    BATCH = 64
+    MAXSIZE = 65507
+
+    def __init__(self, port, evloop=False):
+        self.port = port
+        self.handlers = event.Event()
+        self.sock = None
+        self.loop = None
+        if evloop:
+            self.loop = loop.Loop()
+
+    def start(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            self.sock.bind(("", self.port))
+        except socket.error as e:
+            if e.errno == errno.EADDRINUSE:
+                self.sock.bind(("", 0))
+            else:
+                raise e
+        self.port = self.sock.getsockname()[1]
+        self.sock.setblocking(0)
+        if self.loop:
+            self.loop.add_reader(self.sock.fileno(), self.read_ready)
+            self.loop.start()
+        else:
+            t = threading.Thread(target=self.read_loop)
+            t.daemon = True
+            t.start()
+
+    def read_loop(self):
+        sock = self.sock
+        while True:
+            try:
+                select.select([sock], [], [])
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                return
+            except (socket.error, ValueError):
+                return # closed under us
+            if not self.read_ready():
+                return
+
+    def read_ready(self):
+        '''
+        Handle whatever datagrams are waiting, up to BATCH of them.
+        Returns False once the socket's been closed.
+        '''
+        for _ in xrange(self.BATCH):
+            try:
+                data, addr = self.sock.recvfrom(self.MAXSIZE)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return True
+                if e.errno == errno.ECONNREFUSED:
+                    continue # an ICMP error from some earlier send
+                return False
+            self.handlers.fire(data, addr)
+        return True
+
+    def send(self, data, addr):
+        try:
+            self.sock.sendto(data, tuple(addr))
+        except socket.error as e:
+            if e.errno == errno.EMSGSIZE:
+                raise # no retry is going to fix that
+            # a full buffer or an unreachable host; it's a datagram,
+            # so it's as good as lost, and retries sort it out
+            pass
+
+    def shutdown(self):
+        if self.loop:
+            self.loop.remove_reader(self.sock.fileno())
+            self.loop.stop()
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+class RPCCodec(object):
+    '''
+    The datagram format for RPCs:
+
+        magic    c    'K'
+        kind     B    REQUEST, RESPONSE or ERROR
+        method   B    index into METHODS, 0 if it isn't listed
+        txid     I    transaction id, echoed back in the response
+        sender   20s  sender's node id
+        flags    B    which optional fields follow
+
+    then, if flagged, a 20 byte target id, a count-prefixed list of
+    contacts at 26 bytes apiece (id, IPv4 address, port), a length-
+    prefixed raw value, and finally anything else as a json object.
+    Contacts are most of what a Kademlia node ever sends, so they
+    don't go anywhere near json.
+    '''
+    MAGIC = 'K'
+    HEADER = struct.Struct("!cBBI20sB")
+    CONTACT = struct.Struct("!20s4sH")
+
+    REQUEST, RESPONSE, ERROR = 0, 1, 2
+
+    # append only; the index is what goes on the wire
+    METHODS = [None, 'ping', 'find_node', 'find_value', 'store']
+    CODES = dict((m, i) for i, m in enumerate(METHODS) if m)
+
+    TARGET = 0x01
+    NODES = 0x02
+    VALUE = 0x04
+    REST = 0x08
+
+    @staticmethod
+    def packid(n):
+        return ('%040x' % n).decode('hex')
+
+    @staticmethod
+    def unpackid(s):
+        return int(s.encode('hex'), 16)
+
+    def encode(self, kind, method, txid, sender, args):
+        code = self.CODES.get(method, 0)
+        flags = 0
+        tail = []
+        rest = dict(args)
+        target = rest.pop('target', None)
+        if target is not None:
+            flags |= self.TARGET
+            tail.append(self.packid(target))
+        nodes = rest.pop('nodes', None)
+        if nodes is not None:
+            flags |= self.NODES
+            tail.append(struct.pack("!H", len(nodes)))
+            for nid, addr in nodes:
+                tail.append(self.CONTACT.pack(self.packid(nid),
+                                              socket.inet_aton(addr[0]), addr[1]))
+        value = rest.pop('value', None)
+        if value is not None:
+            flags |= self.VALUE
+            tail.append(struct.pack("!I", len(value)))
+            tail.append(value)
+        if not code:
+            rest['method'] = method
+        if rest:
+            flags |= self.REST
+            tail.append(json.dumps(rest))
+        head = self.HEADER.pack(self.MAGIC, kind, code, txid,
+                                self.packid(sender), flags)
+        return head + "".join(tail)
+
+    def decode(self, data):
+        '''
+        (kind, method, txid, sender, args); raises ValueError if data
+        isn't one of ours.
+        '''
+        if data[:1] != self.MAGIC:
+            raise ValueError("not an rpc")
+        try:
+            magic, kind, code, txid, sender, flags = self.HEADER.unpack_from(data)
+            off = self.HEADER.size
+            args = {}
+            if flags & self.TARGET:
+                args['target'] = self.unpackid(data[off:off + 20])
+                off += 20
+            if flags & self.NODES:
+                n = struct.unpack_from("!H", data, off)[0]
+                off += 2
+                nodes = []
+                for _ in xrange(n):
+                    nid, ip, port = self.CONTACT.unpack_from(data, off)
+                    off += self.CONTACT.size
+                    nodes.append((self.unpackid(nid), (socket.inet_ntoa(ip), port)))
+                args['nodes'] = nodes
+            if flags & self.VALUE:
+                n = struct.unpack_from("!I", data, off)[0]
+                off += 4
+                args['value'] = data[off:off + n]
+                off += n
+            if flags & self.REST:
+                args.update(json.loads(data[off:]))
+        except (struct.error, ValueError, socket.error) as e:
+            raise ValueError("bad rpc: %s" % e)
+        method = self.METHODS[code] if 0 < code < len(self.METHODS) else args.pop('method', None)
+        return kind, method, txid, self.unpackid(sender), args
+
+class RPC(object):
+    '''
+    Request/response calls over a UDP transport.
+
+    call() sends a request and hands back an event.Future for the
+    response.  Requests carry a random transaction id that the
+    response echoes, so any number of calls to any number of nodes can
+    be in flight at once.  A request that hasn't been answered after
+    timeout seconds is sent again, up to retries times, and then the
+    Future fails with event.Timeout.  One too big to fit in a
+    datagram fails straight away with ValueError, without being sent,
+    and one to a host name that doesn't resolve with the socket error.
+
+    serve() sets up the handler for a method.  It's called with
+    (args, addr, sender) and whatever dict it returns is the response;
+    an exception goes back to the caller as an error.
+
+    Every datagram we get (request or response) fires seen with the
+    sender's (id, addr), which is how the DHT keeps its routing table
+    fresh without any heartbeats of its own.
+    '''
+    def __init__(self, transport, myid, wheel=None, timeout=1.0, retries=2):
+        self.transport = transport
+        self.id = myid
+        self.wheel = wheel or timer.wheel()
+        self.timeout = timeout
+        self.retries = retries
+        self.codec = RPCCodec()
+        self.maxsize = getattr(transport, 'MAXSIZE', UDP.MAXSIZE)
+        self.pending = {} # txid -> [future, addr, data, tries left, wheel handle]
+        self.lock = threading.Lock()
+        self.methods = {}
+        self.seen = event.Event()
+        self.stats = {'sent': 0, 'received': 0, 'retries': 0, 'timeouts': 0}
+        transport.handlers += self.handle
+
+    def serve(self, method, handler):
+        self.methods[method] = handler
+
+    def fits(self, method, **args):
+        '''
+        Whether a request with args would fit in a datagram.
+        '''
+        data = self.codec.encode(self.codec.REQUEST, method, 0, self.id, args)
+        return len(data) <= self.maxsize
+
+    def call(self, addr, method, timeout=None, retries=None, **args):
+        future = event.Future()
+        try:
+            # the answer comes back from an IP, not a name, and that's
+            # what handle() checks it against
+            addr = (socket.gethostbyname(addr[0]), addr[1])
+        except socket.error as e:
+            future.addr = tuple(addr)
+            future.set_exception(e)
+            return future
+        future.addr = addr
+        timeout = self.timeout if timeout is None else timeout
+        retries = self.retries if retries is None else retries
+        with self.lock:
+            txid = random.getrandbits(32)
+            while txid in self.pending:
+                txid = random.getrandbits(32)
+            data = self.codec.encode(self.codec.REQUEST, method, txid, self.id, args)
+            big = len(data) > self.maxsize
+            if not big:
+                entry = [future, addr, data, retries, None]
+                self.pending[txid] = entry
+                entry[4] = self.wheel.later(timeout, self.expire, txid, timeout)
+        if big:
+            future.set_exception(ValueError("%s request of %d bytes won't fit in a datagram"
+                                            % (method, len(data))))
+            return future
+        self.transmit(data, addr)
+        return future
+
+    def transmit(self, data, addr):
+        self.stats['sent'] += 1
+        self.transport.send(data, addr)
+
+    def expire(self, txid, timeout):
+        with self.lock:
+            entry = self.pending.get(txid, None)
+            if entry is None:
+                return
+            future, addr, data, left, h = entry
+            if left > 0:
+                entry[3] = left - 1
+                entry[4] = self.wheel.later(timeout, self.expire, txid, timeout)
+                self.stats['retries'] += 1
+            else:
+                del self.pending[txid]
+                self.stats['timeouts'] += 1
+        if left > 0:
+            self.transmit(data, addr)
+        else:
+            future.set_exception(event.Timeout("no answer from %s:%d" % addr))
+
+    def handle(self, data, addr):
+        try:
+            kind, method, txid, sender, args = self.codec.decode(data)
+        except ValueError:
+            return
+        self.stats['received'] += 1
+        if sender == self.id:
+            return
+        self.seen.fire(sender, addr)
+        if kind == self.codec.REQUEST:
+            self.answer(method, txid, sender, args, addr)
+            return
+        with self.lock:
+            entry = self.pending.get(txid, None)
+            if entry is None or entry[1] != addr:
+                return # late, or not from who we asked
+            del self.pending[txid]
+        future = entry[0]
+        entry[4].cancel()
+        future.sender = sender
+        if kind == self.codec.ERROR:
+            future.set_exception(RuntimeError(args.get('error', 'rpc failed')))
+        else:
+            future.set_result(args)
+
+    def answer(self, method, txid, sender, args, addr):
+        handler = self.methods.get(method, None)
+        try:
+            if handler is None:
+                raise RuntimeError("no such method %s" % method)
+            resp = handler(args, addr, sender) or {}
+            kind = self.codec.RESPONSE
+        except Exception as e:
+            print traceback.format_exc()
+            resp = {'error': str(e)}
+            kind = self.codec.ERROR
+        data = self.codec.encode(kind, method, txid, self.id, resp)
+        if len(data) > self.maxsize:
+            data = self.codec.encode(self.codec.ERROR, method, txid, self.id,
+                                     {'error': "response too big for a datagram"})
+        self.transmit(data, addr)
@@ -0,0 +1,94 @@
+'''
+Everyone in a lace after the same lock at once, from a couple of
+threads apiece: nobody may ever hold it while somebody else does.
+
+    python -m unittest discover tests
+'''
+
+import os
+import sys
+import time
+import threading
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "p2p"))
+import broadcaster
+import event
+
+class ContentionTest(unittest.TestCase):
+    NODES = 6
+    THREADS = 2 # per node
+    ROUNDS = 10
+
+    def lace(self, evloop):
+        first = broadcaster.Broadcaster(port=0, heartbeat=5, evloop=evloop)
+        first.base()
+        first.start()
+        nodes = [first]
+        for i in xrange(self.NODES - 1):
+            b = broadcaster.Broadcaster([('127.0.0.1', first.tcp.port)], port=0,
+                                        heartbeat=5, evloop=evloop)
+            b.start()
+            nodes.append(b)
+            time.sleep(0.5)
+        self.assertFalse([b for b in nodes if b.value == (0, 0)])
+        return nodes
+
+    def check(self, evloop):
+        nodes = self.lace(evloop)
+        holders = []
+        overlaps = []
+        errors = []
+        count = threading.Lock()
+        def contend(b):
+            try:
+                for i in xrange(self.ROUNDS):
+                    b.acquire(key='k', timeout=30).result(35)
+                    with count:
+                        if holders:
+                            overlaps.append((holders[:], b.value))
+                        holders.append(b.value)
+                    time.sleep(0.002)
+                    with count:
+                        holders.remove(b.value)
+                    b.release('k')
+            except Exception as e:
+                errors.append(e)
+        try:
+            threads = [threading.Thread(target=contend, args=(b,))
+                       for b in nodes for i in xrange(self.THREADS)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join(120)
+            self.assertEqual(errors, [])
+            self.assertEqual(overlaps, [])
+        finally:
+            for b in nodes:
+                b.stop()
+
+    def test_threads(self):
+        self.check(False)
+
+    def test_evloop(self):
+        self.check(True)
+
+    def test_queued_deadline(self):
+        b = broadcaster.Broadcaster(port=0, heartbeat=5)
+        b.base()
+        b.start()
+        try:
+            b.acquire(key='k', timeout=5).result(5)
+            # waits behind the first, and gives up on time
+            late = b.acquire(key='k', timeout=0.2)
+            nxt = b.acquire(key='k', timeout=5)
+            self.assertRaises(event.Timeout, late.result, 5)
+            self.assertFalse(nxt.done())
+            b.release('k')
+            self.assertEqual(nxt.result(5)['key'], 'k')
+            b.release('k')
+            self.assertTrue(b.lock_for('k').idle())
+        finally:
+            b.stop()
+
+if __name__ == '__main__':
+    unittest.main()
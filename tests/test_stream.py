@@ -0,0 +1,99 @@
+'''
+Streams through a relay to a child that reads slowly: the relay has to
+hold the transfer back, not queue all of it for the child, and without
+holding up anything else the lace has to say in the meantime.
+
+    python -m unittest discover tests
+'''
+
+import os
+import sys
+import time
+import socket
+import hashlib
+import threading
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "p2p"))
+import broadcaster
+import stream
+import tcp
+
+class SlowReader(tcp.FrameReader):
+    MAXREAD = 16384
+
+    def fill(self, sock):
+        time.sleep(0.01)
+        return tcp.FrameReader.fill(self, sock)
+
+class SlowTCP(tcp.TCP):
+    '''
+    Reads about 1.5MB/s, however fast it's sent to.
+    '''
+    def serve(self, conn):
+        conn.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 32768)
+        conn.reader = SlowReader()
+        tcp.TCP.serve(self, conn)
+
+class SlowChildTest(unittest.TestCase):
+    SIZE = 16 * 1024 * 1024
+
+    def lace(self, evloop):
+        # (1, 1) streams; (2, 1) relays it down its column to (2, 2),
+        # which is the slow one
+        first = broadcaster.Broadcaster(port=0, heartbeat=5, evloop=evloop)
+        first.base()
+        first.start()
+        nodes = [first]
+        for i in xrange(3):
+            kw = {'transport': SlowTCP(0, evloop)} if i == 2 else {}
+            b = broadcaster.Broadcaster([('127.0.0.1', first.tcp.port)], port=0,
+                                        heartbeat=5, evloop=evloop, **kw)
+            b.start()
+            nodes.append(b)
+            time.sleep(0.5)
+        self.assertEqual([b.value for b in nodes], [(1, 1), (2, 1), (1, 2), (2, 2)])
+        return nodes
+
+    def check(self, evloop):
+        nodes = self.lace(evloop)
+        try:
+            got = []
+            nodes[3].event += lambda data, **kw: \
+                got.append(hashlib.sha1(data['stream'].read()).hexdigest())
+            src = os.urandom(self.SIZE)
+            nodes[0].send_stream(src)
+            locked = []
+            def lock():
+                # needs a word from everyone, the slow one included
+                start = time.time()
+                nodes[1].acquire(key='meanwhile', timeout=5).result(6)
+                locked.append((time.time() - start, bool(got)))
+                nodes[1].release('meanwhile')
+            threading.Timer(1, lock).start()
+            peak = 0
+            end = time.time() + 60
+            while not got and time.time() < end:
+                for b in nodes[:3]:
+                    for c in set(b.conns.conns.values()):
+                        peak = max(peak, c.outq.bulkbytes)
+                time.sleep(0.002)
+            self.assertEqual(got, [hashlib.sha1(src).hexdigest()])
+            # a window and a chunk, give or take, never the whole thing
+            self.assertTrue(peak <= stream.Streams.WINDOW + stream.Streams.CHUNK * 2,
+                            "%d bytes queued on one connection" % peak)
+            wait, after = locked[0]
+            self.assertFalse(after, "the lock waited for the stream")
+            self.assertTrue(wait < 2, "%.1fs for the lock" % wait)
+            self.assertEqual([b.suspects for b in nodes], [{}] * len(nodes))
+        finally:
+            for b in nodes:
+                b.stop()
+
+    def test_threads(self):
+        self.check(False)
+
+    def test_evloop(self):
+        self.check(True)
+
+if __name__ == '__main__':
+    unittest.main()